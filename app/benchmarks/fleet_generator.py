@@ -0,0 +1,95 @@
+import random
+from app.main.model.fleet import Fleet
+
+# Share of each type of power plant in a generated fleet
+DEFAULT_MIX = {"gasfired": 0.6, "turbojet": 0.15, "windturbine": 0.25}
+
+
+def generate_power_plants(size, seed=0, mix=None, decimals=0):
+    """
+    Generates the powerplants of a request, with limits and efficiencies in the range of real power plants
+    :param size: number of power plants
+    :param seed: seed of the random generator, the same seed giving the same power plants
+    :param mix: dict of the share of each type of power plant, DEFAULT_MIX if None
+    :param decimals: number of decimals of the limits, 0 for whole MWs. Fractional limits refine the grid of the dp
+    engine, down to 0.01 MW for 2 decimals
+    :return: list of power plant dicts, as in the payloads
+    """
+    rng = random.Random(seed)
+    mix = mix or DEFAULT_MIX
+    power_plant_types = rng.choices(list(mix), weights=list(mix.values()), k=size)
+    power_plants = []
+    for number, power_plant_type in enumerate(power_plant_types):
+        if power_plant_type == "gasfired":
+            pmax = rng.randrange(100, 500, 10)
+            power_plant = {"efficiency": round(rng.uniform(0.35, 0.6), 2), "pmin": round(pmax * rng.uniform(0.2, 0.5)),
+                           "pmax": pmax}
+        elif power_plant_type == "turbojet":
+            power_plant = {"efficiency": round(rng.uniform(0.25, 0.35), 2), "pmin": 0,
+                           "pmax": rng.randrange(10, 80, 2)}
+        else:
+            power_plant = {"efficiency": 1, "pmin": 0, "pmax": rng.randrange(50, 250, 10)}
+        if decimals:
+            power_plant["pmax"] = round(power_plant["pmax"] - rng.random(), decimals)
+            if power_plant["pmin"]:
+                power_plant["pmin"] = round(power_plant["pmin"] + rng.random(), decimals)
+        power_plants.append(dict(name=f"{power_plant_type}{number}", type=power_plant_type, **power_plant))
+    return power_plants
+
+
+def generate_fuels(seed=0):
+    """Generates the fuels of a request, with prices in the range of the market"""
+    rng = random.Random(seed)
+    return {"gas(euro/MWh)": round(rng.uniform(10, 30), 1),
+            "kerosine(euro/MWh)": round(rng.uniform(40, 70), 1),
+            "co2(euro/ton)": round(rng.uniform(10, 30)),
+            "wind(%)": round(rng.uniform(0, 100))}
+
+
+def transition_loads(power_plants, fuels, count, seed=0):
+    """
+    Loads around the pmin transitions of the merit order, where the load left for the next power plant is just below
+    or above its pmin. They are the worst case of the transition search of the legacy engine. The loads are spread
+    over the capacity: each one is around the transition nearest a load drawn in the next of count equal bands of it
+    :param count: number of loads
+    :return: sorted list of int loads, between 0 and the capacity of the power plants
+    """
+    rng = random.Random(seed)
+    fleet = Fleet.from_raw_data(power_plants)
+    fleet.set_fuels(fuels)
+    fleet.sort()
+    capacity = int(fleet.effective_pmax.sum())
+    transitions = [int(fleet.effective_pmax[:number].sum() + fleet.effective_pmin[number])
+                   for number in range(len(fleet)) if fleet.effective_pmin[number] > 0]
+    transitions = [transition for transition in transitions if transition <= capacity] or [capacity // 2]
+    loads = set()
+    band = 0
+    while len(loads) < min(count, capacity + 1):
+        target = (band % count + rng.random()) * capacity / count
+        transition = min(transitions, key=lambda transition: abs(transition - target))
+        loads.add(min(capacity, max(0, transition + rng.randint(-5, 5))))
+        band += 1
+    return sorted(loads)
+
+
+def capacity_loads(power_plants, fuels, count, low=0.4, high=0.6, seed=0):
+    """
+    Loads drawn uniformly between two shares of the capacity of the power plants. The grid of the dp engine grows with
+    the load, so the higher loads are its worst case
+    :param count: number of loads
+    :param low: smallest share of the capacity
+    :param high: largest share of the capacity
+    :return: sorted list of int loads
+    """
+    rng = random.Random(seed)
+    fleet = Fleet.from_raw_data(power_plants)
+    fleet.set_fuels(fuels)
+    capacity = fleet.effective_pmax.sum()
+    return sorted(int(rng.uniform(low, high) * capacity) for _ in range(count))
+
+
+def generate_payload(size, seed=0, mix=None, decimals=0):
+    """Request of the /powerplant/ route with generated powerplants and fuels, and a load around a pmin transition"""
+    power_plants = generate_power_plants(size, seed, mix, decimals)
+    fuels = generate_fuels(seed)
+    return {"load": transition_loads(power_plants, fuels, 1, seed)[0], "fuels": fuels, "powerplants": power_plants}
@@ -0,0 +1,343 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import pathlib
+import platform
+import argparse
+import itertools
+import subprocess
+import urllib.request
+import numpy as np
+from app.benchmarks.run import PERCENTILES
+
+EXAMPLE_PAYLOADS = pathlib.Path(__file__).resolve().parents[2] / "example_payloads"
+# Statuses counted as error rates in the report. The others but 200 are counted as other_errors
+ERROR_STATUSES = {400: "infeasible", 422: "invalid", 503: "busy", 504: "solver_timeout"}
+# Seconds between two samples of the CPU and memory of the server
+SAMPLING_INTERVAL = 0.5
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+def read_requests(path=EXAMPLE_PAYLOADS):
+    """
+    Requests replayed by the load test
+    :param path: directory of JSON payloads of POST /powerplant/, or NDJSON file of recorded requests, each a dict of
+    method, path and body, or only the payload of POST /powerplant/
+    :return: list of tuples of method, path and body
+    """
+    path = pathlib.Path(path)
+    if path.is_dir():
+        return [("POST", "/powerplant/", json.loads(payload_path.read_text()))
+                for payload_path in sorted(path.glob("*.json"))]
+    requests = []
+    with open(path, "r") as fp:
+        for line in fp:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if "body" in record:
+                requests.append((record.get("method", "POST"), record.get("path", "/powerplant/"), record["body"]))
+            else:
+                requests.append(("POST", "/powerplant/", record))
+    return requests
+
+
+def encode_request(method, path, body, host):
+    """Bytes of the HTTP request, the connection being closed after the response"""
+    body = json.dumps(body).encode()
+    head = (f"{method} {path} HTTP/1.1\r\nHost: {host}\r\nContent-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n")
+    return head.encode() + body
+
+
+async def send(host, port, request):
+    """Sends the encoded request on a new connection and returns the status of the response, read to its end"""
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        writer.write(request)
+        status_line = await reader.readline()
+        await reader.read()
+    finally:
+        writer.close()
+    return int(status_line.split()[1])
+
+
+async def timed_send(host, port, request, start, timeout):
+    """
+    :param start: time of the loop from which the latency is measured
+    :return: tuple of the latency in seconds and the status, timeout or connection_error
+    """
+    loop = asyncio.get_event_loop()
+    try:
+        status = await asyncio.wait_for(send(host, port, request), timeout)
+    except asyncio.TimeoutError:
+        status = "timeout"
+    except (OSError, ValueError, IndexError):
+        status = "connection_error"
+    return loop.time() - start, status
+
+
+async def generate_load(host, port, requests, concurrency, duration, rate=None, timeout=30):
+    """
+    Replays the encoded requests in a loop for the duration
+    :param concurrency: maximum number of requests in flight
+    :param rate: requests per second started at a fixed pace, their latency including the time they waited for one of
+    the concurrent slots. None to send the next request as soon as a slot is free
+    :param timeout: seconds after which a request is given up
+    :return: list of tuples of latency and status, as returned by timed_send
+    """
+    loop = asyncio.get_event_loop()
+    next_requests = itertools.cycle(requests)
+    start = loop.time()
+    results = []
+    if rate is None:
+        async def send_in_loop():
+            while loop.time() < start + duration:
+                results.append(await timed_send(host, port, next(next_requests), loop.time(), timeout))
+
+        await asyncio.gather(*(send_in_loop() for _ in range(concurrency)))
+        return results
+
+    slots = asyncio.Semaphore(concurrency)
+
+    async def send_in_slot(request, scheduled):
+        async with slots:
+            results.append(await timed_send(host, port, request, scheduled, timeout))
+
+    sent = []
+    for index in range(int(duration * rate)):
+        scheduled = start + index / rate
+        await asyncio.sleep(max(0.0, scheduled - loop.time()))
+        sent.append(asyncio.ensure_future(send_in_slot(next(next_requests), scheduled)))
+    await asyncio.gather(*sent)
+    return results
+
+
+def process_tree(pid):
+    """IDs of the process and of all its descendants, e.g. the workers of the WSGI server and their solver pools"""
+    children = {}
+    for stat_path in pathlib.Path("/proc").glob("[0-9]*/stat"):
+        try:
+            stat = stat_path.read_text()
+        except OSError:
+            continue
+        parent = int(stat.rsplit(")", 1)[1].split()[1])
+        children.setdefault(parent, []).append(int(stat_path.parent.name))
+    pids, pending = [], [pid]
+    while pending:
+        pids.append(pending.pop())
+        pending.extend(children.get(pids[-1], []))
+    return pids
+
+
+def process_usage(pid):
+    """
+    CPU and memory of the process and its descendants, read from /proc
+    :return: tuple of the CPU time in seconds and the resident memory in bytes, None where /proc is missing
+    """
+    if not pathlib.Path("/proc").is_dir():
+        return None
+    cpu_seconds, rss_bytes = 0.0, 0
+    for process_id in process_tree(pid):
+        try:
+            stat = pathlib.Path(f"/proc/{process_id}/stat").read_text().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        # utime and stime are the 12th and 13th fields after the name, rss the 22nd, in pages
+        cpu_seconds += (int(stat[11]) + int(stat[12])) / CLOCK_TICKS
+        rss_bytes += int(stat[21]) * PAGE_SIZE
+    return cpu_seconds, rss_bytes
+
+
+async def sample_usage(pid, samples, stop):
+    """Appends a (time, CPU seconds, RSS bytes) sample of the process tree to samples until stop is set"""
+    loop = asyncio.get_event_loop()
+    while not stop.is_set():
+        usage = process_usage(pid)
+        if usage is not None:
+            samples.append((loop.time(),) + usage)
+        try:
+            await asyncio.wait_for(stop.wait(), SAMPLING_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+
+def summarize_usage(samples):
+    """CPU in percent of one core and memory of the server over the samples, None without at least two of them"""
+    if len(samples) < 2:
+        return None
+    (first_time, first_cpu, _), (last_time, last_cpu, _) = samples[0], samples[-1]
+    rss = np.array([sample[2] for sample in samples])
+    return {"cpu_percent": 100 * (last_cpu - first_cpu) / (last_time - first_time),
+            "rss_mean_bytes": int(rss.mean()), "rss_peak_bytes": int(rss.max())}
+
+
+def summarize_results(results, duration):
+    """Throughput, latency percentiles in milliseconds, statuses and error rates of the results of generate_load"""
+    count = len(results)
+    statuses = {}
+    for _, status in results:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    summary = {"requests": count, "duration_s": duration, "throughput_rps": count / duration, "statuses": statuses}
+    if count:
+        latencies_ms = np.array([latency for latency, _ in results]) * 1000
+        summary["latency"] = {"mean_ms": float(latencies_ms.mean()), "max_ms": float(latencies_ms.max())}
+        for percentile in PERCENTILES:
+            summary["latency"][f"p{percentile}_ms"] = float(np.percentile(latencies_ms, percentile))
+    error_counts = dict.fromkeys(list(ERROR_STATUSES.values()) + ["other_errors", "timeout", "connection_error"], 0)
+    for status, status_count in statuses.items():
+        if status in error_counts:
+            error_counts[status] += status_count
+        elif status.isdigit() and int(status) in ERROR_STATUSES:
+            error_counts[ERROR_STATUSES[int(status)]] += status_count
+        elif status != "200":
+            error_counts["other_errors"] += status_count
+    summary["error_rates"] = {name: error_count / count if count else 0.0 for name, error_count in error_counts.items()}
+    return summary
+
+
+def run_load_test(host, port, requests, concurrency, duration, rate=None, timeout=30, server_pid=None):
+    """
+    Warms the server up with each request once, then replays them at the concurrency and rate for the duration
+    :param requests: list of tuples of method, path and body, as returned by read_requests
+    :param server_pid: ID of the process of the server, whose CPU and memory are sampled, None to not sample them
+    :return: dict of the summary of the results, with the usage of the server under server
+    """
+    encoded_requests = [encode_request(method, path, body, host) for method, path, body in requests]
+    loop = asyncio.get_event_loop()
+    for request in encoded_requests:
+        loop.run_until_complete(timed_send(host, port, request, loop.time(), timeout))
+    samples, stop = [], asyncio.Event()
+
+    async def load_and_sample():
+        sampling = asyncio.ensure_future(sample_usage(server_pid, samples, stop)) if server_pid else None
+        start = loop.time()
+        results = await generate_load(host, port, encoded_requests, concurrency, duration, rate, timeout)
+        elapsed = loop.time() - start
+        stop.set()
+        if sampling is not None:
+            await sampling
+        return results, elapsed
+
+    results, elapsed = loop.run_until_complete(load_and_sample())
+    summary = summarize_results(results, elapsed)
+    summary["server"] = summarize_usage(samples)
+    return summary
+
+
+def start_server(server, port, env):
+    """
+    Starts the app in a process of its own
+    :param server: gunicorn, as in the Dockerfile, or flask for the development server of manage.py
+    :param env: environment variables of the app, e.g. WEB_CONCURRENCY, VALIDATION_MODE or DISPATCH_CACHE
+    :return: Popen of the server
+    """
+    env = dict(os.environ, PORT=str(port), **env)
+    env.setdefault("FLASK_ENV", "production")
+    root = str(pathlib.Path(__file__).resolve().parents[2])
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [root, env.get("PYTHONPATH")]))
+    if server == "gunicorn":
+        command = [sys.executable, "-m", "gunicorn", "--config", "app/gunicorn_config.py", "app.wsgi:app"]
+    else:
+        command = [sys.executable, "-m", "app.manage"]
+    return subprocess.Popen(command, cwd=root, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def wait_until_ready(host, port, process, timeout=30):
+    """Waits until the server answers GET /metrics"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"The server exited with code {process.returncode} before being ready")
+        try:
+            with urllib.request.urlopen(f"http://{host}:{port}/metrics", timeout=1):
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"The server was not ready within {timeout} s")
+
+
+def stop_server(process):
+    process.terminate()
+    try:
+        process.wait(10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def compare(report, baseline):
+    """Relative change of the throughput and of the latency percentiles of the report from the baseline"""
+    changes = {}
+    names = [("throughput_rps", None)] + [(f"p{percentile}_ms", "latency") for percentile in PERCENTILES]
+    for name, group in names:
+        value = report["results"].get(group, {}).get(name) if group else report["results"].get(name)
+        baseline_value = baseline["results"].get(group, {}).get(name) if group else baseline["results"].get(name)
+        if value is not None and baseline_value:
+            changes[name] = value / baseline_value - 1
+    return changes
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replays requests against the app started locally, at a given "
+                                                 "concurrency and rate, and reports its throughput and latencies")
+    parser.add_argument("--requests", default=str(EXAMPLE_PAYLOADS),
+                        help="directory of JSON payloads of POST /powerplant/ or NDJSON file of recorded requests")
+    parser.add_argument("--server", default="gunicorn", choices=["gunicorn", "flask"])
+    parser.add_argument("--url", help="host:port of a server already running, instead of starting one")
+    parser.add_argument("--port", type=int, default=5051, help="port of the server started")
+    parser.add_argument("--env", action="append", default=[], metavar="NAME=VALUE",
+                        help="environment variable of the server started, e.g. WEB_CONCURRENCY=4 or DISPATCH_CACHE=off")
+    parser.add_argument("--concurrency", type=int, default=8, help="maximum number of requests in flight")
+    parser.add_argument("--rate", type=float, help="requests per second, as fast as the concurrency allows by default")
+    parser.add_argument("--duration", type=float, default=10, help="seconds of load")
+    parser.add_argument("--timeout", type=float, default=30, help="seconds after which a request is given up")
+    parser.add_argument("--label", help="name of the configuration tested, kept in the report")
+    parser.add_argument("--output", help="file to write the JSON report to, else it is printed")
+    parser.add_argument("--baseline", help="JSON report to compare with")
+    args = parser.parse_args(argv)
+
+    env = dict(variable.split("=", 1) for variable in args.env)
+    requests = read_requests(args.requests)
+    if not requests:
+        parser.error(f"No requests found in {args.requests}")
+    process = None
+    if args.url:
+        host, port = args.url.rsplit(":", 1)
+        port = int(port)
+    else:
+        host, port = "127.0.0.1", args.port
+        process = start_server(args.server, port, env)
+    try:
+        if process is not None:
+            wait_until_ready(host, port, process)
+        results = run_load_test(host, port, requests, args.concurrency, args.duration, args.rate, args.timeout,
+                                process.pid if process is not None else None)
+    finally:
+        if process is not None:
+            stop_server(process)
+
+    report = {"metadata": {"label": args.label, "server": args.url or args.server, "env": env,
+                           "requests": args.requests, "concurrency": args.concurrency, "rate": args.rate,
+                           "duration": args.duration, "python": platform.python_version(),
+                           "platform": platform.platform(), "cpus": os.cpu_count(),
+                           "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S")},
+              "results": results}
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump(report, fp, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    if args.baseline:
+        with open(args.baseline, "r") as fp:
+            changes = compare(report, json.load(fp))
+        for name, change in changes.items():
+            print(f"{name}: {change:+.1%} from the baseline", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,310 @@
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import numpy as np
+from app.main.model.fleet import Fleet
+from app.main.model.power_plant import PowerPlantConfigurationError
+from app.main.controller.fast_validation import fast_load_validator
+from app.main.service import load_calculations, supply_curve, incremental_dispatch, scheduling
+from app.main.service.dispatch_cache import DispatchCache
+from app.main.service.fleet_registry import RegisteredFleet
+
+# Largest fleet of a case: the oracle enumerates its 2^size sets of power plants on
+MAX_SIZE = 10
+# Relative difference of cost, and difference of load in MW, below which two dispatches are considered equal
+COST_TOLERANCE = 1e-7
+LOAD_TOLERANCE = 1e-6
+# Time budget in seconds of each dispatch mode for all the loads of a case, tens of times their usual duration so that
+# only a regression (e.g. a search that blows up) exceeds it
+TIME_BUDGET = 1.0
+# Modes that are not exact: their dispatches must be valid and can not be cheaper than the oracle, but they may miss
+# the cheapest one or a feasible one
+HEURISTIC_MODES = {"legacy", "schedule/ramps"}
+
+
+def exhaustive_dispatch(fleet, load):
+    """
+    Cheapest dispatch of the load, enumerating every set of power plants on. For a given set, the cheapest dispatch
+    puts all of them at pmin and raises them in merit order, the costs being linear
+    :param fleet: Fleet with its fuels set, of at most MAX_SIZE power plants
+    :param load: load to distribute
+    :return: tuple of the cost and the array of the load on each power plant, None if no set can deliver the load
+    """
+    size = len(fleet)
+    if size > MAX_SIZE:
+        raise ValueError(f"The oracle enumerates fleets of at most {MAX_SIZE} power plants, not {size}")
+    merit_order = np.argsort(fleet.cost_per_mwh, kind="stable")
+    pmin, pmax = fleet.effective_pmin[merit_order], fleet.effective_pmax[merit_order]
+    on_sets = ((np.arange(2 ** size)[:, np.newaxis] >> np.arange(size)) & 1) == 1
+    on_sets &= pmax > 0
+    minimum = on_sets @ pmin
+    room = on_sets * (pmax - pmin)
+    feasible = (minimum <= load + LOAD_TOLERANCE) & (minimum + room.sum(axis=1) >= load - LOAD_TOLERANCE)
+    if not feasible.any():
+        return None
+    on_sets, minimum, room = on_sets[feasible], minimum[feasible], room[feasible]
+    raised = np.clip((load - minimum)[:, np.newaxis] - (np.cumsum(room, axis=1) - room), 0, room)
+    loads = on_sets * pmin + raised
+    costs = loads @ fleet.cost_per_mwh[merit_order]
+    cheapest = int(np.argmin(costs))
+    sorted_loads = np.zeros(size)
+    sorted_loads[merit_order] = loads[cheapest]
+    return float(costs[cheapest]), sorted_loads
+
+
+def generate_case(seed, max_size=8):
+    """
+    Small fleet of gas-fired power plants, turbojets of zero pmin and wind turbines, with the loads at which the
+    feasibility or the set of power plants on changes: the sums of pmin and of pmax of the sets of power plants,
+    one MW off on both sides, and 0 and the capacity. The limits of half the fleets are in hundredths of MW and the
+    wind (%) may be too, so that the limits of the wind turbines fall off the grid of the dp engine
+    :return: dict of fuels, powerplants and loads, the loads int as the engines distribute int loads
+    """
+    rng = random.Random(seed)
+    power_plants = []
+    fractional = rng.random() < 0.5
+    for number in range(rng.randint(1, max_size)):
+        power_plant_type = rng.choice(["gasfired", "gasfired", "turbojet", "windturbine"])
+        if power_plant_type == "gasfired":
+            pmax = rng.randrange(20, 300, 10)
+            power_plant = {"efficiency": round(rng.uniform(0.3, 0.6), 2), "pmin": rng.randrange(0, pmax, 5),
+                           "pmax": pmax}
+        elif power_plant_type == "turbojet":
+            power_plant = {"efficiency": round(rng.uniform(0.25, 0.35), 2), "pmin": 0, "pmax": rng.randrange(5, 60)}
+        else:
+            power_plant = {"efficiency": 1, "pmin": 0, "pmax": rng.randrange(10, 150, 10)}
+        if fractional:
+            power_plant["pmax"] = round(power_plant["pmax"] - rng.random(), 2)
+            if power_plant["pmin"]:
+                power_plant["pmin"] = round(power_plant["pmin"] + rng.random(), 2)
+        power_plants.append(dict(name=f"{power_plant_type}{number}", type=power_plant_type, **power_plant))
+    # Some power plants of the same efficiency, whose ties the engines must break the same way
+    if len(power_plants) > 1 and rng.random() < 0.3:
+        first, second = rng.sample(range(len(power_plants)), 2)
+        if power_plants[first]["type"] == power_plants[second]["type"]:
+            power_plants[second]["efficiency"] = power_plants[first]["efficiency"]
+    fuels = {"gas(euro/MWh)": round(rng.uniform(10, 30), 1), "kerosine(euro/MWh)": round(rng.uniform(40, 70), 1),
+             "co2(euro/ton)": rng.randrange(0, 30),
+             "wind(%)": rng.choice([0, 100, rng.randrange(0, 100), round(rng.uniform(0, 100), 2)])}
+    fleet = Fleet.from_raw_data(power_plants)
+    fleet.set_fuels(fuels)
+    on_sets = ((np.arange(2 ** len(fleet))[:, np.newaxis] >> np.arange(len(fleet))) & 1) == 1
+    boundaries = set((on_sets @ fleet.effective_pmin).tolist()) | set((on_sets @ fleet.effective_pmax).tolist())
+    loads = {int(boundary) + offset for boundary in boundaries for offset in (-1, 0, 1)}
+    loads = sorted(load for load in loads if load >= 0)
+    return {"fuels": fuels, "powerplants": power_plants, "loads": rng.sample(loads, min(len(loads), 12))}
+
+
+def dispatch_with_engine(engine):
+    def dispatch(case):
+        return [distribute(lambda payload: load_calculations.load_distributor(payload, engine, cache=None),
+                           dict(case, load=load)) for load in case["loads"]]
+    return dispatch
+
+
+def distribute(load_distributor, payload):
+    """Response of the load distributor, None if the load can not be distributed, the exception if it failed"""
+    try:
+        return load_distributor(payload)
+    except PowerPlantConfigurationError:
+        return None
+    except Exception as err:
+        return err
+
+
+def dispatch_cached(case):
+    cache = DispatchCache()
+    for load in case["loads"]:
+        distribute(lambda payload: load_calculations.load_distributor(payload, cache=cache), dict(case, load=load))
+    return [distribute(lambda payload: load_calculations.load_distributor(payload, cache=cache), dict(case, load=load))
+            for load in case["loads"]]
+
+
+def dispatch_batch(case):
+    return [slot.get("powerplants") for slot in load_calculations.load_distributor_batch(case)]
+
+
+def dispatch_curve(case):
+    """Costs only, the curve giving no dispatch"""
+    return [evaluated_load.get("cost") for evaluated_load in
+            supply_curve.supply_curve_calculator(case, cache=None)["loads"]]
+
+
+def dispatch_registered(case):
+    registered_fleet = RegisteredFleet("oracle", case["powerplants"])
+    return [distribute(lambda payload: load_calculations.registered_fleet_load_distributor(
+        registered_fleet, payload, cache=None), dict(case, load=load)) for load in case["loads"]]
+
+
+def dispatch_fast_validation(case):
+    responses = []
+    for load in case["loads"]:
+        input_args, registered_fleet = fast_load_validator.validate(
+            {"load": load, "fuels": case["fuels"], "powerplants": case["powerplants"]})
+        responses.append(distribute(lambda payload: load_calculations.registered_fleet_load_distributor(
+            registered_fleet, payload, cache=None), input_args))
+    return responses
+
+
+def dispatch_shuffled(case):
+    """Same power plants in another order, which must not change the cost"""
+    power_plants = list(case["powerplants"])
+    random.Random(len(power_plants)).shuffle(power_plants)
+    return dispatch_with_engine("dp")(dict(case, powerplants=power_plants))
+
+
+def dispatch_redispatch(case):
+    """
+    Each load re-dispatched from the cost tables of the thermal power plants, built for the largest load with another
+    wind
+    """
+    registered_fleet = RegisteredFleet("oracle", case["powerplants"])
+    cache = DispatchCache()
+    distribute(lambda payload: incremental_dispatch.incremental_load_distributor(registered_fleet, payload, cache=cache),
+               {"load": max(case["loads"]), "fuels": dict(case["fuels"], **{"wind(%)": 50})})
+    responses = []
+    for load in case["loads"]:
+        response = distribute(lambda payload: incremental_dispatch.incremental_load_distributor(
+            registered_fleet, payload, cache=cache), {"load": load, "fuels": case["fuels"]})
+        responses.append(response["powerplants"] if isinstance(response, dict) else response)
+    return responses
+
+
+def dispatch_schedule(case):
+    """Each load scheduled as a slot alone, without start-up costs, minimum times nor ramps"""
+    return [distribute(lambda payload: scheduling.schedule_calculator(payload)["slots"][0]["powerplants"],
+                       dict(case, loads=[load])) for load in case["loads"]]
+
+
+def dispatch_schedule_with_ramps(case):
+    """
+    The loads scheduled as the slots of one profile, the gas-fired power plants having ramps and minimum up and down
+    times. When the other power plants can deliver every load alone, the profile can be scheduled by leaving the
+    gas-fired ones off: the schedule must then be found. Its dispatches must follow the ramps, else they are errors
+    """
+    power_plants = [dict(power_plant, ramp_rate=max(power_plant["pmax"] / 4, power_plant["pmin"] / 2),
+                         min_up_time=3, min_down_time=2) if power_plant["type"] == "gasfired" else power_plant
+                    for power_plant in case["powerplants"]]
+    try:
+        slots = scheduling.schedule_calculator(dict(case, powerplants=power_plants))["slots"]
+    except PowerPlantConfigurationError as err:
+        others = Fleet.from_raw_data([power_plant for power_plant in power_plants if "ramp_rate" not in power_plant])
+        others.set_fuels(case["fuels"])
+        if all(exhaustive_dispatch(others, load) is not None for load in case["loads"]):
+            return [PowerPlantConfigurationError(f"Feasible profile not scheduled: {err}")] * len(case["loads"])
+        return [None] * len(case["loads"])
+    responses, previous_loads = [], {power_plant["name"]: 0 for power_plant in power_plants}
+    for slot in slots:
+        loads = {power_plant["name"]: power_plant["p"] for power_plant in slot["powerplants"]}
+        # Started up to max(pmin, ramp rate), and stopped from any load
+        ramp_violations = [power_plant["name"] for power_plant in power_plants if "ramp_rate" in power_plant and
+                           loads[power_plant["name"]] > 0 and
+                           abs(loads[power_plant["name"]] - previous_loads[power_plant["name"]]) >
+                           max(power_plant["ramp_rate"], power_plant["pmin"] if not previous_loads[power_plant["name"]]
+                               else 0) + LOAD_TOLERANCE]
+        responses.append(ValueError(f"Ramps exceeded by {ramp_violations}") if ramp_violations
+                         else slot["powerplants"])
+        previous_loads = loads
+    return responses
+
+
+# Dispatch modes compared with the oracle: function of a case returning, for each of its loads, the powerplants of
+# the response (or only the cost), None when the load can not be distributed and the exception when it failed
+DISPATCH_MODES = {"dp": dispatch_with_engine("dp"), "bnb": dispatch_with_engine("bnb"),
+                  "legacy": dispatch_with_engine("legacy"), "dp/cached": dispatch_cached, "dp/batch": dispatch_batch,
+                  "dp/curve": dispatch_curve, "dp/registered": dispatch_registered,
+                  "dp/fast_validation": dispatch_fast_validation, "dp/shuffled": dispatch_shuffled,
+                  "dp/redispatch": dispatch_redispatch, "schedule": dispatch_schedule,
+                  "schedule/ramps": dispatch_schedule_with_ramps}
+
+
+def check_case(case, modes=None):
+    """
+    Dispatches the loads of the case in every mode and compares them with the oracle
+    :param modes: names of the DISPATCH_MODES checked, all of them if None
+    :return: tuple of the list of discrepancies, each a dict of the mode, the load and what differs, and the dict
+    of the duration in seconds of each mode
+    """
+    fleet = Fleet.from_raw_data(case["powerplants"])
+    fleet.set_fuels(case["fuels"])
+    expected = [exhaustive_dispatch(fleet, load) for load in case["loads"]]
+    discrepancies, durations = [], {}
+    for mode in modes or DISPATCH_MODES:
+        start = time.perf_counter()
+        try:
+            responses = DISPATCH_MODES[mode](case)
+        except Exception as err:
+            discrepancies.append({"mode": mode, "error": f"{type(err).__name__}: {err}"})
+            continue
+        finally:
+            durations[mode] = time.perf_counter() - start
+        if durations[mode] > TIME_BUDGET:
+            discrepancies.append({"mode": mode, "duration": durations[mode], "budget": TIME_BUDGET})
+        for load, oracle, response in zip(case["loads"], expected, responses):
+            discrepancy = compare_with_oracle(fleet, load, oracle, response, mode in HEURISTIC_MODES)
+            if discrepancy is not None:
+                discrepancies.append(dict(discrepancy, mode=mode, load=load))
+    return discrepancies, durations
+
+
+def compare_with_oracle(fleet, load, oracle, response, heuristic=False):
+    """
+    :param oracle: return value of exhaustive_dispatch
+    :param response: powerplants of the response, or its cost, None if the load could not be distributed, the
+    exception if it failed
+    :param heuristic: whether the response may be more expensive than the oracle, or missing
+    :return: dict describing the discrepancy, None if there is none
+    """
+    if isinstance(response, Exception):
+        return {"error": f"{type(response).__name__}: {response}"}
+    if response is None:
+        if oracle is not None and not heuristic:
+            return {"expected_cost": oracle[0], "cost": None}
+        return None
+    if isinstance(response, list):
+        loads = np.zeros(len(fleet))
+        for power_plant in response:
+            loads[fleet.index_of(power_plant["name"])] = power_plant["p"]
+        on = loads > 0
+        if abs(loads.sum() - load) > LOAD_TOLERANCE or \
+                (on & ((loads < fleet.effective_pmin - LOAD_TOLERANCE) |
+                       (loads > fleet.effective_pmax + LOAD_TOLERANCE))).any():
+            return {"invalid_dispatch": response}
+        cost = float(loads @ fleet.cost_per_mwh)
+    else:
+        cost = response
+    if oracle is None:
+        return {"expected_cost": None, "cost": cost}
+    tolerance = COST_TOLERANCE * (1 + abs(oracle[0]))
+    if cost < oracle[0] - tolerance or (not heuristic and cost > oracle[0] + tolerance):
+        return {"expected_cost": oracle[0], "cost": cost}
+    return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compares the dispatch modes with an exhaustive solver on "
+                                                 "generated small fleets")
+    parser.add_argument("--cases", type=int, default=200, help="number of generated cases")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the first case, the next ones following")
+    parser.add_argument("--max-size", type=int, default=8, help=f"largest fleet, at most {MAX_SIZE}")
+    parser.add_argument("--modes", nargs="*", choices=sorted(DISPATCH_MODES), help="modes compared, all by default")
+    args = parser.parse_args(argv)
+    # The impossible loads are expected, their warnings would drown the discrepancies
+    logging.getLogger("service").setLevel(logging.ERROR)
+
+    failures = 0
+    for seed in range(args.seed, args.seed + args.cases):
+        case = generate_case(seed, args.max_size)
+        discrepancies, _ = check_case(case, args.modes)
+        if discrepancies:
+            failures += 1
+            print(json.dumps({"seed": seed, "case": case, "discrepancies": discrepancies}))
+    print(f"{failures} of {args.cases} cases with discrepancies", file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,212 @@
+import sys
+import json
+import time
+import platform
+import argparse
+import tracemalloc
+from collections import Counter
+import numpy as np
+from app.main import create_app
+from app.main.controller.fast_validation import fast_load_validator
+from app.main.controller.input_validation import PowerPlantLoadSchema
+from app.main.service import load_calculations, wind_scenarios, metrics
+from app.main.service.dispatch_cache import DispatchCache
+from app.main.service.solver_pool import SolverTimeoutError
+from app.benchmarks.fleet_generator import generate_power_plants, generate_fuels, transition_loads, \
+    capacity_loads
+
+# Fleet sizes benchmarked for each engine. The legacy transition search grows exponentially with the fleet
+ENGINE_SIZES = {"dp": (10, 50, 200, 500), "bnb": (10, 50, 200, 500), "legacy": (10,)}
+# Shares of the capacity between which the loads of the high capacity sweeps are drawn
+HIGH_LOADS = (0.75, 0.95)
+# Percentiles of the durations kept in the report
+PERCENTILES = (50, 90, 99)
+
+
+def time_calls(function, arguments):
+    """
+    Calls the function once per argument and measures each call
+    :return: list of durations in seconds
+    """
+    durations = []
+    for argument in arguments:
+        start = time.perf_counter()
+        function(argument)
+        durations.append(time.perf_counter() - start)
+    return durations
+
+
+def peak_memory(function, argument):
+    """Peak of the memory allocated by Python during one call of the function, in bytes"""
+    tracemalloc.start()
+    try:
+        function(argument)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def summarize(durations, memory_peak, failures=None):
+    """
+    Statistics of a benchmark as stored in the report, durations in milliseconds
+    :param failures: Counter of the messages of the calls that failed
+    """
+    durations_ms = np.array(durations) * 1000
+    summary = {"calls": len(durations), "mean_ms": float(durations_ms.mean()), "max_ms": float(durations_ms.max())}
+    for percentile in PERCENTILES:
+        summary[f"p{percentile}_ms"] = float(np.percentile(durations_ms, percentile))
+    summary["memory_peak_bytes"] = memory_peak
+    failures = failures or Counter()
+    summary["failures"] = sum(failures.values())
+    summary["errors"] = dict(failures)
+    return summary
+
+
+def recording_failures(function, failures):
+    """
+    Wraps the function so that its ValueErrors and SolverTimeoutErrors are counted in failures by type and message
+    instead of raised, e.g. the PowerPlantConfigurationError of a load the power plants can not supply or the search
+    that found no dispatch within its limits
+    :param failures: Counter updated by the calls of the wrapped function
+    """
+    def call(argument):
+        try:
+            return function(argument)
+        except (ValueError, SolverTimeoutError) as err:
+            failures[f"{type(err).__name__}: {err}"] += 1
+    return call
+
+
+def distribute(payload, engine="dp", cache=None):
+    """load_distributor of the payload, without the cache of the app unless one is given"""
+    return load_calculations.load_distributor(payload, engine=engine, cache=cache)
+
+
+def benchmark(function, payloads):
+    """
+    Times the function on every payload, after a first call to warm up, and measures its memory on the first. The
+    calls raising a ValueError or a SolverTimeoutError are timed too, and counted in the failures of the summary,
+    along with the calls of each solver engine and the searches stopped at their limits
+    """
+    failures = Counter()
+    untimed = recording_failures(function, Counter())
+    untimed(payloads[0])
+    previous = metrics.RequestProfile.start()
+    try:
+        durations = time_calls(recording_failures(function, failures), payloads)
+    finally:
+        profile = metrics.RequestProfile.stop(previous)
+    summary = summarize(durations, peak_memory(untimed, payloads[0]), failures)
+    # The requests of the app profile themselves, in place of the profile of the benchmark
+    summary["solver_calls"] = {} if profile is None else dict(profile.solver_calls)
+    summary["incomplete_searches"] = 0 if profile is None else profile.incomplete_searches
+    return summary
+
+
+def load_sweep(size, loads_per_fleet, seed, decimals=0):
+    """Payloads of a seeded fleet with limits of that many decimals, with loads around its pmin transitions"""
+    power_plants = generate_power_plants(size, seed, decimals=decimals)
+    fuels = generate_fuels(seed)
+    return [{"load": load, "fuels": fuels, "powerplants": power_plants}
+            for load in transition_loads(power_plants, fuels, loads_per_fleet, seed)]
+
+
+def capacity_sweep(size, loads_per_fleet, seed, decimals=0, low=0.4, high=0.6):
+    """Payloads of a seeded fleet with limits of that many decimals, with loads between two shares of its capacity"""
+    power_plants = generate_power_plants(size, seed, decimals=decimals)
+    fuels = generate_fuels(seed)
+    return [{"load": load, "fuels": fuels, "powerplants": power_plants}
+            for load in capacity_loads(power_plants, fuels, loads_per_fleet, low, high, seed)]
+
+
+def run_benchmarks(loads_per_fleet=20, seed=0):
+    """
+    Runs the benchmarks of the solver engines, of the validation schema and its fast mode, and of the HTTP route
+    :param loads_per_fleet: number of loads swept for every fleet
+    :param seed: seed of the generated fleets and loads
+    :return: dict of the summary of each benchmark, keyed by name
+    """
+    results = {}
+    for engine, sizes in ENGINE_SIZES.items():
+        for size in sizes:
+            # Whole MWs then hundredths of MW, the finest grid of the dp engine, at pmin transitions and at mid and
+            # high capacity, where that grid is the largest
+            sweeps = {"": load_sweep(size, loads_per_fleet, seed),
+                      "/fractional": load_sweep(size, loads_per_fleet, seed, decimals=2),
+                      "/mid": capacity_sweep(size, loads_per_fleet, seed, decimals=2),
+                      "/high": capacity_sweep(size, loads_per_fleet, seed, 2, *HIGH_LOADS)}
+            for suffix, payloads in sweeps.items():
+                summary = benchmark(lambda payload: distribute(payload, engine), payloads)
+                # Past its cells budget, the dp engine distributes the loads by branch and bound
+                label = "dp+bnb" if engine == "dp" and "bnb" in summary["solver_calls"] else engine
+                results[f"load_distributor/{label}/{size}{suffix}"] = summary
+
+    payloads = load_sweep(50, loads_per_fleet, seed)
+    cache = DispatchCache()
+    results["load_distributor/cached/50"] = benchmark(lambda payload: distribute(payload, cache=cache), payloads)
+    schema = PowerPlantLoadSchema()
+    for size in (10, 200):
+        results[f"validation/{size}"] = benchmark(schema.load, load_sweep(size, loads_per_fleet, seed))
+        results[f"validation/fast/{size}"] = benchmark(fast_load_validator.validate,
+                                                       load_sweep(size, loads_per_fleet, seed))
+
+    # Wind scenarios of a fleet of a realistic size, a few loads of 100 scenarios each, dispatched in this process
+    scenarios = {"count": 100, "seed": seed, "wind_std": 20, "correlation": 0.5}
+    results["wind_scenarios/200"] = benchmark(
+        lambda payload: wind_scenarios.wind_scenario_evaluator(dict(payload, scenarios=scenarios), processes=0),
+        load_sweep(200, 3, seed))
+
+    client = create_app("test").test_client()
+    for size in (10, 200):
+        results[f"http/powerplant/{size}"] = benchmark(
+            lambda payload: client.post("/powerplant/", json=payload), load_sweep(size, loads_per_fleet, seed))
+    return results
+
+
+def compare(report, baseline, threshold=0.2, metric="p50_ms"):
+    """
+    Compares the benchmarks of the report with the ones of the baseline
+    :param threshold: relative increase of the metric above which a benchmark has regressed
+    :return: list of (name, baseline value, value) of the benchmarks that regressed
+    """
+    regressions = []
+    for name, summary in report["benchmarks"].items():
+        baseline_summary = baseline["benchmarks"].get(name)
+        if baseline_summary is not None and summary[metric] > baseline_summary[metric] * (1 + threshold):
+            regressions.append((name, baseline_summary[metric], summary[metric]))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks the load distribution on generated fleets")
+    parser.add_argument("--output", help="file to write the JSON report to, else it is printed")
+    parser.add_argument("--baseline", help="JSON report to compare with")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="relative increase of the median above which a benchmark has regressed")
+    parser.add_argument("--loads", type=int, default=20, help="number of loads swept for every fleet")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    report = {"metadata": {"python": platform.python_version(), "numpy": np.__version__,
+                           "platform": platform.platform(), "seed": args.seed, "loads": args.loads,
+                           "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S")},
+              "benchmarks": run_benchmarks(args.loads, args.seed)}
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump(report, fp, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    for name, summary in report["benchmarks"].items():
+        if summary.get("failures"):
+            print(f"{name}: {summary['failures']} of {summary['calls']} calls failed", file=sys.stderr)
+    if args.baseline:
+        with open(args.baseline, "r") as fp:
+            regressions = compare(report, json.load(fp), args.threshold)
+        for name, baseline_value, value in regressions:
+            print(f"{name} regressed: median of {value:.3f} ms against {baseline_value:.3f} ms", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
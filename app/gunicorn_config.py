@@ -0,0 +1,26 @@
+# Settings of gunicorn serving app.wsgi:app, taken from the production config
+import os
+from app.main.config import ProductionConfig
+from app.main.service.metrics import registry
+
+bind = f"{ProductionConfig.HOST}:{ProductionConfig.PORT}"
+workers = ProductionConfig.WORKERS
+threads = ProductionConfig.THREADS
+worker_class = "gthread"
+timeout = ProductionConfig.TIMEOUT
+# The app is imported in the master process and shared copy-on-write by the forked workers
+preload_app = True
+accesslog = "-"
+
+
+def on_starting(server):
+    """Starts the metrics summed over the workers from 0, dropping the files of a previous run"""
+    if ProductionConfig.METRICS_DIR is not None:
+        os.makedirs(ProductionConfig.METRICS_DIR, exist_ok=True)
+        registry.directory = ProductionConfig.METRICS_DIR
+        registry.clear_directory()
+
+
+def worker_exit(server, worker):
+    """Writes the metrics of the worker that is exiting, whose last write may still be deferred"""
+    registry.write(force=True)
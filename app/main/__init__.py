@@ -1,15 +1,43 @@
 import sys
 import logging
-from flask import Flask
+import werkzeug
+# https://github.com/noirbizarre/flask-restplus/issues/777
+werkzeug.cached_property = werkzeug.utils.cached_property
+from flask import Flask, Blueprint
+from flask_restplus import Api
 from app.main.config import config_by_name
 
 
 def create_app(config_name):
+    """
+    Builds the app with the config of that name and registers the API on it. Nothing is started or pushed, so that
+    the app can be served by the development server as well as by a WSGI server
+    :param config_name: development, test or production
+    :return: Flask app
+    """
+    from app.main.controller.production_plan_controller import powerplant_namespace
+    from app.main.controller.fleet_controller import fleet_namespace
+    from app.main.controller.metrics_controller import register_instrumentation
+    from app.main.service.solver_pool import SolverPool
+    from app.main.service.fleet_registry import FleetRegistry
     handler = logging.StreamHandler(sys.stdout)
     handler.setFormatter(logging.Formatter(
         '%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
     app = Flask(__name__)
     app.config.from_object(config_by_name[config_name])
     app.logger.addHandler(handler)
-    app.logger.setLevel(logging.DEBUG)
+    app.logger.setLevel(logging.DEBUG if app.config["DEBUG"] else logging.INFO)
+    app.extensions["solver_pool"] = SolverPool.from_config(app.config)
+    app.extensions["fleet_registry"] = FleetRegistry.from_config(app.config)
+
+    blueprint = Blueprint('api', __name__)
+    api = Api(blueprint,
+              title='Web App to return power plant loads',
+              version='1.0',
+              description='Power Plant Load'
+              )
+    api.add_namespace(powerplant_namespace)
+    api.add_namespace(fleet_namespace)
+    app.register_blueprint(blueprint)
+    register_instrumentation(app)
     return app
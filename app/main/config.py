@@ -1,10 +1,41 @@
-import logging
-
-logger = logging.getLogger(__name__)
+import os
+import tempfile
+import multiprocessing
 
 
 class Config:
-    DEBUG = True
+    DEBUG = False
+    TESTING = False
+    HOST = "0.0.0.0"
+    PORT = int(os.getenv("PORT", 5001))
+    # Worker processes of the SolverPool (0 to solve in the thread of the request), solves queued or running at
+    # once before new ones are rejected, and time budget of a solve in seconds
+    SOLVER_WORKERS = int(os.getenv("SOLVER_WORKERS", 1))
+    SOLVER_MAX_PENDING = int(os.getenv("SOLVER_MAX_PENDING", 4))
+    SOLVER_TIMEOUT = float(os.getenv("SOLVER_TIMEOUT", 10))
+    # Time budget in seconds of the branch and bound searches of a solve, shared by its searches, past which each returns
+    # the cheapest dispatch found so far with its optimality gap. Below the SOLVER_TIMEOUT, so that a long search still
+    # gets a response instead of a 504
+    SEARCH_TIME_LIMIT = float(os.getenv("SEARCH_TIME_LIMIT", SOLVER_TIMEOUT / 2))
+    # Largest number of power plants times loads of the grid of the dp engine, past which it distributes the loads by
+    # branch and bound, and the supply curve is rejected. A million cells take about 20 ms and 0.4 MB of choices
+    DP_MAX_CELLS = int(os.getenv("DP_MAX_CELLS", 20000000))
+    # Worker processes dispatching the wind scenarios of a request, kept by the process of the solve, 0 to dispatch
+    # them in that process
+    SCENARIO_WORKERS = int(os.getenv("SCENARIO_WORKERS", multiprocessing.cpu_count()))
+    # JSON file the registered fleets are written to and read from at start-up, None to keep them in memory only.
+    # Without it, each worker process of the WSGI server has its own fleets
+    FLEET_SNAPSHOT_PATH = os.getenv("FLEET_SNAPSHOT_PATH")
+    # Validation of the requests of POST /powerplant/: "schema" by the marshmallow schema, "fast" column-wise by the
+    # FastLoadValidator, falling back to the schema for the bodies it can not prove valid
+    VALIDATION_MODE = os.getenv("VALIDATION_MODE", "schema")
+    # DISPATCH_CACHE=off solves every request, e.g. to measure the server without the cache of the dispatches
+    DISPATCH_CACHE = os.getenv("DISPATCH_CACHE", "on") != "off"
+    # Directory the worker processes of the WSGI server write their metrics to, so that GET /metrics serves them
+    # summed over all of them. None to serve the metrics of the process answering the scrape only
+    METRICS_DIR = os.getenv("METRICS_DIR")
+    # No suggestion of other routes in the 404 of flask_restplus, e.g. for an unknown fleet
+    ERROR_404_HELP = False
 
 
 class DevelopmentConfig(Config):
@@ -12,11 +43,25 @@ class DevelopmentConfig(Config):
 
 
 class TestingConfig(Config):
-    logger.error("The Testing Env has not been implemented")
+    TESTING = True
+    SOLVER_WORKERS = 0
+    SCENARIO_WORKERS = 0
+    FLEET_SNAPSHOT_PATH = None
+    METRICS_DIR = None
 
 
 class ProductionConfig(Config):
-    logger.error("The Production Env has not been implemented")
+    # Pre-forked worker processes, each serving requests with a pool of threads
+    WORKERS = int(os.getenv("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+    THREADS = int(os.getenv("WORKER_THREADS", 2))
+    # Each process of the solver pools of the WORKERS keeps its own processes for the scenarios: the CPUs are shared
+    # between them
+    SCENARIO_WORKERS = int(os.getenv("SCENARIO_WORKERS", max(multiprocessing.cpu_count() //
+                                                             (WORKERS * max(Config.SOLVER_WORKERS, 1)), 1)))
+    TIMEOUT = int(os.getenv("WORKER_TIMEOUT", 60))
+    METRICS_DIR = os.getenv("METRICS_DIR", os.path.join(tempfile.gettempdir(), "powerplant_metrics"))
+    FLEET_SNAPSHOT_PATH = os.getenv("FLEET_SNAPSHOT_PATH",
+                                    os.path.join(tempfile.gettempdir(), "powerplant_fleets.json"))
 
 
 config_by_name = dict(
@@ -0,0 +1,156 @@
+import json
+import math
+import numpy as np
+from webargs import fields
+from marshmallow import ValidationError
+from app.main.controller.input_validation import PowerPlantLoadSchema
+from app.main.model.fleet import Fleet
+from app.main.service.fleet_registry import RegisteredFleet
+try:
+    # Faster JSON parser, used when it is installed
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+# Types of the JSON values accepted without conversion by each kind of field. bool is left out, not being a number
+FIELD_TYPES = ((fields.Int, (int,)), (fields.Float, (int, float)), (fields.Str, (str,)))
+
+
+class FastLoadValidator:
+    """
+    Validation of the payloads of the PowerPlantLoadSchema, compiled once from the fields of the schema. The
+    powerplants are checked column-wise: one type check per column, then the validators of each field applied to the
+    array of the whole column at once, which the comparisons of the validators of the schema allow.
+    It only tells whether a payload is valid: an invalid one, or one it can not prove valid (e.g. a number sent as a
+    string), is left to the schema, which gives the messages of the 422 response
+    """
+    def __init__(self, schema_class=PowerPlantLoadSchema):
+        schema = schema_class()
+        self.allowed = set(schema.fields)
+        self.required = {name for name, field in schema.fields.items() if field.required}
+        self.load_validators = schema.fields["load"].validators
+        self.fuels_validators = schema.fields["fuels"].validators
+        self.fuel_name_validators = schema.fields["fuels"].key_field.validators
+        self.power_plants_validators = schema.fields["powerplants"].validators
+        power_plant_fields = schema.fields["powerplants"].inner.schema.fields
+        self.power_plant_allowed = set(power_plant_fields)
+        self.power_plant_required = {name for name, field in power_plant_fields.items() if field.required}
+        self.columns = [(name, self.field_types(field), field.validators)
+                        for name, field in power_plant_fields.items()]
+
+    @staticmethod
+    def field_types(field):
+        for field_class, types in FIELD_TYPES:
+            if isinstance(field, field_class):
+                return types
+        raise ValueError(f"No fast validation of the field {field}")
+
+    def validate(self, payload):
+        """
+        :param payload: decoded JSON body
+        :return: tuple of the input args, the same as the schema would give but for the powerplants left as they are,
+        and the RegisteredFleet of the powerplants. None if the payload could not be proven valid
+        """
+        if type(payload) is not dict or not payload.keys() <= self.allowed or not self.required <= payload.keys():
+            return None
+        input_args = {}
+        if "load" in payload:
+            load = payload["load"]
+            if not is_finite_number(load) or not self.passes(self.load_validators, load):
+                return None
+            input_args["load"] = float(load)
+        fuels = payload["fuels"]
+        if type(fuels) is not dict or not self.passes(self.fuels_validators, fuels):
+            return None
+        for fuel_name, value in fuels.items():
+            if not is_finite_number(value) or not self.passes(self.fuel_name_validators, fuel_name):
+                return None
+        input_args["fuels"] = {fuel_name: float(value) for fuel_name, value in fuels.items()}
+        power_plants = payload["powerplants"]
+        if type(power_plants) is not list or not self.passes(self.power_plants_validators, power_plants):
+            return None
+        registered_fleet = self.build_fleet(power_plants)
+        if registered_fleet is None:
+            return None
+        input_args["powerplants"] = power_plants
+        return input_args, registered_fleet
+
+    def build_fleet(self, power_plants):
+        """RegisteredFleet, without ID, of the power plant dicts, None if they could not be proven valid"""
+        for power_plant in power_plants:
+            if type(power_plant) is not dict or not power_plant.keys() <= self.power_plant_allowed or \
+                    not self.power_plant_required <= power_plant.keys():
+                return None
+        columns = {}
+        for name, types, validators in self.columns:
+            values = [power_plant[name] for power_plant in power_plants if name in power_plant]
+            if not all(type(value) in types for value in values):
+                return None
+            if str in types:
+                column = values
+                if not all(self.passes(validators, value) for value in values):
+                    return None
+            else:
+                try:
+                    column = np.array(values, dtype=np.float64 if float in types else np.int64)
+                except OverflowError:
+                    return None
+                if not np.isfinite(column).all() or not self.passes_column(validators, column):
+                    return None
+            if len(values) < len(power_plants):
+                # Optional column: the Fleet takes its default where it is missing
+                values = iter(column)
+                column = [next(values) if name in power_plant else None for power_plant in power_plants]
+            columns[name] = column
+        fleet = Fleet(columns.pop("name"), [Fleet.type_codes_by_name[type_name] for type_name in columns["type"]],
+                      columns["efficiency"], columns["pmin"], columns["pmax"],
+                      **{name: columns.get(name) for name in Fleet.scheduling_defaults})
+        canonical_power_plants = tuple(zip(fleet.names, columns["type"], fleet.efficiency.tolist(),
+                                           fleet.pmin.tolist(), fleet.pmax.tolist()))
+        return RegisteredFleet(None, power_plants, fleet, canonical_power_plants)
+
+    @staticmethod
+    def passes(validators, value):
+        """Whether the value passes the validators, as marshmallow runs them"""
+        try:
+            return all(validator(value) is not False for validator in validators)
+        except ValidationError:
+            return False
+
+    def passes_column(self, validators, column):
+        """Whether all the values of the column pass the validators, applied to the whole array when they allow it"""
+        for validator in validators:
+            try:
+                result = validator(column)
+            except (ValidationError, ValueError, TypeError):
+                result = None
+            if isinstance(result, np.ndarray) and result.shape == column.shape:
+                if not result.all():
+                    return False
+            elif not all(self.passes([validator], value) for value in column.tolist()):
+                return False
+        return True
+
+
+def is_finite_number(value):
+    """Whether the JSON value is a number that a Float field takes as it is"""
+    try:
+        return type(value) in (int, float) and math.isfinite(value)
+    except OverflowError:
+        return False
+
+
+fast_load_validator = FastLoadValidator()
+
+
+def parse_load_body(body):
+    """
+    Decodes and validates the JSON body of a request of the PowerPlantLoadSchema
+    :return: same as FastLoadValidator.validate, None if the body is not valid JSON or could not be proven valid
+    """
+    try:
+        payload = json_loads(body)
+    except ValueError:
+        return None
+    return fast_load_validator.validate(payload)
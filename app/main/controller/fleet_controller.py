@@ -0,0 +1,71 @@
+import logging
+from app.main.model.power_plant import PowerPlantConfigurationError
+from app.main.service import load_calculations, incremental_dispatch
+from app.main.service.fleet_registry import UnknownFleetError, FleetNotInWorkerError, dispatch_in_worker
+from flask import current_app
+from flask_restplus import Resource, Namespace
+from app.main.controller.input_validation import FleetSchema, FleetDispatchSchema
+from app.main.controller.production_plan_controller import solve, use_args
+from webargs.flaskparser import abort
+
+fleet_namespace = Namespace('fleets', description='Power plants registered once and dispatched by fleet ID')
+log = logging.getLogger('controller')
+
+
+def get_registered_fleet(fleet_id):
+    try:
+        return current_app.extensions["fleet_registry"].get(fleet_id)
+    except UnknownFleetError:
+        log.warning(f"Unknown fleet {fleet_id} requested")
+        abort(404, custom=f"No fleet is registered under {fleet_id}")
+
+
+def solve_on_registered_fleet(function, registered_fleet, input_args):
+    """
+    Same as solve, sending the solver pool the ID and version of the fleet instead of the fleet. The power plants are
+    sent again only to a process that does not hold that version of the fleet yet
+    """
+    try:
+        return solve(dispatch_in_worker, function, registered_fleet.fleet_id, registered_fleet.version, input_args)
+    except FleetNotInWorkerError:
+        return solve(dispatch_in_worker, function, registered_fleet.fleet_id, registered_fleet.version, input_args,
+                     registered_fleet.power_plants)
+
+
+@fleet_namespace.route("/<string:fleet_id>")
+class FleetResource(Resource):
+    @use_args(FleetSchema, location="json")
+    def put(self, input_args, fleet_id):
+        registered_fleet = current_app.extensions["fleet_registry"].register(fleet_id, input_args["powerplants"])
+        return {"id": fleet_id, "powerplants": len(registered_fleet.power_plants)}
+
+    def get(self, fleet_id):
+        return get_registered_fleet(fleet_id).convert_as_response()
+
+
+@fleet_namespace.route("/<string:fleet_id>/dispatch")
+class FleetDispatchResource(Resource):
+    @use_args(FleetDispatchSchema, location="json")
+    def post(self, input_args, fleet_id):
+        registered_fleet = get_registered_fleet(fleet_id)
+        try:
+            return solve_on_registered_fleet(load_calculations.registered_fleet_load_distributor, registered_fleet,
+                                             input_args)
+        except PowerPlantConfigurationError:
+            log.warning(f"Impossible load requested from fleet {fleet_id}")
+            abort(400, custom=f"Load {input_args.get('load')} cannot be distributed with the power plants of fleet "
+                              f"{fleet_id}")
+
+
+@fleet_namespace.route("/<string:fleet_id>/redispatch")
+class FleetRedispatchResource(Resource):
+    @use_args(FleetDispatchSchema, location="json")
+    def post(self, input_args, fleet_id):
+        registered_fleet = get_registered_fleet(fleet_id)
+        try:
+            return solve_on_registered_fleet(incremental_dispatch.incremental_load_distributor, registered_fleet,
+                                             input_args)
+        except PowerPlantConfigurationError:
+            log.warning(f"Impossible load requested from fleet {fleet_id}")
+            abort(400, custom=f"Load {input_args.get('load')} cannot be distributed with the power plants of fleet "
+                              f"{fleet_id}")
@@ -1,5 +1,7 @@
 from webargs import fields
-from marshmallow import Schema, validate
+from marshmallow import Schema, validate, validates_schema, ValidationError
+
+FUEL_NAMES = ["gas(euro/MWh)", "kerosine(euro/MWh)", "co2(euro/ton)", "wind(%)"]
 
 
 class PowerPlantSchema(Schema):
@@ -8,16 +10,89 @@ class PowerPlantSchema(Schema):
     efficiency = fields.Float(required=True, validate=lambda eff: eff <= 1)
     pmin = fields.Float(required=True, validate=lambda pmin: pmin >= 0)
     pmax = fields.Float(required=True)
+    # Only used by the multi-period scheduling: cost in euros of a start, minimum number of slots on once started
+    # and off once stopped, and maximum change of load in MW from one slot to the next
+    startup_cost = fields.Float(validate=lambda startup_cost: startup_cost >= 0)
+    min_up_time = fields.Int(validate=lambda min_up_time: min_up_time >= 0)
+    min_down_time = fields.Int(validate=lambda min_down_time: min_down_time >= 0)
+    ramp_rate = fields.Float(validate=lambda ramp_rate: ramp_rate > 0)
 
 
 class PowerPlantLoadSchema(Schema):
     load = fields.Float(validate= lambda load: load >= 0)
     fuels = fields.Dict(
-        fields.String(validate=lambda fuel_name: fuel_name in ["gas(euro/MWh)", "kerosine(euro/MWh)",
-                                                               "co2(euro/ton)", "wind(%)"]),
+        fields.String(validate=lambda fuel_name: fuel_name in FUEL_NAMES),
+        fields.Float(),
+        required=True, validate=validate.Length(min=1))
+    powerplants = fields.List(fields.Nested(PowerPlantSchema), required=True, validate=validate.Length(min=1))
+
+
+class PowerPlantBatchSchema(Schema):
+    loads = fields.List(fields.Float(validate=lambda load: load >= 0), required=True, validate=validate.Length(min=1))
+    fuels = fields.Dict(
+        fields.String(validate=lambda fuel_name: fuel_name in FUEL_NAMES),
+        fields.Float(),
+        required=True, validate=validate.Length(min=1))
+    fuels_per_slot = fields.List(fields.Dict(
+        fields.String(validate=lambda fuel_name: fuel_name in FUEL_NAMES),
+        fields.Float()))
+    powerplants = fields.List(fields.Nested(PowerPlantSchema), required=True, validate=validate.Length(min=1))
+
+    @validates_schema
+    def validate_fuels_per_slot(self, data, **kwargs):
+        if "fuels_per_slot" in data and len(data["fuels_per_slot"]) != len(data["loads"]):
+            raise ValidationError("There must be one fuels dict per load", "fuels_per_slot")
+
+
+class PowerPlantScheduleSchema(PowerPlantBatchSchema):
+    """Same as the batch, the loads being the slots of one profile scheduled together"""
+
+
+class WindScenariosSchema(Schema):
+    count = fields.Int(validate=validate.Range(min=1, max=100000))
+    seed = fields.Int()
+    wind_mean = fields.Float(validate=validate.Range(min=0, max=100))
+    wind_std = fields.Float(validate=lambda wind_std: wind_std >= 0)
+    correlation = fields.Float(validate=validate.Range(min=0, max=1))
+    wind_factors = fields.List(fields.Dict(fields.String(), fields.Float(validate=validate.Range(min=0, max=100))),
+                               validate=validate.Length(min=1))
+
+
+class PowerPlantScenarioSchema(PowerPlantLoadSchema):
+    scenarios = fields.Nested(WindScenariosSchema, required=True)
+
+    @validates_schema
+    def validate_wind_factors(self, data, **kwargs):
+        wind_turbine_names = {power_plant["name"] for power_plant in data["powerplants"]
+                              if power_plant["type"] == "windturbine"}
+        unknown_names = sorted({name for wind_factors in data["scenarios"].get("wind_factors", [])
+                                for name in wind_factors} - wind_turbine_names)
+        if unknown_names:
+            raise ValidationError(f"No wind turbines named {', '.join(unknown_names)} in the powerplants", "scenarios")
+
+
+class PowerPlantCurveSchema(Schema):
+    loads = fields.List(fields.Float(validate=lambda load: load >= 0))
+    fuels = fields.Dict(
+        fields.String(validate=lambda fuel_name: fuel_name in FUEL_NAMES),
         fields.Float(),
         required=True, validate=validate.Length(min=1))
     powerplants = fields.List(fields.Nested(PowerPlantSchema), required=True, validate=validate.Length(min=1))
 
 
+class FleetSchema(Schema):
+    powerplants = fields.List(fields.Nested(PowerPlantSchema), required=True, validate=validate.Length(min=1))
+
+
+class FleetDispatchSchema(Schema):
+    load = fields.Float(validate=lambda load: load >= 0)
+    fuels = fields.Dict(
+        fields.String(validate=lambda fuel_name: fuel_name in FUEL_NAMES),
+        fields.Float(),
+        required=True, validate=validate.Length(min=1))
+
 
+class ReplayRecordSchema(FleetDispatchSchema):
+    """One record of a replay: the powerplants are those of the last record that has them, when missing"""
+    id = fields.Raw()
+    powerplants = fields.List(fields.Nested(PowerPlantSchema), validate=validate.Length(min=1))
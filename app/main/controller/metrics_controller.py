@@ -0,0 +1,84 @@
+import os
+import json
+import time
+import logging
+from flask import Response, g, request
+from app.main.service import metrics
+
+log = logging.getLogger('controller')
+# Response header of the largest optimality gap of the dispatches of a request whose searches stopped at their limits
+# before proving them optimal. Sent whether the profile was requested or not
+OPTIMALITY_GAP_HEADER = "X-Optimality-Gap"
+# Request header opting in for the profile of the request: "stages" for the timings of its stages in the
+# Server-Timing header, "cprofile" to also get the cProfile summary of its solve in the body
+PROFILE_HEADER = "X-Profile"
+PROFILE_MODES = ("stages", "cprofile")
+
+
+def register_instrumentation(app):
+    """
+    Profiles every request of the app into the metrics of the process, served in the Prometheus text format. With the
+    METRICS_DIR of the config, they are written there after every request and served summed over the processes
+    """
+    if app.config["METRICS_DIR"] is not None:
+        os.makedirs(app.config["METRICS_DIR"], exist_ok=True)
+    metrics.registry.directory = app.config["METRICS_DIR"]
+    app.before_request(start_request_profile)
+    app.after_request(end_request_profile)
+    app.teardown_request(clear_request_profile)
+    app.add_url_rule("/metrics", "metrics", render_metrics)
+
+
+def start_request_profile():
+    g.request_start = time.perf_counter()
+    g.profile_mode = request.headers.get(PROFILE_HEADER, "").lower()
+    if g.profile_mode not in PROFILE_MODES:
+        g.profile_mode = None
+    metrics.RequestProfile.start(with_cprofile=g.profile_mode == "cprofile")
+
+
+def end_request_profile(response):
+    profile = metrics.RequestProfile.stop()
+    if profile is None:
+        return response
+    duration = time.perf_counter() - g.request_start
+    route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    metrics.http_request_duration.observe(duration, route=route, method=request.method, status=response.status_code)
+    profile.observe()
+    metrics.registry.write()
+    if profile.incomplete_searches:
+        response.headers[OPTIMALITY_GAP_HEADER] = f"{profile.optimality_gap:.6g}"
+    if g.profile_mode is not None:
+        add_profile_to_response(response, profile, duration)
+    return response
+
+
+def clear_request_profile(exception=None):
+    """Drops the profile of a request that failed before its response, so that the thread does not keep it"""
+    metrics.RequestProfile.stop()
+
+
+def add_profile_to_response(response, profile, duration):
+    """
+    Adds the stage timings, in milliseconds, to the Server-Timing header and the search counters to their own headers.
+    With cProfile, a JSON body is wrapped as {"response": body, "profile": {...}}
+    """
+    timings = dict(profile.stages, total=duration)
+    response.headers["Server-Timing"] = ", ".join(f"{name};dur={seconds * 1000:.3f}"
+                                                  for name, seconds in timings.items())
+    response.headers["X-Solver-Calls"] = ", ".join(f"{engine}={calls}"
+                                                   for engine, calls in sorted(profile.solver_calls.items()))
+    response.headers["X-Search-Depth"] = ", ".join(f"{engine}={depth}"
+                                                   for engine, depth in sorted(profile.search_depth.items()))
+    if g.profile_mode == "cprofile" and response.is_json:
+        body = {"response": response.get_json(),
+                "profile": dict(profile.as_dict(), total=duration, cprofile=profile.cprofile_summary)}
+        response.set_data(json.dumps(body))
+
+
+def render_metrics():
+    """
+    Metrics of all the worker processes with a METRICS_DIR, else of the one answering the request: with several WSGI
+    workers, a scrape then sees only one of them
+    """
+    return Response(metrics.registry.render(), mimetype="text/plain; version=0.0.4")
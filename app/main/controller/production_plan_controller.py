@@ -1,25 +1,126 @@
 import logging
+import functools
 from app.main.model.power_plant import PowerPlantConfigurationError
-from app.main.service import load_calculations
+from app.main.service import load_calculations, replay, scheduling, supply_curve, wind_scenarios
+from app.main.service.solver_pool import SolverPoolBusyError, SolverTimeoutError
+from app.main.service.unit_commitment import GridTooLargeError
+from flask import Response, current_app, request, stream_with_context
 from flask_restplus import Resource, Namespace
-from app.main.controller.input_validation import PowerPlantLoadSchema
-from webargs.flaskparser import use_args, parser, abort
+from app.main.controller import fast_validation
+from app.main.controller.input_validation import PowerPlantLoadSchema, PowerPlantBatchSchema, \
+    PowerPlantCurveSchema, PowerPlantScenarioSchema, PowerPlantScheduleSchema
+from app.main.service.metrics import stage
+from webargs.flaskparser import FlaskParser, abort
 
 powerplant_namespace = Namespace('powerplant', description='Power plant loading related operations')
 log = logging.getLogger('controller')
 
 
+class TimedFlaskParser(FlaskParser):
+    """FlaskParser timing the validation of the requests as a stage of their profile"""
+    def parse(self, *args, **kwargs):
+        with stage("validation"):
+            return super().parse(*args, **kwargs)
+
+
+parser = TimedFlaskParser()
+use_args = parser.use_args
+
+
+def use_load_args(function):
+    """
+    Same as use_args(PowerPlantLoadSchema), unless the VALIDATION_MODE of the app is fast: the JSON body is then
+    validated by the fast_load_validator, which also gives the function the RegisteredFleet of the powerplants. A body
+    it can not prove valid is parsed by the schema, so that errors get the same response in both modes
+    """
+    function_with_schema = use_args(PowerPlantLoadSchema, location="json")(function)
+
+    @functools.wraps(function)
+    def wrapper(self, *args, **kwargs):
+        if current_app.config["VALIDATION_MODE"] == "fast" and request.is_json:
+            with stage("validation"):
+                validated = fast_validation.parse_load_body(request.get_data(cache=True))
+            if validated is not None:
+                input_args, registered_fleet = validated
+                return function(self, input_args, *args, registered_fleet=registered_fleet, **kwargs)
+        return function_with_schema(self, *args, **kwargs)
+    return wrapper
+
+
+def solve(function, *args):
+    """
+    Runs the function of the service in the solver pool of the app. When the pool is full or the solve exceeds its
+    time budget, the response is an error instead. It is returned, not raised, the pool having logged it already
+    """
+    try:
+        return current_app.extensions["solver_pool"].run(function, *args)
+    except SolverPoolBusyError as err:
+        return {"message": str(err)}, 503, {"Retry-After": "1"}
+    except SolverTimeoutError as err:
+        return {"message": str(err)}, 504
+
+
 @powerplant_namespace.route("/")
 class PowerPlantResource(Resource):
-    @use_args(PowerPlantLoadSchema, location="json")
-    def post(self, input_args):
+    @use_load_args
+    def post(self, input_args, registered_fleet=None):
         try:
-            return load_calculations.load_distributor(input_args)
+            if registered_fleet is not None:
+                return solve(load_calculations.registered_fleet_load_distributor, registered_fleet, input_args)
+            return solve(load_calculations.load_distributor, input_args)
         except PowerPlantConfigurationError:
             log.warning("Impossible load requested from powerplants")
             abort(400, custom=f"Load {input_args.get('load')} cannot be distributed with the current power plants")
 
 
+@powerplant_namespace.route("/batch")
+class PowerPlantBatchResource(Resource):
+    @use_args(PowerPlantBatchSchema, location="json")
+    def post(self, input_args):
+        return solve(load_calculations.load_distributor_batch, input_args)
+
+
+@powerplant_namespace.route("/curve")
+class PowerPlantCurveResource(Resource):
+    @use_args(PowerPlantCurveSchema, location="json")
+    def post(self, input_args):
+        try:
+            return solve(supply_curve.supply_curve_calculator, input_args)
+        except GridTooLargeError as err:
+            log.warning("Supply curve requested over too large a grid")
+            abort(400, custom=f"{err}, the supply curve of these power plants can not be built")
+
+
+@powerplant_namespace.route("/scenarios")
+class PowerPlantScenarioResource(Resource):
+    @use_args(PowerPlantScenarioSchema, location="json")
+    def post(self, input_args):
+        return solve(wind_scenarios.wind_scenario_evaluator, input_args, current_app.config["SCENARIO_WORKERS"])
+
+
+@powerplant_namespace.route("/schedule")
+class PowerPlantScheduleResource(Resource):
+    @use_args(PowerPlantScheduleSchema, location="json")
+    def post(self, input_args):
+        try:
+            return solve(scheduling.schedule_calculator, input_args)
+        except PowerPlantConfigurationError as err:
+            log.warning("Impossible schedule requested from powerplants")
+            abort(400, custom=str(err))
+
+
+@powerplant_namespace.route("/replay")
+class PowerPlantReplayResource(Resource):
+    def post(self):
+        """
+        Dispatches the newline-delimited JSON records of the body as they are read, streaming back a line of NDJSON per
+        record. The records are dispatched in the thread of the request, one at a time, rather than in the solver pool,
+        the body being read as it goes
+        """
+        results = replay.replay_records(request.stream)
+        return Response(stream_with_context(replay.dump_records(results)), mimetype="application/x-ndjson")
+
+
 @parser.error_handler
 def handle_parse_error(err, req, schema, *, error_status_code, error_headers):
     log.warning(f"Failed to establish schema :{schema} because {err}")
@@ -0,0 +1,150 @@
+import numpy as np
+
+
+class Fleet:
+    """
+    Power plants stored column-wise in typed arrays instead of one PowerPlant instance per plant.
+    The effective limits and the cost per MWh only depend on the fuels, so they are computed once in set_fuels.
+    Iterating over the fleet or indexing it gives FleetPowerPlant views, that behave like PowerPlant instances
+    """
+    type_codes_by_name = {"gasfired": 0, "turbojet": 1, "windturbine": 2}
+    GASFIRED, TURBOJET, WINDTURBINE = 0, 1, 2
+    # Columns of the optional fields of the power plants, only used by the multi-period scheduling, and their defaults
+    scheduling_defaults = {"startup_cost": 0.0, "min_up_time": 0, "min_down_time": 0, "ramp_rate": np.inf}
+
+    def __init__(self, names, type_codes, efficiency, pmin, pmax, startup_cost=None, min_up_time=None,
+                 min_down_time=None, ramp_rate=None):
+        self.names = list(names)
+        self.type_codes = np.asarray(type_codes, dtype=np.int8)
+        self.efficiency = np.asarray(efficiency, dtype=np.float64)
+        self.pmin = np.asarray(pmin, dtype=np.float64)
+        self.pmax = np.asarray(pmax, dtype=np.float64)
+        self.startup_cost = self.optional_column(startup_cost, "startup_cost", np.float64)
+        self.min_up_time = self.optional_column(min_up_time, "min_up_time", np.int64)
+        self.min_down_time = self.optional_column(min_down_time, "min_down_time", np.int64)
+        self.ramp_rate = self.optional_column(ramp_rate, "ramp_rate", np.float64)
+        self.effective_pmin = np.zeros(len(self.names))
+        self.effective_pmax = np.zeros(len(self.names))
+        self.cost_per_mwh = np.zeros(len(self.names))
+        self._name_index = None
+
+    @classmethod
+    def from_raw_data(cls, power_plants_raw):
+        """Builds the fleet from the list of power plant dicts of the request"""
+        type_codes = []
+        for powerplant_raw in power_plants_raw:
+            pptype = powerplant_raw.get("type")
+            if pptype not in cls.type_codes_by_name:
+                raise ValueError(f"unexpected power plant type {pptype}. Check for typos")
+            type_codes.append(cls.type_codes_by_name[pptype])
+        optional_columns = {column: [powerplant_raw.get(column) for powerplant_raw in power_plants_raw]
+                            for column in cls.scheduling_defaults}
+        return cls([powerplant_raw.get("name") for powerplant_raw in power_plants_raw], type_codes,
+                   [powerplant_raw.get("efficiency") for powerplant_raw in power_plants_raw],
+                   [powerplant_raw.get("pmin") for powerplant_raw in power_plants_raw],
+                   [powerplant_raw.get("pmax") for powerplant_raw in power_plants_raw], **optional_columns)
+
+    def optional_column(self, values, column, dtype):
+        """Array of the values of an optional column, its default where a value is missing"""
+        default = self.scheduling_defaults[column]
+        if values is None:
+            return np.full(len(self.names), default, dtype=dtype)
+        if isinstance(values, np.ndarray):
+            return values
+        return np.array([default if value is None else value for value in values], dtype=dtype)
+
+    def set_fuels(self, fuels):
+        """
+        Computes the limits and the cost per MWh of all the power plants for the fuels.
+        Same rules as the PowerPlant classes: only the gas-fired power plants emit CO2, and the wind turbines
+        deliver exactly their share of pmax when on
+        """
+        wind_percentage = fuels.get("wind(%)", 0)
+        if wind_percentage < 0:
+            raise ValueError("Wind percentage cannot be less than 0")
+        gasfired = self.type_codes == self.GASFIRED
+        turbojet = self.type_codes == self.TURBOJET
+        windturbine = self.type_codes == self.WINDTURBINE
+        self.cost_per_mwh = np.zeros(len(self.names))
+        self.cost_per_mwh[gasfired] = (fuels.get("gas(euro/MWh)", 0) / self.efficiency[gasfired] +
+                                       0.3 * fuels.get("co2(euro/ton)", 0))
+        self.cost_per_mwh[turbojet] = fuels.get("kerosine(euro/MWh)", 0) / self.efficiency[turbojet]
+        self.effective_pmax = np.where(windturbine, self.pmax * wind_percentage / 100, self.pmax)
+        self.effective_pmin = np.where(windturbine, self.effective_pmax, self.pmin)
+
+    def with_fuels(self, fuels):
+        """
+        New fleet with the fuels set, sharing the columns that do not depend on the fuels with this one. They are
+        never modified in place, so this fleet can be reused for other fuels
+        """
+        fleet = Fleet(self.names, self.type_codes, self.efficiency, self.pmin, self.pmax, self.startup_cost,
+                      self.min_up_time, self.min_down_time, self.ramp_rate)
+        fleet.set_fuels(fuels)
+        return fleet
+
+    def sort(self):
+        """Sorts the power plants in place by cost per MWh, keeping the order of the power plants of equal cost"""
+        order = np.argsort(self.cost_per_mwh, kind="stable")
+        self.names = [self.names[index] for index in order]
+        for column in ("type_codes", "efficiency", "pmin", "pmax", "effective_pmin", "effective_pmax",
+                       "cost_per_mwh") + tuple(self.scheduling_defaults):
+            setattr(self, column, getattr(self, column)[order])
+        self._name_index = None
+
+    def index_of(self, name):
+        """Position of the power plant with that name in the fleet"""
+        if self._name_index is None:
+            self._name_index = {name: index for index, name in enumerate(self.names)}
+        return self._name_index[name]
+
+    def copy(self):
+        """List of views on the power plants, like the copy of a list of PowerPlant instances"""
+        return list(self)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, index):
+        if not -len(self.names) <= index < len(self.names):
+            raise IndexError("Fleet index out of range")
+        return FleetPowerPlant(self, index % len(self.names))
+
+    def __iter__(self):
+        return (FleetPowerPlant(self, index) for index in range(len(self.names)))
+
+
+class FleetPowerPlant:
+    """View on one power plant of a Fleet, with the interface of a PowerPlant"""
+    __slots__ = ("fleet", "index")
+
+    def __init__(self, fleet, index):
+        self.fleet = fleet
+        self.index = index
+
+    @property
+    def name(self):
+        return self.fleet.names[self.index]
+
+    def min_power_when_on(self):
+        return float(self.fleet.effective_pmin[self.index])
+
+    def max_power_when_on(self):
+        return float(self.fleet.effective_pmax[self.index])
+
+    def cost_per_mwh(self):
+        return float(self.fleet.cost_per_mwh[self.index])
+
+    def cost_euros_per_load(self, load_on_powerplant):
+        return load_on_powerplant * self.cost_per_mwh()
+
+    def __lt__(self, other):
+        return self.cost_per_mwh() < other.cost_per_mwh()
+
+    def __eq__(self, other):
+        return isinstance(other, FleetPowerPlant) and self.fleet is other.fleet and self.index == other.index
+
+    def __hash__(self):
+        return hash((id(self.fleet), self.index))
+
+    def __repr__(self):
+        return f"FleetPowerPlant({self.name!r})"
@@ -0,0 +1,293 @@
+import bisect
+import logging
+import time
+from collections import namedtuple
+from app.main.model.power_plant import PowerPlantConfigurationError
+from app.main.service.solver_pool import SolverTimeoutError
+from app.main.service.metrics import count_solver_calls, record_incomplete_search
+logger = logging.getLogger("service")
+
+# Outcome of a search: the dispatch (key=powerplant, value=load on it) of the best configuration found, its cost,
+# its relative gap to the lower bound of the cost (0 when proven optimal) and the counters of the search
+SearchResult = namedtuple("SearchResult", ["dispatch", "cost", "optimality_gap", "complete", "nodes_explored",
+                                           "nodes_pruned", "memo_hits"])
+
+
+class SearchLimitReached(Exception):
+    """Raised inside the search when its node or time limit is hit"""
+
+
+class BranchAndBoundCore:
+    """
+    Load distribution by branch and bound over the choices of the transition search of the LoadCalculatorCore.
+    Walking through the power plants in merit order, each one is either off, at pmax, or the marginal one. Once the
+    marginal power plant is chosen, the later ones are either off or at pmin, and the marginal one covers the rest.
+    Branches that can not beat the cheapest configuration found so far (the incumbent) are pruned, and the subproblems
+    are memoized on (start index, remaining load).
+    Has the same interface as the LoadCalculatorCore, so both can be selected by the LoadCalculationInterface
+    """
+    # Relative difference below which two costs or two loads are considered equal
+    tolerance = 1e-9
+
+    def __init__(self, node_limit=None, time_limit=None):
+        """
+        :param node_limit: maximum number of nodes explored, None for no limit
+        :param time_limit: maximum duration of a search in seconds, None for no limit.
+        When a limit is hit, the incumbent is returned with its optimality gap (anytime mode)
+        """
+        self.node_limit = node_limit
+        self.time_limit = time_limit
+        self.last_result = None
+
+    @count_solver_calls("bnb")
+    def get_optimal_power_plants_for_load(self, load, sorted_power_plants):
+        """
+        NOTE: Unit conversion is not handled here
+        Obtains a dict (key=powerplant, value=load on it) which is going to cost the least in euros, or the cheapest
+        found within the limits of the search
+        :param load: int, load required to be distributed among power plants available on the grid
+        :param sorted_power_plants: list of sorted power plant instances
+        :return: dict of powerplants which are the most optimal (least cost in euros)
+        """
+        self.last_result = self.search(load, sorted_power_plants)
+        if not self.last_result.complete:
+            logger.warning(f"Search stopped at its limits with an optimality gap of {self.last_result.optimality_gap}")
+            record_incomplete_search(self.last_result.optimality_gap)
+        return self.last_result.dispatch
+
+    def get_optimal_power_plants_for_loads(self, loads, sorted_power_plants):
+        """
+        Same as get_optimal_power_plants_for_load for several loads
+        :return: list of dict of powerplants which are the most optimal for each load,
+        None for the loads which can not be distributed
+        """
+        power_plants_to_use = []
+        for load in loads:
+            try:
+                power_plants_to_use.append(self.get_optimal_power_plants_for_load(load, sorted_power_plants))
+            except PowerPlantConfigurationError:
+                power_plants_to_use.append(None)
+        return power_plants_to_use
+
+    def search(self, load, sorted_power_plants):
+        """
+        Searches the cheapest configuration for the load
+        :return: SearchResult
+        :raises PowerPlantConfigurationError: no configuration can deliver the load
+        :raises SolverTimeoutError: a limit was hit before any configuration was found
+        """
+        search = BranchAndBoundSearch(sorted_power_plants, load, self.tolerance, self.node_limit, self.time_limit)
+        try:
+            search.run(search.explore_at_pmax(0, load, 0, None))
+            complete = True
+        except SearchLimitReached:
+            complete = False
+        if search.incumbent_dispatch is None:
+            if not complete:
+                raise SolverTimeoutError(f"No configuration found for a load of {load} within the limits of the search")
+            logger.debug(f"Impossible to have a configuration with load {load}")
+            raise PowerPlantConfigurationError(f"Impossible to have a configuration with a load of {load}")
+        lower_bound = search.merit_order_bound(0, load, search.cumulated_pmax, search.cumulated_cost_at_pmax)
+        optimality_gap = 0.0 if complete else max(0.0, (search.incumbent_cost - lower_bound) /
+                                                  max(search.incumbent_cost, self.tolerance))
+        return SearchResult(dispatch=search.convert_dispatch(search.incumbent_dispatch),
+                            cost=search.incumbent_cost, optimality_gap=optimality_gap, complete=complete,
+                            nodes_explored=search.nodes_explored, nodes_pruned=search.nodes_pruned,
+                            memo_hits=search.memo_hits)
+
+
+class BranchAndBoundSearch:
+    """
+    State of one search of the BranchAndBoundCore.
+    Each explore_* method is the generator of a subproblem, driven by run, returning (cost, dispatch, lower bound): the
+    cheapest cost found in the subproblem (inf if none was found below the incumbent) with its dispatch, and the lower
+    bound proven on it.
+    Dispatches are chains of ((plant number, load), rest of the chain), so that they are shared and never copied
+    """
+    infinity = float("inf")
+
+    def __init__(self, sorted_power_plants, load, tolerance, node_limit, time_limit):
+        self.plants = [power_plant for power_plant in sorted_power_plants if power_plant.max_power_when_on() > 0]
+        self.pmin = [power_plant.min_power_when_on() for power_plant in self.plants]
+        self.pmax = [power_plant.max_power_when_on() for power_plant in self.plants]
+        self.cost_per_mwh = [power_plant.cost_euros_per_load(1) for power_plant in self.plants]
+        # Cumulated limits and costs at those limits of the plants, for the merit order bounds
+        self.cumulated_pmax, self.cumulated_cost_at_pmax = self.cumulate(self.pmax)
+        self.cumulated_pmin, self.cumulated_cost_at_pmin = self.cumulate(self.pmin)
+        # Smallest pmin of the plants from each index on: a smaller load can not be delivered by them
+        self.smallest_pmin = [self.infinity] * (len(self.plants) + 1)
+        for index in reversed(range(len(self.plants))):
+            self.smallest_pmin[index] = min(self.smallest_pmin[index + 1], self.pmin[index])
+        self.load_tolerance = tolerance * (1 + load)
+        self.cost_tolerance = tolerance * (1 + self.merit_order_bound(0, min(load, self.cumulated_pmax[-1]), self.cumulated_pmax,
+                                                                        self.cumulated_cost_at_pmax))
+        self.node_limit = node_limit
+        self.deadline = None if time_limit is None else time.monotonic() + time_limit
+        self.incumbent_cost = self.infinity
+        self.incumbent_dispatch = None
+        self.memo = {}
+        self.nodes_explored = 0
+        self.nodes_pruned = 0
+        self.memo_hits = 0
+
+    def cumulate(self, limits):
+        """Cumulated sums of the limits of the plants and of their costs at those limits"""
+        cumulated_limits, cumulated_costs = [0.0], [0.0]
+        for limit, cost_per_mwh in zip(limits, self.cost_per_mwh):
+            cumulated_limits.append(cumulated_limits[-1] + limit)
+            cumulated_costs.append(cumulated_costs[-1] + limit * cost_per_mwh)
+        return cumulated_limits, cumulated_costs
+
+    def merit_order_bound(self, index, load, cumulated_limits, cumulated_costs):
+        """
+        Lower bound of the cost of the load with the power plants from index on: the cheapest ones filled up to
+        their limit in merit order, the last one only partly. inf if they can not deliver the load
+        """
+        capacity_before = cumulated_limits[index]
+        if load > cumulated_limits[-1] - capacity_before + self.load_tolerance:
+            return self.infinity
+        last = min(bisect.bisect_left(cumulated_limits, capacity_before + load), len(self.plants))
+        if last <= index:
+            return 0.0
+        load_before_last = cumulated_limits[last - 1] - capacity_before
+        return (cumulated_costs[last - 1] - cumulated_costs[index] +
+                self.cost_per_mwh[last - 1] * max(0.0, load - load_before_last))
+
+    @staticmethod
+    def run(subproblem):
+        """
+        Runs the generator of a subproblem with an explicit stack instead of recursion, the search going one level
+        deeper per power plant: each generator yields the generators of its own subproblems and is sent their results
+        :return: result of the subproblem
+        """
+        stack, result = [subproblem], None
+        while stack:
+            try:
+                child = stack[-1].send(result)
+            except StopIteration as stop:
+                stack.pop()
+                result = stop.value
+            else:
+                stack.append(child)
+                result = None
+        return result
+
+    def explore_at_pmax(self, index, remaining_load, cost_so_far, prefix):
+        """Subproblem of the plants from index on, before the marginal power plant is chosen"""
+        if remaining_load <= self.load_tolerance:
+            self.update_incumbent(cost_so_far, prefix, None)
+            return 0.0, None, 0.0
+        if remaining_load < self.smallest_pmin[index] - self.load_tolerance:
+            return self.infinity, None, self.infinity
+        key = (index, round(remaining_load, 9))
+        cached = self.cached(key, cost_so_far, prefix)
+        if cached is not None:
+            return cached
+        # As if the pmin were 0
+        lower_bound = self.merit_order_bound(index, remaining_load, self.cumulated_pmax, self.cumulated_cost_at_pmax)
+        if cost_so_far + lower_bound >= self.incumbent_cost - self.cost_tolerance:
+            self.nodes_pruned += 1
+            return self.infinity, None, lower_bound
+        self.count_node()
+
+        pmax = self.pmax[index]
+        branches = []
+        if pmax <= remaining_load + self.load_tolerance:
+            branches.append((pmax * self.cost_per_mwh[index], (index, pmax),
+                             lambda cost, chain: self.explore_at_pmax(index + 1, remaining_load - pmax, cost, chain)))
+        if self.pmin[index] <= remaining_load + self.load_tolerance:
+            branches.append((0.0, None,
+                             lambda cost, chain: self.explore_after_marginal(index + 1, remaining_load, index, cost,
+                                                                             chain)))
+        branches.append((0.0, None, lambda cost, chain: self.explore_at_pmax(index + 1, remaining_load, cost, chain)))
+        return (yield self.explore_branches(key, branches, cost_so_far, prefix))
+
+    def explore_after_marginal(self, index, remaining_load, marginal_index, cost_so_far, prefix):
+        """Subproblem of the plants from index on at pmin or off, the marginal power plant covering the rest"""
+        if remaining_load < self.pmin[marginal_index] - self.load_tolerance:
+            return self.infinity, None, self.infinity
+        marginal_cost_per_mwh = self.cost_per_mwh[marginal_index]
+        if remaining_load <= self.pmax[marginal_index] + self.load_tolerance:
+            # Turning on more plants at pmin only moves load from the marginal plant to more expensive ones
+            marginal_load = min(remaining_load, self.pmax[marginal_index])
+            cost = marginal_load * marginal_cost_per_mwh
+            dispatch = ((marginal_index, marginal_load), None)
+            self.update_incumbent(cost_so_far + cost, prefix, dispatch)
+            return cost, dispatch, cost
+        key = (index, round(remaining_load, 9), marginal_index)
+        cached = self.cached(key, cost_so_far, prefix)
+        if cached is not None:
+            return cached
+        # The load above pmax of the marginal plant goes to the next plants at pmin, as if they could take part of it
+        lower_bound = (self.pmax[marginal_index] * marginal_cost_per_mwh +
+                       self.merit_order_bound(index, remaining_load - self.pmax[marginal_index], self.cumulated_pmin,
+                                              self.cumulated_cost_at_pmin))
+        if cost_so_far + lower_bound >= self.incumbent_cost - self.cost_tolerance:
+            self.nodes_pruned += 1
+            return self.infinity, None, lower_bound
+        self.count_node()
+
+        pmin = self.pmin[index]
+        branches = []
+        if pmin > 0:
+            branches.append((pmin * self.cost_per_mwh[index], (index, pmin),
+                             lambda cost, chain: self.explore_after_marginal(index + 1, remaining_load - pmin,
+                                                                             marginal_index, cost, chain)))
+        branches.append((0.0, None,
+                         lambda cost, chain: self.explore_after_marginal(index + 1, remaining_load, marginal_index,
+                                                                         cost, chain)))
+        return (yield self.explore_branches(key, branches, cost_so_far, prefix))
+
+    def explore_branches(self, key, branches, cost_so_far, prefix):
+        """
+        Explores the branches (cost of the choice, (plant number, load) of the choice or None if the plant is off or
+        marginal, subproblem) of a node in order, and memoizes the cheapest one with the lower bound proven on the node
+        """
+        best_cost, best_dispatch, lower_bound = self.infinity, None, self.infinity
+        for choice_cost, choice, explore in branches:
+            cost, dispatch, branch_lower_bound = yield explore(cost_so_far + choice_cost,
+                                                               prefix if choice is None else (choice, prefix))
+            lower_bound = min(lower_bound, choice_cost + branch_lower_bound)
+            if choice_cost + cost < best_cost - self.cost_tolerance:
+                best_cost = choice_cost + cost
+                best_dispatch = dispatch if choice is None else (choice, dispatch)
+        self.memo[key] = (best_cost, best_dispatch, lower_bound)
+        return best_cost, best_dispatch, lower_bound
+
+    def cached(self, key, cost_so_far, prefix):
+        """
+        Result of the subproblem if it is memoized and either exact or proven unable to beat the incumbent, else None
+        """
+        if key not in self.memo:
+            return None
+        cost, dispatch, lower_bound = self.memo[key]
+        if lower_bound >= cost - self.cost_tolerance:
+            self.memo_hits += 1
+            self.update_incumbent(cost_so_far + cost, prefix, dispatch)
+            return self.memo[key]
+        if cost_so_far + lower_bound >= self.incumbent_cost - self.cost_tolerance:
+            self.memo_hits += 1
+            self.nodes_pruned += 1
+            return self.infinity, None, lower_bound
+        return None
+
+    def count_node(self):
+        if self.node_limit is not None and self.nodes_explored >= self.node_limit:
+            raise SearchLimitReached()
+        self.nodes_explored += 1
+        if self.deadline is not None and self.nodes_explored % 64 == 0 and time.monotonic() > self.deadline:
+            raise SearchLimitReached()
+
+    def update_incumbent(self, cost, prefix, dispatch):
+        if cost < self.incumbent_cost - self.cost_tolerance:
+            self.incumbent_cost = cost
+            self.incumbent_dispatch = (prefix, dispatch)
+
+    def convert_dispatch(self, incumbent_dispatch):
+        """dict (key=powerplant, value=load on it) of the chains of the prefix and of the dispatch of the incumbent"""
+        loads_per_plant = {}
+        for chain in incumbent_dispatch:
+            while chain is not None:
+                (index, load), chain = chain
+                loads_per_plant[index] = round(load, 10)
+        return {self.plants[index]: loads_per_plant[index] for index in sorted(loads_per_plant)}
@@ -0,0 +1,109 @@
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from app.main.config import Config
+
+
+class LRUCache:
+    """Thread-safe mapping of bounded size, evicting the least recently used entries and the ones older than ttl"""
+    def __init__(self, max_size, ttl, clock=time.monotonic):
+        """
+        :param max_size: maximum number of entries kept
+        :param ttl: seconds after which an entry expires, None to never expire
+        :param clock: function returning the current time in seconds
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key):
+        """Returns the value stored for the key, None if it is missing or has expired"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.ttl is not None and self.clock() - entry[0] > self.ttl:
+                del self._entries[key]
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (self.clock(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        """Counters of the cache"""
+        return {"size": len(self._entries), "hits": self.hits, "misses": self.misses,
+                "evictions": self.evictions, "expirations": self.expirations}
+
+
+class DispatchCache:
+    """
+    Caches of the load distribution, keyed on the fingerprint of the power plants and fuels of the request:
+    - merit_orders: the power plant instances, with their fuels set, sorted by cost
+    - responses: the response for a (fingerprint, engine, load)
+    - curves: the SupplyCurve of the power plants and fuels
+    - cost_tables: the CostTables of the DynamicProgrammingCore over the capacity of a registered fleet with its fuels,
+    from which its next loads are re-dispatched. They are the largest entries, up to the cells budget of the core
+    """
+    def __init__(self, max_merit_orders=128, max_responses=4096, max_curves=32, max_cost_tables=4, ttl=3600):
+        self.merit_orders = LRUCache(max_merit_orders, ttl)
+        self.responses = LRUCache(max_responses, ttl)
+        self.curves = LRUCache(max_curves, ttl)
+        self.cost_tables = LRUCache(max_cost_tables, ttl)
+
+    @classmethod
+    def fingerprint(cls, power_plants, fuels):
+        """
+        Hash of the canonicalized power plants and fuels. Numbers are compared as floats, and the order of the power
+        plants is kept as it decides between power plants of equal cost
+        """
+        return cls.fingerprint_of_canonical(cls.canonicalize_power_plants(power_plants), fuels)
+
+    @staticmethod
+    def canonicalize_power_plants(power_plants):
+        return tuple((power_plant.get("name"), power_plant.get("type"), float(power_plant.get("efficiency")),
+                      float(power_plant.get("pmin")), float(power_plant.get("pmax"))) for power_plant in power_plants)
+
+    @staticmethod
+    def fingerprint_of_canonical(canonical_power_plants, fuels):
+        """Same as fingerprint, for power plants already canonicalized e.g. the ones of a registered fleet"""
+        canonical_fuels = tuple(sorted((fuel_name, float(value)) for fuel_name, value in fuels.items()))
+        return hashlib.sha1(repr((canonical_power_plants, canonical_fuels)).encode()).hexdigest()
+
+    def clear(self):
+        self.merit_orders.clear()
+        self.responses.clear()
+        self.curves.clear()
+        self.cost_tables.clear()
+
+    def stats(self):
+        return {"merit_orders": self.merit_orders.stats(), "responses": self.responses.stats(),
+                "curves": self.curves.stats(), "cost_tables": self.cost_tables.stats()}
+
+
+# Cache shared by the requests of the app, None when it is turned off. It is read from the config of the environment,
+# the solves running in worker processes without the app
+dispatch_cache = DispatchCache() if Config.DISPATCH_CACHE else None
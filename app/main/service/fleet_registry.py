@@ -0,0 +1,156 @@
+import os
+import json
+import fcntl
+import hashlib
+import logging
+import threading
+from app.main.model.fleet import Fleet
+from app.main.service.dispatch_cache import DispatchCache
+from app.main.service.metrics import stage
+logger = logging.getLogger("service")
+
+
+class UnknownFleetError(KeyError):
+    """Raised when dispatching on a fleet that was not registered"""
+
+
+class FleetNotInWorkerError(KeyError):
+    """Raised in a process of the solver pool that does not hold the version of the fleet it is asked to dispatch"""
+
+
+class RegisteredFleet:
+    """
+    Power plants registered once under an ID. What does not depend on the fuels is built at registration: the
+    typed columns of the Fleet and the canonical form of the power plants used in the fingerprints of the cache
+    """
+    def __init__(self, fleet_id, power_plants, fleet=None, canonical_power_plants=None):
+        """
+        :param fleet_id: ID of the fleet in the registry, None for the power plants of a single request
+        :param power_plants: list of power plant dicts, as validated by the PowerPlantSchema
+        :param fleet: Fleet of the power plants, built from them when None
+        :param canonical_power_plants: same as DispatchCache.canonicalize_power_plants, computed when None
+        """
+        self.fleet_id = fleet_id
+        self.power_plants = [dict(power_plant) for power_plant in power_plants]
+        self.fleet = Fleet.from_raw_data(self.power_plants) if fleet is None else fleet
+        self.canonical_power_plants = DispatchCache.canonicalize_power_plants(self.power_plants) \
+            if canonical_power_plants is None else canonical_power_plants
+        self.version = hashlib.sha1(json.dumps(self.power_plants, sort_keys=True).encode()).hexdigest()
+
+    def fleet_with_fuels(self, fuels):
+        """New Fleet of the power plants with the fuels set. The registered fleet is left untouched"""
+        with stage("fleet"):
+            return self.fleet.with_fuels(fuels)
+
+    def fingerprint(self, fuels):
+        """Same fingerprint as DispatchCache.fingerprint of the power plants and fuels"""
+        return DispatchCache.fingerprint_of_canonical(self.canonical_power_plants, fuels)
+
+    def convert_as_response(self):
+        return {"id": self.fleet_id, "powerplants": [dict(power_plant) for power_plant in self.power_plants]}
+
+
+# Fleets held by this process when it is a worker of the solver pool, by ID. A worker is sent the power plants of a
+# fleet only the first time it dispatches that version of it, then only the ID and version
+worker_fleets = {}
+
+
+def dispatch_in_worker(function, fleet_id, version, raw_input_data, power_plants=None):
+    """
+    Calls the function of the service on the fleet of that ID held by the process, run in the solver pool
+    :param function: function of the service taking the RegisteredFleet and the raw_input_data
+    :param version: version of the RegisteredFleet expected
+    :param raw_input_data: dict of the load and fuels
+    :param power_plants: power plants of the fleet, None when the process is expected to hold that version already
+    :raises FleetNotInWorkerError: if the process does not hold that version and no power plants were sent
+    """
+    registered_fleet = worker_fleets.get(fleet_id)
+    if registered_fleet is None or registered_fleet.version != version:
+        if power_plants is None:
+            raise FleetNotInWorkerError(f"Fleet {fleet_id} is not held by process {os.getpid()}")
+        registered_fleet = RegisteredFleet(fleet_id, power_plants)
+        worker_fleets[fleet_id] = registered_fleet
+    return function(registered_fleet, raw_input_data)
+
+
+class FleetRegistry:
+    """
+    Fleets registered by ID, kept in memory. With a snapshot path, every registration is written to that JSON file,
+    which is read again at start-up and whenever another process has written it since, so that the workers of the
+    WSGI server sharing the file see the same fleets. A registration holds an exclusive lock on the file of the
+    snapshot path followed by .lock from reading the snapshot to writing it, so that concurrent ones are all kept
+    """
+    def __init__(self, snapshot_path=None):
+        """:param snapshot_path: JSON file of the snapshots, None to keep the fleets in memory only"""
+        self.snapshot_path = snapshot_path
+        self._fleets = {}
+        self._snapshot_mtime = None
+        self._lock = threading.Lock()
+        if snapshot_path is not None:
+            self.load_snapshot()
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config["FLEET_SNAPSHOT_PATH"])
+
+    def register(self, fleet_id, power_plants):
+        """
+        Registers the power plants under the ID, replacing the fleet already registered under it if any
+        :return: RegisteredFleet
+        """
+        registered_fleet = RegisteredFleet(fleet_id, power_plants)
+        with self._lock:
+            if self.snapshot_path is None:
+                self._fleets[fleet_id] = registered_fleet
+            else:
+                with open(f"{self.snapshot_path}.lock", "a") as lock_file:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+                    # Read even if its modification time did not change, which may be too coarse to tell writes apart
+                    self.load_snapshot()
+                    self._fleets[fleet_id] = registered_fleet
+                    self.save_snapshot()
+        logger.info(f"Registered fleet {fleet_id} of {len(registered_fleet.power_plants)} power plants")
+        return registered_fleet
+
+    def get(self, fleet_id):
+        """RegisteredFleet of that ID, raises UnknownFleetError if there is none"""
+        with self._lock:
+            self.reload_snapshot_if_changed()
+            try:
+                return self._fleets[fleet_id]
+            except KeyError:
+                raise UnknownFleetError(f"Unknown fleet {fleet_id}") from None
+
+    def __len__(self):
+        return len(self._fleets)
+
+    def reload_snapshot_if_changed(self):
+        if self.snapshot_path is not None and self.snapshot_mtime() != self._snapshot_mtime:
+            self.load_snapshot()
+
+    def snapshot_mtime(self):
+        try:
+            return os.stat(self.snapshot_path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def load_snapshot(self):
+        """Replaces the fleets in memory by the ones of the snapshot file, if it exists"""
+        mtime = self.snapshot_mtime()
+        if mtime is None:
+            return
+        with open(self.snapshot_path, "r") as fp:
+            snapshot = json.load(fp)
+        self._fleets = {fleet_id: RegisteredFleet(fleet_id, power_plants)
+                        for fleet_id, power_plants in snapshot.items()}
+        self._snapshot_mtime = mtime
+        logger.info(f"Loaded {len(self._fleets)} fleets from {self.snapshot_path}")
+
+    def save_snapshot(self):
+        """Writes all the fleets to the snapshot file. The file is replaced at once, never left half written"""
+        temporary_path = f"{self.snapshot_path}.{os.getpid()}.tmp"
+        with open(temporary_path, "w") as fp:
+            json.dump({fleet_id: registered_fleet.power_plants
+                       for fleet_id, registered_fleet in self._fleets.items()}, fp)
+        os.replace(temporary_path, self.snapshot_path)
+        self._snapshot_mtime = self.snapshot_mtime()
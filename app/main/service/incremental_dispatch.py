@@ -0,0 +1,161 @@
+import logging
+from collections import namedtuple
+import numpy as np
+from app.main.model.fleet import Fleet
+from app.main.model.power_plant import PowerPlantConfigurationError
+from app.main.service import load_calculations
+from app.main.service.dispatch_cache import dispatch_cache
+from app.main.service.metrics import stage
+from app.main.service.unit_commitment import DynamicProgrammingCore, GridTooLargeError
+logger = logging.getLogger("service")
+
+# Power plants that are on (names, in merit order) and the marginal one (None if all of them are at their limits),
+# returned with every dispatch
+Commitment = namedtuple("Commitment", ["committed", "marginal"])
+
+
+def incremental_load_distributor(registered_fleet, raw_input_data, engine="dp", cache=dispatch_cache):
+    """
+    Same as registered_fleet_load_distributor, for the successive loads of a fleet. With the dp engine, the cost tables
+    of the thermal power plants of the fleet and fuels are built by the first request, up to twice its load, and kept
+    in the cache, so that the next loads with the same fuels but the wind are only backtracked from them instead of
+    solving again
+    :param registered_fleet: RegisteredFleet
+    :param raw_input_data: dictionary of load and fuels
+    :param engine: name of the solver engine of the full solves, in SOLVER_ENGINES
+    :param cache: DispatchCache of the sorted power plants and cost tables, None to not cache
+    :return: dict of the powerplants (same as load_distributor), the commitment for the next request and whether the
+    load was re-dispatched from the cost tables of a previous request
+    """
+    fuels = raw_input_data.get("fuels", {})
+    fingerprint = registered_fleet.fingerprint(fuels)
+    if cache is None:
+        load_calculations_interface = load_calculations.LoadCalculationInterface \
+            .get_load_calculator_from_registered_fleet(raw_input_data, engine, registered_fleet)
+    else:
+        load_calculations_interface = load_calculations.LoadCalculationInterface.get_load_calculator_from_merit_orders(
+            raw_input_data, engine, cache.merit_orders, fingerprint, registered_fleet)
+    sorted_fleet = load_calculations_interface.get_sorted_power_plants()
+    incremental_dispatcher = IncrementalDispatcher(sorted_fleet)
+    distributed_load, redispatched = None, False
+    if engine == "dp":
+        load = load_calculations_interface.load_to_distrib
+        with stage("redispatch"):
+            # The cost tables do not depend on the wind
+            thermal_fingerprint = registered_fleet.fingerprint({fuel_name: value for fuel_name, value in fuels.items()
+                                                                if fuel_name != "wind(%)"})
+            redispatched = incremental_dispatcher.load_cost_tables(None if cache is None else cache.cost_tables,
+                                                                   thermal_fingerprint, load)
+            if incremental_dispatcher.cost_tables is not None:
+                distributed_load = incremental_dispatcher.redispatch(load)
+    if distributed_load is None:
+        redispatched = False
+        distributed_load = load_calculations_interface.distribute_load()
+    with stage("response"):
+        return {"powerplants": load_calculations_interface.convert_distributed_data_as_response(
+                    distributed_load, sorted_fleet),
+                "commitment": incremental_dispatcher.get_commitment(distributed_load)._asdict(),
+                "redispatched": redispatched}
+
+
+class IncrementalDispatcher:
+    """
+    Re-dispatch of the loads of the same power plants and fuels from the cost tables of the DynamicProgrammingCore,
+    on the grid of the whole MWs. They are built up to a multiple of the load, so that the next loads are only
+    backtracked from them as long as they stay below it: a walk back through the power plants and the rebuild of the
+    cost table at pmax from the checkpoint before the marginal power plant, instead of a solve over all of them.
+    They are built for the thermal power plants only, the wind turbines being added to them as in the
+    ScenarioDispatcher, so that they are kept whatever the wind
+    """
+    # Largest load of the cost tables, relative to the load they are built for
+    load_headroom = 2
+    # Grids of the wind, finest first, as in the ScenarioDispatcher. The outputs of the wind turbines are snapped to
+    # the finest one like in a full solve, and need a full solve when off a coarser one
+    wind_resolutions = (0.01, 0.1, 1)
+
+    def __init__(self, sorted_fleet, core=None):
+        """
+        :param sorted_fleet: Fleet with its fuels set, sorted by cost
+        :param core: DynamicProgrammingCore building the cost tables
+        """
+        self.fleet = sorted_fleet
+        self.core = core or DynamicProgrammingCore()
+        self.wind_indices = np.flatnonzero(sorted_fleet.type_codes == Fleet.WINDTURBINE)
+        self.cost_tables = None
+
+    def load_cost_tables(self, cost_tables_cache, fingerprint, load):
+        """
+        Takes the cost tables of the fingerprint from the cache if they reach the load, else builds them and puts them
+        in the cache. They are left to None when the grid exceeds the cells budget of the core, the load then needing
+        a full solve
+        :param cost_tables_cache: LRUCache of the cost tables per fingerprint, None to always build them
+        :param fingerprint: fingerprint of the power plants and fuels but the wind of the fleet
+        :param load: int, load to distribute
+        :return: whether the cost tables come from the cache
+        """
+        if cost_tables_cache is not None:
+            cost_tables = self.cost_tables = cost_tables_cache.get(fingerprint)
+            # Reaching the load, or the capacity of the thermal power plants when the wind takes the rest
+            if cost_tables is not None and \
+                    min(load / cost_tables.resolution, cost_tables.capacity) < cost_tables.cost_at_pmax.size:
+                return True
+        thermal_power_plants = [self.fleet[index] for index in range(len(self.fleet))
+                                if self.fleet.type_codes[index] != Fleet.WINDTURBINE]
+        capacity = sum(power_plant.max_power_when_on() for power_plant in thermal_power_plants)
+        # The finest grid of the wind on which the tables reach the headroom within the cells budget
+        for wind_resolution in self.wind_resolutions:
+            resolution = self.core.resolution or self.core.determine_resolution([1, wind_resolution],
+                                                                                thermal_power_plants)
+            if len(thermal_power_plants) * (min(self.load_headroom * load, capacity) / resolution + 1) <= \
+                    self.core.max_cells:
+                break
+        # As wide as the headroom and the cells budget allow, the loads above the capacity being left out anyway
+        largest_load_steps = max(int(round(load / resolution)),
+                                 min(int(round(self.load_headroom * load / resolution)),
+                                     self.core.max_cells // max(len(thermal_power_plants), 1) - 1))
+        try:
+            self.cost_tables = self.core.build_cost_tables(thermal_power_plants, resolution, 0, largest_load_steps)
+        except GridTooLargeError as err:
+            logger.info(f"{err}: the load is solved again")
+            self.cost_tables = None
+            return False
+        if cost_tables_cache is not None:
+            cost_tables_cache.put(fingerprint, self.cost_tables)
+        return False
+
+    def redispatch(self, load):
+        """
+        :param load: int, load to distribute
+        :return: dict (key=powerplant, value=load on it) of the cheapest dispatch, None when it needs a full solve:
+        when the output of a wind turbine is off the grid of the cost tables while a finer one exists, or can not be
+        taken by the power plants on once snapped to it
+        """
+        resolution = self.cost_tables.resolution
+        wind_power = self.fleet.effective_pmax[self.wind_indices]
+        wind_steps = np.round(wind_power / resolution).astype(np.int64)
+        wind_differences = wind_steps * resolution - wind_power
+        if resolution > self.core.base_resolution + 1e-12 and (np.abs(wind_differences) > 1e-9).any():
+            return None
+        dispatch = self.core.backtrack_with_fixed_outputs(self.cost_tables, wind_steps, int(round(load / resolution)))
+        if dispatch is None:
+            logger.debug(f"Impossible to have a configuration with load {load}")
+            raise PowerPlantConfigurationError(f"Impossible to have a configuration with a load of {load}")
+        thermal_dispatch, wind_on = dispatch
+        # The wind turbines deliver their actual output, the thermal power plants taking the difference with the grid
+        power_per_plant = self.cost_tables.convert_to_power(*thermal_dispatch, float(wind_differences[wind_on].sum()))
+        if power_per_plant is None:
+            return None
+        # The power plants of cached tables are the ones of another fleet with the same fingerprint, sorted the same way
+        distributed_load = {self.fleet[self.cost_tables.plants[plant_number].index]: power
+                            for plant_number, power in power_per_plant.items()}
+        distributed_load.update({self.fleet[int(index)]: round(float(power), 10)
+                                 for index, power in zip(self.wind_indices[wind_on], wind_power[wind_on])})
+        return distributed_load
+
+    def get_commitment(self, distributed_load):
+        """Commitment of a dispatch (key=powerplant, value=load on it) of the fleet"""
+        committed = [power_plant for power_plant in self.fleet if distributed_load.get(power_plant, 0) > 0]
+        marginal = [power_plant.name for power_plant in committed
+                    if distributed_load[power_plant] < power_plant.max_power_when_on()]
+        return Commitment(committed=[power_plant.name for power_plant in committed],
+                          marginal=marginal[-1] if marginal else None)
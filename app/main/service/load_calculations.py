@@ -1,38 +1,171 @@
 import logging
-from app.main.model.power_plant import PowerPlantFactory, PowerPlant, PowerPlantConfigurationError
+import numpy as np
+from app.main.config import Config
+from app.main.model.fleet import Fleet
+from app.main.model.power_plant import PowerPlant, PowerPlantConfigurationError
+from app.main.service.unit_commitment import DynamicProgrammingCore
+from app.main.service.branch_and_bound import BranchAndBoundCore
+from app.main.service.dispatch_cache import dispatch_cache
+from app.main.service.metrics import stage, count_solver_calls
 logger = logging.getLogger("service")
 
 
-def load_distributor(raw_input_data):
+def load_distributor(raw_input_data, engine="dp", cache=dispatch_cache):
     """
     Obtains the raw_input_data, transfers it and gets the output in desired form
     :param raw_input_data: dictionary of load, fuels and powerplants
+    :param engine: name of the solver engine in SOLVER_ENGINES
+    :param cache: DispatchCache reused between requests with the same powerplants and fuels, None to not cache
     :return:list of powerplants with the name and load on each of them
     """
-    load_calculations_interface = LoadCalculationInterface.get_load_calculator_from_raw_data(raw_input_data)
+    if cache is None:
+        return distribute_and_convert(
+            LoadCalculationInterface.get_load_calculator_from_raw_data(raw_input_data, engine))
+    fingerprint = cache.fingerprint(raw_input_data.get("powerplants"), raw_input_data.get("fuels", {}))
+    return cached_load_distributor(raw_input_data, engine, cache, fingerprint, lambda: (
+        LoadCalculationInterface.get_load_calculator_from_merit_orders(
+            raw_input_data, engine, cache.merit_orders, fingerprint)))
+
+
+def registered_fleet_load_distributor(registered_fleet, raw_input_data, engine="dp", cache=dispatch_cache):
+    """
+    Same as load_distributor for the power plants of a fleet of the FleetRegistry, which are neither validated
+    nor built again
+    :param registered_fleet: RegisteredFleet
+    :param raw_input_data: dictionary of load and fuels
+    """
+    if cache is None:
+        return distribute_and_convert(
+            LoadCalculationInterface.get_load_calculator_from_registered_fleet(raw_input_data, engine, registered_fleet))
+    fingerprint = registered_fleet.fingerprint(raw_input_data.get("fuels", {}))
+    return cached_load_distributor(raw_input_data, engine, cache, fingerprint, lambda: (
+        LoadCalculationInterface.get_load_calculator_from_merit_orders(
+            raw_input_data, engine, cache.merit_orders, fingerprint, registered_fleet)))
+
+
+def cached_load_distributor(raw_input_data, engine, cache, fingerprint, get_load_calculator):
+    """
+    Returns the cached response for the fingerprint, engine and load, else distributes the load and caches the response
+    :param get_load_calculator: function returning the LoadCalculationInterface of the request
+    """
+    response_key = (fingerprint, engine, raw_input_data.get("load", 0))
+    cached_response = cache.responses.get(response_key)
+    if cached_response is not None:
+        return [dict(power_plant_load) for power_plant_load in cached_response]
+    sanitized_response = distribute_and_convert(get_load_calculator())
+    cache.responses.put(response_key, [dict(power_plant_load) for power_plant_load in sanitized_response])
+    return sanitized_response
+
+
+def distribute_and_convert(load_calculations_interface):
+    """Distributes the load of the LoadCalculationInterface and converts it to the response"""
     distributed_load = load_calculations_interface.distribute_load()
-    sanitized_response = load_calculations_interface.convert_distributed_data_as_response(
-        distributed_load, load_calculations_interface.power_plants)
+    with stage("response"):
+        sanitized_response = load_calculations_interface.convert_distributed_data_as_response(
+            distributed_load, load_calculations_interface.power_plants)
     return sanitized_response
 
 
+def load_distributor_batch(raw_input_data, engine="dp"):
+    """
+    Distributes several loads (e.g. the time slots of a day) on the same power plants. The fleet is created once,
+    and the merit order and cost tables are shared by all the slots burning the same fuels
+    :param raw_input_data: dictionary of loads, fuels, powerplants and optionally fuels_per_slot, a list (one per
+    load) of dictionaries overriding some of the fuels for that slot
+    :param engine: name of the solver engine in SOLVER_ENGINES
+    :return: list with for each slot its load, cost in euros and list of powerplants with the name and load on
+    each of them. Slots whose load cannot be distributed have an error instead
+    """
+    loads = raw_input_data.get("loads")
+    fuels = raw_input_data.get("fuels", {})
+    fuels_per_slot = raw_input_data.get("fuels_per_slot") or [{}] * len(loads)
+    with stage("fleet"):
+        fleet = Fleet.from_raw_data(raw_input_data.get("powerplants"))
+    slots_per_fuels = {}
+    for slot, slot_fuels in enumerate(fuels_per_slot):
+        fuels_of_slot = dict(fuels, **slot_fuels)
+        slots_per_fuels.setdefault(tuple(sorted(fuels_of_slot.items())), []).append(slot)
+
+    response = [None] * len(loads)
+    for fuels_items, slots in slots_per_fuels.items():
+        fleet.set_fuels(dict(fuels_items))
+        load_calculations_interface = LoadCalculationInterface(0, dict(fuels_items), fleet, engine)
+        slot_loads = [loads[slot] for slot in slots]
+        distributed_loads = load_calculations_interface.distribute_loads(slot_loads)
+        feasible = [number for number, distributed_load in enumerate(distributed_loads) if distributed_load is not None]
+        costs = load_calculations_interface.calculate_cost_of_dispatches(
+            [distributed_loads[number] for number in feasible], load_calculations_interface.power_plants)
+        with stage("response"):
+            for number, cost in zip(feasible, costs):
+                response[slots[number]] = {
+                    "load": slot_loads[number],
+                    "cost": float(cost),
+                    "powerplants": load_calculations_interface.convert_distributed_data_as_response(
+                        distributed_loads[number], load_calculations_interface.power_plants)}
+        for number in set(range(len(slots))) - set(feasible):
+            logger.warning(f"Impossible load {slot_loads[number]} requested in slot {slots[number]}")
+            response[slots[number]] = {
+                "load": slot_loads[number],
+                "error": f"Load {slot_loads[number]} cannot be distributed with the current power plants"}
+    return response
+
+
 class LoadCalculationInterface:
     """Interface to the Flask App for consolidating information from the POST and sending valid data back"""
     @classmethod
-    def get_load_calculator_from_raw_data(cls, raw_input_data):
+    def get_load_calculator_from_raw_data(cls, raw_input_data, engine="dp"):
         load_to_distribute = raw_input_data.get("load", 0)
         fuels = raw_input_data.get("fuels", {})
-        power_plants = raw_input_data.get("powerplants")
-        power_plant_instances = [PowerPlantFactory.get_power_plant_instance(powerplant) for powerplant in power_plants]
-        [PowerPlantFactory.set_fuel_on_power_plant(powerplant_instance, fuels) for powerplant_instance in
-         power_plant_instances]
-        return cls(load_to_distribute, fuels, power_plant_instances)
+        with stage("fleet"):
+            fleet = Fleet.from_raw_data(raw_input_data.get("powerplants"))
+            fleet.set_fuels(fuels)
+        return cls(load_to_distribute, fuels, fleet, engine)
 
-    def __init__(self, load_to_distribute, fuel_list, power_plants):
+    @classmethod
+    def get_load_calculator_from_registered_fleet(cls, raw_input_data, engine, registered_fleet):
+        fuels = raw_input_data.get("fuels", {})
+        return cls(raw_input_data.get("load", 0), fuels, registered_fleet.fleet_with_fuels(fuels), engine)
+
+    @classmethod
+    def get_load_calculator_from_merit_orders(cls, raw_input_data, engine, merit_orders, fingerprint,
+                                              registered_fleet=None):
+        """
+        Same as get_load_calculator_from_raw_data, but reuses the sorted power plants of a previous request with the
+        same fingerprint
+        :param merit_orders: LRUCache of the sorted fleet per fingerprint
+        :param fingerprint: fingerprint of the powerplants and fuels of the raw_input_data
+        :param registered_fleet: RegisteredFleet of the power plants, None to build them from the raw_input_data
+        """
+        fleet_sorted = merit_orders.get(fingerprint)
+        if fleet_sorted is None:
+            if registered_fleet is None:
+                load_calculations_interface = cls.get_load_calculator_from_raw_data(raw_input_data, engine)
+            else:
+                load_calculations_interface = cls.get_load_calculator_from_registered_fleet(
+                    raw_input_data, engine, registered_fleet)
+            merit_orders.put(fingerprint, load_calculations_interface.get_sorted_power_plants())
+            return load_calculations_interface
+        # The cached fleet is shared between requests. It is never modified again once sorted
+        return cls(raw_input_data.get("load", 0), raw_input_data.get("fuels", {}), fleet_sorted, engine,
+                   power_plants_are_sorted=True)
+
+    def __init__(self, load_to_distribute, fuel_list, power_plants, engine="dp", power_plants_are_sorted=False):
         logger.info("Setting up load calculation interface")
         self.load_to_distrib = load_to_distribute
         self.fuel_list = fuel_list
         self.power_plants = power_plants
+        self.engine = engine
+        self.power_plants_are_sorted = power_plants_are_sorted
+
+    @property
+    def engine(self):
+        return self._engine
+
+    @engine.setter
+    def engine(self, engine):
+        if engine not in SOLVER_ENGINES:
+            raise ValueError(f"Unknown solver engine {engine}. Choose one of {sorted(SOLVER_ENGINES)}")
+        self._engine = engine
 
     @property
     def load_to_distrib(self):
@@ -44,14 +177,47 @@ class LoadCalculationInterface:
             raise ValueError("The load to distribute cannot be less than 0")
         self._load_to_distrib = int(load_to_distrib)
 
+    def get_sorted_power_plants(self):
+        """Sorts the power plants by cost, unless they already are"""
+        if not self.power_plants_are_sorted:
+            with stage("sort"):
+                PowerPlant.get_sorted_power_plants(self.power_plants)
+            self.power_plants_are_sorted = True
+        return self.power_plants
+
     def distribute_load(self):
         """
-        Sends the load and power plants to the PowerPlantCore to get the most inexpensive configuration of PowerPlants
+        Sends the load and power plants to the core of the selected engine to get the most inexpensive configuration
+        of PowerPlants
         :return:
         """
-        power_plants_sorted = PowerPlant.get_sorted_power_plants(self.power_plants)
-        load_calculator = LoadCalculatorCore()
-        return load_calculator.get_optimal_power_plants_for_load(self.load_to_distrib, power_plants_sorted)
+        power_plants_sorted = self.get_sorted_power_plants()
+        load_calculator = get_solver(self.engine)
+        with stage("dispatch"):
+            return load_calculator.get_optimal_power_plants_for_load(self.load_to_distrib, power_plants_sorted)
+
+    def distribute_loads(self, loads):
+        """
+        Same as distribute_load for several loads, sorting the power plants once
+        :param loads: list of loads to distribute
+        :return: list of the most inexpensive configurations, None for the loads that cannot be distributed
+        """
+        if any(load < 0 for load in loads):
+            raise ValueError("The load to distribute cannot be less than 0")
+        power_plants_sorted = self.get_sorted_power_plants()
+        load_calculator = get_solver(self.engine, len(loads))
+        with stage("dispatch"):
+            return load_calculator.get_optimal_power_plants_for_loads([int(load) for load in loads],
+                                                                      power_plants_sorted)
+
+    @staticmethod
+    def calculate_cost_of_dispatches(distributed_load_dicts, fleet):
+        """Costs in euros of several configurations of the fleet, as the product of their loads and the costs per MWh"""
+        loads_per_power_plant = np.zeros((len(distributed_load_dicts), len(fleet)))
+        for number, distributed_load_dict in enumerate(distributed_load_dicts):
+            for power_plant, load_on_power_plant in distributed_load_dict.items():
+                loads_per_power_plant[number, power_plant.index] = load_on_power_plant
+        return loads_per_power_plant @ fleet.cost_per_mwh
 
     @staticmethod
     def convert_distributed_data_as_response(distributed_load_dict, power_plants):
@@ -66,6 +232,7 @@ class LoadCalculationInterface:
 
 class LoadCalculatorCore:
     """All functions related to calculating the load. No unit conversion handled here"""
+    @count_solver_calls("legacy")
     def get_optimal_power_plants_for_load(self, load, sorted_power_plants):
         """
         NOTE: Unit conversion is not handled here
@@ -111,6 +278,20 @@ class LoadCalculatorCore:
             raise PowerPlantConfigurationError(f"Impossible to have a configuration with a load of {load}")
         return power_plants_to_use
 
+    def get_optimal_power_plants_for_loads(self, loads, sorted_power_plants):
+        """
+        Same as get_optimal_power_plants_for_load for several loads
+        :return: list of dict of powerplants which are the most optimal for each load,
+        None for the loads which can not be distributed
+        """
+        power_plants_to_use = []
+        for load in loads:
+            try:
+                power_plants_to_use.append(self.get_optimal_power_plants_for_load(load, sorted_power_plants))
+            except PowerPlantConfigurationError:
+                power_plants_to_use.append(None)
+        return power_plants_to_use
+
     def determine_cheapest_config_at_transition(self, power_plants_already_calc, powerplant_index_check_from,
                                                 sorted_power_plants, remaining_load_to_distrib, max_load):
         """
@@ -164,3 +345,24 @@ class LoadCalculatorCore:
         for powerplant, load_value in load_dict.items():
             total_cost = total_cost + powerplant.cost_euros_per_load(load_value)
         return total_cost
+
+
+# Solver engines that can be selected in the LoadCalculationInterface
+SOLVER_ENGINES = {
+    "dp": DynamicProgrammingCore,
+    "bnb": BranchAndBoundCore,
+    "legacy": LoadCalculatorCore,
+}
+# Engines whose searches stop at a time limit, the dp one in its branch and bound past its cells budget
+TIME_LIMITED_ENGINES = {"dp", "bnb"}
+
+
+def get_solver(engine, searches=1):
+    """
+    Solver of the engine in SOLVER_ENGINES, as built for the solves of the requests: the SEARCH_TIME_LIMIT of the
+    config is shared by the searches of the solver
+    :param searches: number of searches the solver is built for, e.g. the loads of a batch
+    """
+    if engine in TIME_LIMITED_ENGINES:
+        return SOLVER_ENGINES[engine](time_limit=Config.SEARCH_TIME_LIMIT / max(searches, 1))
+    return SOLVER_ENGINES[engine]()
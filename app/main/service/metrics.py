@@ -0,0 +1,341 @@
+import io
+import os
+import glob
+import json
+import time
+import pstats
+import bisect
+import cProfile
+import functools
+import threading
+from contextlib import contextmanager
+
+# Upper bounds in seconds of the buckets of the latency histograms
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# Upper bounds of the buckets of the histograms of counts per request
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 10000, 100000)
+
+
+class Counter:
+    """Counter of the Prometheus text format, with a value per combination of labels"""
+    metric_type = "counter"
+
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = self.label_values(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def label_values(self, labels):
+        return tuple(str(labels[label_name]) for label_name in self.label_names)
+
+    def format_labels(self, label_values, extra_labels=()):
+        labels = list(zip(self.label_names, label_values)) + list(extra_labels)
+        if not labels:
+            return ""
+        return "{" + ",".join(f'{name}="{value}"' for name, value in labels) + "}"
+
+    def snapshot(self):
+        """Copy of the value per label values"""
+        with self._lock:
+            return dict(self._values)
+
+    @staticmethod
+    def combine(value, other_value):
+        """Value of the same labels summed over two processes"""
+        return value + other_value
+
+    @staticmethod
+    def load_value(value):
+        """Value as read back from the JSON of a snapshot"""
+        return value
+
+    def samples(self, values=None):
+        """:param values: value per label values, the ones of the process if None"""
+        values = self.snapshot() if values is None else values
+        return [(self.name + self.format_labels(key), value) for key, value in sorted(values.items())]
+
+    def render(self, values=None):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.metric_type}"]
+        lines.extend(f"{sample_name} {value}" for sample_name, value in self.samples(values))
+        return "\n".join(lines)
+
+
+class Histogram(Counter):
+    """Histogram of the Prometheus text format: cumulative buckets, sum and count per combination of labels"""
+    metric_type = "histogram"
+
+    def __init__(self, name, documentation, label_names=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.label_values(labels)
+        with self._lock:
+            bucket_counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            bucket_counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._values[key] = (bucket_counts, total + value)
+
+    def snapshot(self):
+        with self._lock:
+            return {key: (list(bucket_counts), total) for key, (bucket_counts, total) in self._values.items()}
+
+    @staticmethod
+    def combine(value, other_value):
+        return [count + other_count for count, other_count in zip(value[0], other_value[0])], value[1] + other_value[1]
+
+    @staticmethod
+    def load_value(value):
+        return list(value[0]), value[1]
+
+    def samples(self, values=None):
+        values = self.snapshot() if values is None else values
+        samples = []
+        for key, (bucket_counts, total) in sorted(values.items()):
+            cumulated = 0
+            for upper_bound, bucket_count in zip(self.buckets + ("+Inf",), bucket_counts):
+                cumulated += bucket_count
+                samples.append((self.name + "_bucket" + self.format_labels(key, [("le", upper_bound)]), cumulated))
+            samples.append((self.name + "_sum" + self.format_labels(key), total))
+            samples.append((self.name + "_count" + self.format_labels(key), cumulated))
+        return samples
+
+
+class MetricsRegistry:
+    """
+    Metrics of the process, rendered in the Prometheus text format. With a directory, e.g. shared by the worker
+    processes of a WSGI server, each process writes its metrics to a file of its own there, and the metrics rendered
+    are summed over all the files, so that a scrape reaching any of the processes sees all of them. The files of the
+    processes that exited are kept, their counts being part of the totals
+    """
+    # Seconds between two writes of the file of the process. A write requested sooner is deferred to the end of the
+    # interval, so that a burst of requests writes it once and the file lags the process by at most the interval
+    write_interval = 1.0
+
+    def __init__(self, directory=None):
+        self.metrics = []
+        self.directory = directory
+        self._last_write = -float("inf")
+        self._deferred_write = None
+        self._write_lock = threading.Lock()
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def write(self, force=False):
+        """
+        Writes the metrics of the process to its file of the directory, if any, replacing it atomically
+        :param force: write now even if the last write is more recent than the write_interval, e.g. for a scrape
+        """
+        if self.directory is None:
+            return
+        with self._write_lock:
+            elapsed = time.monotonic() - self._last_write
+            if not force and elapsed < self.write_interval:
+                if self._deferred_write is None:
+                    self._deferred_write = threading.Timer(self.write_interval - elapsed, self.write, (True,))
+                    self._deferred_write.daemon = True
+                    self._deferred_write.start()
+                return
+            if self._deferred_write is not None:
+                self._deferred_write.cancel()
+                self._deferred_write = None
+            self._last_write = time.monotonic()
+        snapshot = {metric.name: [[list(key), value] for key, value in metric.snapshot().items()]
+                    for metric in self.metrics}
+        path = os.path.join(self.directory, f"metrics_{os.getpid()}.json")
+        # Of the thread, as the threads of a worker process write concurrently
+        temporary_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(temporary_path, "w") as fp:
+            json.dump(snapshot, fp)
+        os.replace(temporary_path, path)
+
+    def read(self):
+        """Value per label values of each metric (key=name), summed over the files of the directory"""
+        values_per_metric = {metric.name: {} for metric in self.metrics}
+        metrics_by_name = {metric.name: metric for metric in self.metrics}
+        for path in glob.glob(os.path.join(self.directory, "metrics_*.json")):
+            with open(path, "r") as fp:
+                snapshot = json.load(fp)
+            for name, values in snapshot.items():
+                metric = metrics_by_name.get(name)
+                if metric is None:
+                    continue
+                for key, value in values:
+                    key, value = tuple(key), metric.load_value(value)
+                    current_value = values_per_metric[name].get(key)
+                    values_per_metric[name][key] = value if current_value is None else \
+                        metric.combine(current_value, value)
+        return values_per_metric
+
+    def clear_directory(self):
+        """Removes the files of the directory, e.g. when the server starts, so that the totals start from 0"""
+        for path in glob.glob(os.path.join(self.directory, "metrics_*")):
+            os.remove(path)
+
+    def render(self):
+        if self.directory is None:
+            return "\n".join(metric.render() for metric in self.metrics) + "\n"
+        self.write(force=True)
+        values_per_metric = self.read()
+        return "\n".join(metric.render(values_per_metric[metric.name]) for metric in self.metrics) + "\n"
+
+
+registry = MetricsRegistry()
+http_request_duration = registry.register(Histogram(
+    "powerplant_http_request_duration_seconds", "Duration of the HTTP requests", ("route", "method", "status")))
+stage_duration = registry.register(Histogram(
+    "powerplant_stage_duration_seconds", "Duration of each stage of the requests", ("stage",)))
+solver_calls = registry.register(Histogram(
+    "powerplant_solver_calls", "Calls of get_optimal_power_plants_for_load per request", ("engine",),
+    buckets=COUNT_BUCKETS))
+search_depth = registry.register(Histogram(
+    "powerplant_search_depth", "Deepest recursion of the search per request", ("engine",), buckets=COUNT_BUCKETS))
+incomplete_searches = registry.register(Counter(
+    "powerplant_incomplete_searches_total", "Searches stopped at their limits before proving their dispatch optimal"))
+solver_pool_rejections = registry.register(Counter(
+    "powerplant_solver_pool_rejections_total", "Solves rejected because the solver pool was full"))
+solver_pool_timeouts = registry.register(Counter(
+    "powerplant_solver_pool_timeouts_total", "Solves that exceeded their time budget"))
+
+
+class RequestProfile:
+    """
+    Stage timings and search counters of one request. It is kept per thread, so that the services record into the
+    profile of the request they work for without it being passed around
+    """
+    _current = threading.local()
+
+    def __init__(self, with_cprofile=False):
+        """:param with_cprofile: run the solves of the request under cProfile"""
+        self.with_cprofile = with_cprofile
+        self.cprofile_summary = None
+        self.stages = {}
+        self.solver_calls = {}
+        self.search_depth = {}
+        self.depth = 0
+        # Searches stopped at their limits before proving their dispatch optimal, and the largest of their gaps
+        self.incomplete_searches = 0
+        self.optimality_gap = None
+
+    @classmethod
+    def current(cls):
+        """Profile of the request of the thread, None outside of a request"""
+        return getattr(cls._current, "profile", None)
+
+    @classmethod
+    def start(cls, with_cprofile=False):
+        """Starts the profile of a request in the thread, returning the one it replaces"""
+        previous = cls.current()
+        cls._current.profile = cls(with_cprofile)
+        return previous
+
+    @classmethod
+    def stop(cls, previous=None):
+        profile = cls.current()
+        cls._current.profile = previous
+        return profile
+
+    def merge(self, profile_data):
+        """Adds the data of a profile recorded elsewhere, e.g. in a worker process of the solver pool"""
+        for stage, duration in profile_data["stages"].items():
+            self.stages[stage] = self.stages.get(stage, 0.0) + duration
+        for engine, calls in profile_data["solver_calls"].items():
+            self.solver_calls[engine] = self.solver_calls.get(engine, 0) + calls
+        for engine, depth in profile_data["search_depth"].items():
+            self.search_depth[engine] = max(self.search_depth.get(engine, 0), depth)
+        self.incomplete_searches += profile_data["incomplete_searches"]
+        if profile_data["optimality_gap"] is not None:
+            self.optimality_gap = max(self.optimality_gap or 0.0, profile_data["optimality_gap"])
+
+    def record_incomplete_search(self, optimality_gap):
+        self.incomplete_searches += 1
+        self.optimality_gap = max(self.optimality_gap or 0.0, optimality_gap)
+
+    def as_dict(self):
+        return {"stages": dict(self.stages), "solver_calls": dict(self.solver_calls),
+                "search_depth": dict(self.search_depth), "incomplete_searches": self.incomplete_searches,
+                "optimality_gap": self.optimality_gap}
+
+    def observe(self):
+        """Records the profile into the metrics of the process"""
+        for stage, duration in self.stages.items():
+            stage_duration.observe(duration, stage=stage)
+        for engine, calls in self.solver_calls.items():
+            solver_calls.observe(calls, engine=engine)
+        for engine, depth in self.search_depth.items():
+            search_depth.observe(depth, engine=engine)
+        if self.incomplete_searches:
+            incomplete_searches.inc(self.incomplete_searches)
+
+
+@contextmanager
+def stage(name):
+    """Times the block as a stage of the current request"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile = RequestProfile.current()
+        if profile is not None:
+            profile.stages[name] = profile.stages.get(name, 0.0) + time.perf_counter() - start
+
+
+def count_solver_calls(engine):
+    """
+    Decorator of the get_optimal_power_plants_for_load of a solver engine, counting its calls in the current request
+    and the depth of its recursion
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            profile = RequestProfile.current()
+            if profile is None:
+                return method(*args, **kwargs)
+            profile.solver_calls[engine] = profile.solver_calls.get(engine, 0) + 1
+            profile.depth += 1
+            profile.search_depth[engine] = max(profile.search_depth.get(engine, 0), profile.depth)
+            try:
+                return method(*args, **kwargs)
+            finally:
+                profile.depth -= 1
+        return wrapper
+    return decorator
+
+
+def record_incomplete_search(optimality_gap):
+    """Records in the current request a search stopped at its limits, with the optimality gap of its dispatch"""
+    profile = RequestProfile.current()
+    if profile is not None:
+        profile.record_incomplete_search(optimality_gap)
+
+
+def profiled_call(function, args, with_cprofile=False, lines=25):
+    """
+    Calls the function with the args in a profile of its own, e.g. in a worker process of the solver pool
+    :param with_cprofile: also run the function under cProfile
+    :param lines: number of functions of the cProfile summary, sorted by cumulative time
+    :return: tuple of the return value, the profile data as a dict and the cProfile summary (None without cProfile)
+    """
+    previous = RequestProfile.start()
+    profiler = cProfile.Profile() if with_cprofile else None
+    try:
+        if profiler is None:
+            result = function(*args)
+        else:
+            result = profiler.runcall(function, *args)
+    finally:
+        profile = RequestProfile.stop(previous)
+    summary = None
+    if profiler is not None:
+        stream = io.StringIO()
+        pstats.Stats(profiler, stream=stream).sort_stats("cumulative").print_stats(lines)
+        summary = stream.getvalue()
+    return result, profile.as_dict(), summary
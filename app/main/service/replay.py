@@ -0,0 +1,90 @@
+import sys
+import json
+import logging
+import argparse
+from marshmallow import ValidationError
+from app.main.controller.input_validation import ReplayRecordSchema
+from app.main.model.power_plant import PowerPlantConfigurationError
+from app.main.service import load_calculations
+from app.main.service.dispatch_cache import dispatch_cache
+from app.main.service.fleet_registry import RegisteredFleet
+from app.main.service.metrics import stage
+from app.main.service.solver_pool import SolverTimeoutError
+logger = logging.getLogger("service")
+
+
+def replay_records(lines, engine="dp", cache=dispatch_cache):
+    """
+    Dispatches newline-delimited JSON records one at a time, e.g. years of historical snapshots for a backtest. The
+    lines are read as the results are consumed, so only one record is held in memory at a time
+    :param lines: iterable of the lines (str or bytes) of the records, each a dict of load, fuels and optionally
+    powerplants and id. A record without powerplants is dispatched on those of the last record that has them, which
+    are validated and built once
+    :param engine: name of the solver engine in SOLVER_ENGINES
+    :param cache: DispatchCache of the sorted power plants and responses, None to not cache
+    :return: generator of a result per record: a dict of its line number, its id if any, and either the powerplants
+    (same as load_distributor) or an error, a record that can not be dispatched never stopping the replay
+    """
+    schema = ReplayRecordSchema()
+    registered_fleet = None
+    for line_number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        result = {"line": line_number}
+        try:
+            with stage("validation"):
+                record = schema.loads(line)
+        except ValidationError as err:
+            yield dict(result, error=err.messages)
+            continue
+        except ValueError as err:
+            yield dict(result, error=f"Invalid JSON: {err}")
+            continue
+        if "id" in record:
+            result["id"] = record["id"]
+        if "powerplants" in record:
+            with stage("fleet"):
+                registered_fleet = RegisteredFleet("replay", record["powerplants"])
+        if registered_fleet is None:
+            yield dict(result, error="No powerplants given in this record nor in a previous one")
+            continue
+        try:
+            result["powerplants"] = load_calculations.registered_fleet_load_distributor(
+                registered_fleet, record, engine, cache)
+        except PowerPlantConfigurationError:
+            logger.warning(f"Impossible load {record.get('load')} requested on line {line_number}")
+            result["error"] = f"Load {record.get('load')} cannot be distributed with the current power plants"
+        except (ValueError, SolverTimeoutError) as err:
+            # e.g. a negative wind (%), which the schema lets through. The next records are still dispatched
+            logger.warning(f"Record on line {line_number} could not be dispatched: {err}")
+            result["error"] = str(err)
+        yield result
+
+
+def dump_records(results):
+    """Generator of the NDJSON lines of the results"""
+    for result in results:
+        yield json.dumps(result) + "\n"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Dispatches the NDJSON records of a file, without the server")
+    parser.add_argument("input", help="NDJSON file of the records, - for the standard input")
+    parser.add_argument("output", help="NDJSON file to write the results to, - for the standard output")
+    parser.add_argument("--engine", default="dp", choices=sorted(load_calculations.SOLVER_ENGINES))
+    args = parser.parse_args(argv)
+
+    input_file = sys.stdin if args.input == "-" else open(args.input, "r")
+    output_file = sys.stdout if args.output == "-" else open(args.output, "w")
+    try:
+        output_file.writelines(dump_records(replay_records(input_file, args.engine)))
+    finally:
+        if input_file is not sys.stdin:
+            input_file.close()
+        if output_file is not sys.stdout:
+            output_file.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,283 @@
+import copy
+import logging
+import itertools
+from collections import namedtuple
+import numpy as np
+from app.main.model.fleet import Fleet
+from app.main.model.power_plant import PowerPlantConfigurationError
+from app.main.service.load_calculations import get_solver
+from app.main.service.solver_pool import SolverTimeoutError
+from app.main.service.metrics import stage
+logger = logging.getLogger("service")
+
+# Number of commitments kept after each slot
+BEAM_WIDTH = 32
+# Number of power plants tried to be started, and stopped, from each commitment
+NEIGHBOURS = 3
+# Number of slots the power plants are considered off before the first one, so that they can all be started
+INITIAL_OFF_TIME = 10 ** 6
+
+# Commitment of the power plants after a slot and the path that led to it: the power plants on, for how many slots
+# each one has been on and off, their loads, the cost of the schedule so far and the state of the slot before
+ScheduleState = namedtuple("ScheduleState", ["committed", "on_time", "off_time", "loads", "cost", "startup_cost",
+                                             "previous"])
+
+
+def schedule_calculator(raw_input_data, beam_width=BEAM_WIDTH, engine="bnb"):
+    """
+    Schedules the power plants over the slots of a load profile, e.g. the 96 quarter hours of a day
+    :param raw_input_data: dictionary of loads, fuels, powerplants (with optionally startup_cost, min_up_time,
+    min_down_time and ramp_rate) and optionally fuels_per_slot, a list (one per load) of dictionaries overriding some of
+    the fuels for that slot
+    :param beam_width: number of commitments kept after each slot
+    :param engine: name of the solver engine in SOLVER_ENGINES of the dispatch of each slot alone
+    :return: dict of the cost in euros of the schedule, of which the start-up costs, the number of starts and for each
+    slot its load, cost and list of powerplants with the name and load on each of them, in the order of the request
+    """
+    loads = raw_input_data.get("loads")
+    fuels = raw_input_data.get("fuels", {})
+    fuels_per_slot = raw_input_data.get("fuels_per_slot") or [{}] * len(loads)
+    with stage("fleet"):
+        fleet = Fleet.from_raw_data(raw_input_data.get("powerplants"))
+        fleets_per_slot = [fleet.with_fuels(dict(fuels, **slot_fuels)) for slot_fuels in fuels_per_slot]
+    with stage("dispatch"):
+        states = HorizonScheduler(fleet, beam_width, engine).schedule(loads, fleets_per_slot)
+    with stage("response"):
+        return HorizonScheduler.convert_schedule_as_response(states, loads, fleet)
+
+
+class HorizonScheduler:
+    """
+    Schedules the power plants over several slots, with start-up costs, minimum up and down times and ramp rates.
+    Dynamic programming over time, whose states are the commitments (the power plants that are on) after each slot.
+    From each state, a few commitments of the next slot are tried: the same one, the power plants that must stay on
+    only and the one of the cheapest dispatch of the slot alone, each repaired in merit order until it can deliver the
+    load within the minimum up and down times and ramp limits, then the repaired one with one of the NEIGHBOURS
+    cheapest power plants that are off started or one of the NEIGHBOURS most expensive ones that are on stopped.
+    Each is dispatched in merit order and, with ramps, also with the ramp-limited power plants raised last, so that they
+    can be held low ahead of a drop of the load. The commitments whose minimum up times would hold a coming load below
+    the pmin of the power plants, or below the loads they can ramp down to, are dropped, the paths reaching the same
+    state are merged, keeping the cheapest, and only the beam_width cheapest states are kept after each slot. The
+    schedule is the cheapest among the states kept, not among all of them
+    """
+    # Relative difference below which two loads are considered equal
+    tolerance = 1e-9
+
+    def __init__(self, fleet, beam_width=BEAM_WIDTH, engine="bnb"):
+        """:param fleet: Fleet of the power plants, in the order of the request"""
+        self.fleet = fleet
+        self.beam_width = beam_width
+        self.engine = engine
+
+    def schedule(self, loads, fleets_per_slot):
+        """
+        :param loads: list of the loads of the slots
+        :param fleets_per_slot: list of the fleet with the fuels of each slot set
+        :return: list of the ScheduleState of each slot, along the cheapest schedule
+        """
+        size = len(self.fleet)
+        states = [ScheduleState(committed=np.zeros(size, dtype=bool), on_time=np.zeros(size, dtype=np.int64),
+                                off_time=np.full(size, INITIAL_OFF_TIME, dtype=np.int64), loads=np.zeros(size),
+                                cost=0.0, startup_cost=0.0, previous=None)]
+        # Slots after which a power plant started can still be held on by its minimum up time
+        look_ahead = max(int(self.fleet.min_up_time.max()) - 1, 0) if size else 0
+        solver = get_solver(self.engine, len(loads))
+        for slot, (load, slot_fleet) in enumerate(zip(loads, fleets_per_slot)):
+            future_loads = np.array(loads[slot + 1:slot + 1 + look_ahead], dtype=np.float64)
+            future_pmin = np.array([future_fleet.effective_pmin
+                                    for future_fleet in fleets_per_slot[slot + 1:slot + 1 + look_ahead]]
+                                   ).reshape(len(future_loads), size)
+            merit_order = np.argsort(slot_fleet.cost_per_mwh, kind="stable")
+            merit_order_list = merit_order.tolist()
+            slot_commitment = self.slot_commitment(load, slot_fleet, solver)
+            next_states = {}
+            for state in states:
+                for next_state in self.successors(state, load, slot_fleet, merit_order, merit_order_list,
+                                                  slot_commitment):
+                    if not self.can_meet_future_loads(next_state, future_loads, future_pmin):
+                        continue
+                    key = self.merge_key(next_state)
+                    if key not in next_states or next_state.cost < next_states[key].cost:
+                        next_states[key] = next_state
+            if not next_states:
+                logger.debug(f"Impossible to schedule the load {load} of slot {slot}")
+                raise PowerPlantConfigurationError(f"Impossible to schedule a load of {load} in slot {slot}")
+            states = sorted(next_states.values(), key=lambda next_state: next_state.cost)[:self.beam_width]
+        schedule = [states[0]]
+        while schedule[-1].previous.previous is not None:
+            schedule.append(schedule[-1].previous)
+        return schedule[::-1]
+
+    def can_meet_future_loads(self, state, future_loads, future_pmin):
+        """
+        Whether the power plants held on by their minimum up time after the state can go as low as the next loads,
+        each one down to its pmin or as far as it can ramp down from its load
+        :param future_loads: array of the loads of the next slots
+        :param future_pmin: array of the pmin of each power plant (columns) in each of the next slots (rows)
+        """
+        held_on = np.flatnonzero(state.committed & (state.on_time < self.fleet.min_up_time))
+        if not held_on.size or not future_loads.size:
+            return True
+        offsets = np.arange(len(future_loads))[:, np.newaxis]
+        held_on_later = state.on_time[held_on] + offsets < self.fleet.min_up_time[held_on]
+        lowest = np.maximum(future_pmin[:, held_on],
+                            state.loads[held_on] - self.fleet.ramp_rate[held_on] * (offsets + 1))
+        return bool(((held_on_later * lowest).sum(axis=1) <= future_loads * (1 + self.tolerance)).all())
+
+    def merge_key(self, state):
+        """
+        States of the same key have the same future: the same power plants on, which still must stay on or off and
+        for how long. Only the cheapest one of them is kept. Their loads may differ, which only matters with ramps
+        """
+        return (state.committed.tobytes(), np.minimum(state.on_time, self.fleet.min_up_time).tobytes(),
+                np.minimum(state.off_time, self.fleet.min_down_time).tobytes())
+
+    def slot_commitment(self, load, slot_fleet, solver):
+        """
+        Commitment of the cheapest dispatch of the load of the slot alone, as if there were no start-up costs, minimum
+        up and down times or ramps
+        :param solver: solver of the engine, from get_solver
+        :return: array of bool of the power plants on, None if the load can not be distributed or no dispatch was found
+        within the time limit of the solver, the other commitments being tried anyway
+        """
+        sorted_fleet = copy.copy(slot_fleet)
+        sorted_fleet.sort()
+        try:
+            distributed_load = solver.get_optimal_power_plants_for_load(load, sorted_fleet)
+        except (PowerPlantConfigurationError, SolverTimeoutError):
+            return None
+        commitment = np.zeros(len(self.fleet), dtype=bool)
+        for power_plant, load_on_power_plant in distributed_load.items():
+            commitment[self.fleet.index_of(power_plant.name)] = load_on_power_plant > 0
+        return commitment
+
+    def successors(self, state, load, slot_fleet, merit_order, merit_order_list, slot_commitment=None):
+        """ScheduleState of each commitment tried for the slot after the state"""
+        pmin, pmax = slot_fleet.effective_pmin, slot_fleet.effective_pmax
+        ramp_rate = self.fleet.ramp_rate
+        # Limits of the power plants for the slot if on: within the ramp of their previous load, or of 0 when started
+        lower = np.where(state.committed, np.maximum(pmin, state.loads - ramp_rate), pmin)
+        upper = np.minimum(pmax, np.where(state.committed, state.loads + ramp_rate, np.maximum(pmin, ramp_rate)))
+        usable = (pmax > 0) & (lower <= upper * (1 + self.tolerance))
+        must_stay_on = state.committed & (state.on_time < self.fleet.min_up_time)
+        if (must_stay_on & ~usable).any():
+            return []
+        free = usable & ~must_stay_on & (state.committed | (state.off_time >= self.fleet.min_down_time))
+
+        # Lists of floats, faster than arrays to walk through one power plant at a time
+        lower_list, upper_list, free_list = lower.tolist(), upper.tolist(), free.tolist()
+        committed = state.committed & usable
+        repaired = self.repair(committed, load, lower_list, upper_list, free_list, merit_order_list)
+        tried = [must_stay_on]
+        if slot_commitment is not None:
+            tried.append((slot_commitment & free) | must_stay_on)
+        # The power plants are switched from the repaired commitment, and the repair must leave them as they are
+        base = committed if repaired is None else repaired
+        off = merit_order[(free & ~base)[merit_order]].tolist()
+        on = merit_order[(free & base)[merit_order]].tolist()
+        switched = off[:NEIGHBOURS] + on[::-1][:NEIGHBOURS]
+
+        commitments = [repaired]
+        commitments.extend(self.repair(commitment, load, lower_list, upper_list, free_list, merit_order_list)
+                           for commitment in tried)
+        commitments.extend(self.repair(self.switched(base, index), load, lower_list, upper_list,
+                                       self.switched(free_list, index), merit_order_list) for index in switched)
+
+        ramp_limited = np.isfinite(ramp_rate)
+        held_low_order = np.concatenate((merit_order[~ramp_limited[merit_order]],
+                                         merit_order[ramp_limited[merit_order]]))
+        successors, seen, room = [], set(), upper - lower
+        for commitment in commitments:
+            if commitment is None or commitment.tobytes() in seen:
+                continue
+            seen.add(commitment.tobytes())
+            successors.append(self.dispatch(state, commitment, load, lower, room, slot_fleet, merit_order))
+            if (commitment & ramp_limited).any():
+                held_low = self.dispatch(state, commitment, load, lower, room, slot_fleet, held_low_order)
+                if not np.array_equal(held_low.loads, successors[-1].loads):
+                    successors.append(held_low)
+        return successors
+
+    @staticmethod
+    def switched(values, index):
+        """Copy of the array or list of bool with the value at the index switched"""
+        values = values.copy()
+        values[index] = not values[index]
+        return values
+
+    def repair(self, commitment, load, lower, upper, free, merit_order):
+        """
+        Starts the cheapest free power plants whose minimum still fits in the load until the commitment can deliver it.
+        If its minimum is above the load, the most expensive free ones are stopped first. If none fits, the most
+        expensive one that can not be lowered is stopped to make room
+        :return: array of bool of the power plants on, None if the load can not be delivered from the commitment
+        """
+        commitment = commitment.tolist()
+        capacity = sum(itertools.compress(upper, commitment))
+        minimum = sum(itertools.compress(lower, commitment))
+        if minimum > load * (1 + self.tolerance):
+            for index in reversed(merit_order):
+                if minimum <= load * (1 + self.tolerance):
+                    break
+                if free[index] and commitment[index]:
+                    commitment[index] = False
+                    capacity -= upper[index]
+                    minimum -= lower[index]
+        stopped = set()
+        while True:
+            for index in merit_order:
+                if capacity >= load * (1 - self.tolerance):
+                    break
+                if free[index] and not commitment[index] and index not in stopped and \
+                        minimum + lower[index] <= load * (1 + self.tolerance):
+                    commitment[index] = True
+                    capacity += upper[index]
+                    minimum += lower[index]
+            if capacity >= load * (1 - self.tolerance):
+                break
+            # No power plant fits in the load left: make room by stopping the most expensive one that can not be
+            # lowered, e.g. a wind turbine
+            rigid = [index for index in reversed(merit_order)
+                     if free[index] and commitment[index] and lower[index] >= upper[index]]
+            if not rigid:
+                return None
+            commitment[rigid[0]] = False
+            capacity -= upper[rigid[0]]
+            minimum -= lower[rigid[0]]
+            stopped.add(rigid[0])
+        if capacity < load * (1 - self.tolerance) or minimum > load * (1 + self.tolerance):
+            return None
+        return np.array(commitment)
+
+    def dispatch(self, state, commitment, load, lower, room, slot_fleet, merit_order):
+        """
+        ScheduleState of the commitment after the state, the power plants on being raised in the order given
+        :param room: array of the load each power plant can be raised by above its lower limit
+        :param merit_order: array of the indices of the power plants, in the order they are raised
+        """
+        loads = lower * commitment
+        room = (room * commitment)[merit_order]
+        raised = np.minimum(np.maximum(load - loads.sum() - (np.cumsum(room) - room), 0), room)
+        loads[merit_order] += raised
+        startup_cost = float(np.dot(self.fleet.startup_cost, commitment & ~state.committed))
+        # The time on of the power plants that are off is 0, and the time off of the ones that are on
+        return ScheduleState(committed=commitment,
+                             on_time=(state.on_time + 1) * commitment,
+                             off_time=(state.off_time + 1) * ~commitment,
+                             loads=loads,
+                             cost=state.cost + float(loads @ slot_fleet.cost_per_mwh) + startup_cost,
+                             startup_cost=state.startup_cost + startup_cost,
+                             previous=state)
+
+    @staticmethod
+    def convert_schedule_as_response(states, loads, fleet):
+        """Converts the states of the schedule to the response expected"""
+        slots, previous_cost, starts = [], 0.0, 0
+        for state, load in zip(states, loads):
+            starts += int((state.committed & ~state.previous.committed).sum())
+            slots.append({"load": load,
+                          "cost": state.cost - previous_cost,
+                          "powerplants": [{"name": name, "p": round(float(load_on_power_plant), 10)}
+                                          for name, load_on_power_plant in zip(fleet.names, state.loads)]})
+            previous_cost = state.cost
+        return {"cost": states[-1].cost, "startup_cost": states[-1].startup_cost, "starts": starts, "slots": slots}
@@ -0,0 +1,115 @@
+import logging
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from app.main.service import metrics
+logger = logging.getLogger("service")
+
+
+class SolverPoolBusyError(Exception):
+    """Raised when the pool already has as many solves pending as it accepts"""
+
+
+class SolverTimeoutError(Exception):
+    """Raised when a solve does not finish within the time budget"""
+
+
+class SolverPool:
+    """
+    Runs the solves in a pool of worker processes, so that a CPU-bound solve neither blocks the other requests nor
+    the thread of its own request beyond its time budget.
+    At most max_pending solves are queued or running at once: further ones are rejected straight away.
+    A solve that exceeds its budget is cancelled if it has not started. Once running, it can not be interrupted and
+    keeps its place in the pool until it finishes
+    """
+    def __init__(self, max_workers=1, max_pending=4, timeout=10):
+        """
+        :param max_workers: number of worker processes, 0 to solve in the thread of the request without time budget
+        :param max_pending: maximum number of solves queued or running at once
+        :param timeout: default time budget of a solve in seconds
+        """
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self._pending = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+        # Started on the first solve, so that no process is created before the app is forked by the WSGI server
+        self._executor = None
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config["SOLVER_WORKERS"], config["SOLVER_MAX_PENDING"], config["SOLVER_TIMEOUT"])
+
+    def run(self, function, *args, timeout=None):
+        """
+        Calls the function with the args in a worker process and waits for its result
+        :param function: function of a module, as it is pickled to the worker
+        :param timeout: time budget in seconds, None for the default one of the pool
+        :return: return value of the function. Its exceptions are raised again here
+        """
+        if not self._pending.acquire(blocking=False):
+            logger.warning(f"Rejecting solve, {self.max_pending} solves are already pending")
+            metrics.solver_pool_rejections.inc()
+            raise SolverPoolBusyError(f"The server is already solving {self.max_pending} requests, try again later")
+        profile = metrics.RequestProfile.current()
+        with_cprofile = profile is not None and profile.with_cprofile
+        if not self.max_workers:
+            try:
+                return self.merge_profile(profile, metrics.profiled_call(function, args, with_cprofile))
+            finally:
+                self._pending.release()
+        try:
+            # The function runs in a profile of its own in the worker, which is merged into the one of the request
+            future = self.get_executor().submit(metrics.profiled_call, function, args, with_cprofile)
+        except BrokenProcessPool:
+            self._pending.release()
+            self.shutdown(wait=False)
+            raise
+        except Exception:
+            self._pending.release()
+            raise
+        timeout = self.timeout if timeout is None else timeout
+        # Released here once the result is in, rather than by a callback of the future that may run after the caller
+        # has already answered and sent the next solve
+        still_running = False
+        try:
+            return self.merge_profile(profile, future.result(timeout=timeout))
+        except BrokenProcessPool:
+            # A worker died (e.g. killed when out of memory). The next solve starts a new pool
+            logger.error("A worker of the solver pool died, restarting the pool")
+            self.shutdown(wait=False)
+            raise
+        except TimeoutError:
+            metrics.solver_pool_timeouts.inc()
+            still_running = not future.cancel()
+            logger.warning(f"Solve exceeded its time budget of {timeout} s" +
+                           (", it keeps running in its worker" if still_running else ""))
+            if still_running:
+                # It keeps its place until it finishes
+                future.add_done_callback(lambda _: self._pending.release())
+            raise SolverTimeoutError(f"The solve did not finish within its time budget of {timeout} s")
+        finally:
+            if not still_running:
+                self._pending.release()
+
+    @staticmethod
+    def merge_profile(profile, profiled_result):
+        """Merges the profile of the solve into the one of the request, if any, and returns the result of the solve"""
+        result, profile_data, cprofile_summary = profiled_result
+        if profile is not None:
+            profile.merge(profile_data)
+            profile.cprofile_summary = cprofile_summary
+        return result
+
+    def get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                logger.info(f"Starting solver pool of {self.max_workers} processes")
+                self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+            return self._executor
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=wait)
+                self._executor = None
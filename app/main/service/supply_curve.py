@@ -0,0 +1,213 @@
+import bisect
+import logging
+from collections import namedtuple
+import numpy as np
+from app.main.model.fleet import Fleet
+from app.main.model.power_plant import PowerPlantConfigurationError
+from app.main.service.dispatch_cache import dispatch_cache, DispatchCache
+from app.main.service.unit_commitment import DynamicProgrammingCore
+from app.main.service.metrics import stage
+logger = logging.getLogger("service")
+
+# Range of loads over which the same power plants are on and only the marginal one changes its load
+CurveSegment = namedtuple("CurveSegment", ["load_from", "load_to", "cost_from", "marginal_price",
+                                           "marginal_powerplant", "powerplants_on"])
+
+
+def supply_curve_calculator(raw_input_data, cache=dispatch_cache):
+    """
+    Obtains the raw_input_data, builds the supply curve of the powerplants and evaluates it at the requested loads
+    :param raw_input_data: dictionary of fuels, powerplants and optionally loads
+    :param cache: DispatchCache keeping the curves already built, None to always build the curve
+    :return: dict with the segments of the curve and, for each requested load, its cost, marginal price and cost per MW
+    """
+    supply_curve = None
+    if cache is not None:
+        fingerprint = DispatchCache.fingerprint(raw_input_data.get("powerplants"), raw_input_data.get("fuels", {}))
+        supply_curve = cache.curves.get(fingerprint)
+    if supply_curve is None:
+        with stage("curve"):
+            supply_curve = SupplyCurve.get_supply_curve_from_raw_data(raw_input_data)
+        if cache is not None:
+            cache.curves.put(fingerprint, supply_curve)
+    evaluated_loads = []
+    for load in raw_input_data.get("loads", []):
+        try:
+            evaluated_loads.append(supply_curve.evaluate(load))
+        except PowerPlantConfigurationError:
+            evaluated_loads.append({"load": load,
+                                    "error": f"Load {load} cannot be distributed with the current power plants"})
+    return {"segments": supply_curve.convert_segments_as_response(), "loads": evaluated_loads}
+
+
+class SupplyCurve:
+    """
+    Cheapest cost of a fleet as a function of the load, from 0 to the capacity of the fleet.
+    Between two changes of the power plants that are on, the cost is linear in the load. The curve is built once
+    from the cost tables of the DynamicProgrammingCore and is then answered with a binary search over its segments
+    """
+    # Relative difference below which a cost is considered on the line of a segment
+    tolerance = 1e-9
+
+    @classmethod
+    def get_supply_curve_from_raw_data(cls, raw_input_data, core=None):
+        fleet = Fleet.from_raw_data(raw_input_data.get("powerplants"))
+        fleet.set_fuels(raw_input_data.get("fuels", {}))
+        fleet.sort()
+        return cls(fleet, core)
+
+    def __init__(self, sorted_fleet, core=None):
+        """
+        :param sorted_fleet: Fleet with its fuels set, sorted by cost
+        :param core: DynamicProgrammingCore building the cost tables. Its grid always contains the whole MWs
+        :raises GridTooLargeError: the grid up to the capacity of the fleet exceeds the cells budget of the core
+        """
+        logger.info("Building supply curve")
+        self.fleet = sorted_fleet
+        self.core = core or DynamicProgrammingCore()
+        self.resolution = self.core.resolution or self.core.determine_resolution([1], sorted_fleet)
+        cost_tables = self.core.build_cost_tables(sorted_fleet, self.resolution)
+        # Largest shift of the loads of a segment by the fixed output power plants off the grid
+        self.max_shift = sum(abs(power - round(power / self.resolution) * self.resolution)
+                             for power in cost_tables.fixed_power.values())
+        self.segments = self.build_segments(self.core, cost_tables)
+        self.breakpoints = [segment.load_from for segment in self.segments]
+
+    def build_segments(self, core, cost_tables):
+        """
+        Walks along the loads of the grid. The dispatch of the first load of a segment stays the cheapest, moving
+        only the marginal power plant, as long as the costs follow its marginal price and it has room left
+        :return: list of CurveSegment sorted by load
+        """
+        optimal_costs = cost_tables.optimal_costs()
+        feasible = np.isfinite(optimal_costs)
+        segments = []
+        load_steps = 0
+        while load_steps < optimal_costs.size:
+            if not feasible[load_steps]:
+                next_feasible = np.flatnonzero(feasible[load_steps:])
+                if not next_feasible.size:
+                    break
+                load_steps += int(next_feasible[0])
+                continue
+            steps_per_plant, marginal_index = core.backtrack(cost_tables, [load_steps])[0]
+            segment_steps = 0
+            if marginal_index is not None:
+                room_left = cost_tables.pmax_steps[marginal_index] - steps_per_plant[marginal_index]
+                costs_on_line = (optimal_costs[load_steps] +
+                                 cost_tables.cost_per_step[marginal_index] * np.arange(1, room_left + 1))
+                costs = optimal_costs[load_steps + 1:load_steps + room_left + 1]
+                on_line = np.abs(costs - costs_on_line[:costs.size]) <= self.tolerance * (1 + np.abs(costs))
+                segment_steps = costs.size if on_line.all() else int(np.argmin(on_line))
+            segments.append(self.convert_to_segment(cost_tables, load_steps, load_steps + segment_steps,
+                                                    optimal_costs[load_steps], steps_per_plant, marginal_index))
+            load_steps += segment_steps + 1
+        # The fixed output power plants off the grid shift the loads of the segments they are on in
+        return sorted(segments, key=lambda segment: segment.load_from)
+
+    @staticmethod
+    def convert_to_segment(cost_tables, first_steps, last_steps, cost_from, steps_per_plant, marginal_index):
+        """
+        Segment of the loads first_steps..last_steps of the grid. The fixed output power plants on and off the grid
+        deliver their actual output, the loads and cost of the segment being shifted by the difference
+        """
+        marginal_power_plant = None if marginal_index is None else cost_tables.plants[marginal_index]
+        powerplants_on, load_shift, cost_shift = {}, 0.0, 0.0
+        for plant_number, steps in sorted(steps_per_plant.items()):
+            power_plant = cost_tables.plants[plant_number]
+            power = steps * cost_tables.resolution
+            if plant_number in cost_tables.fixed_power:
+                load_shift += cost_tables.fixed_power[plant_number] - power
+                cost_shift += (cost_tables.fixed_power[plant_number] - power) * power_plant.cost_per_mwh()
+                power = cost_tables.fixed_power[plant_number]
+            powerplants_on[power_plant.name] = round(power, 10)
+        return CurveSegment(
+            load_from=round(first_steps * cost_tables.resolution + load_shift, 10),
+            load_to=round(last_steps * cost_tables.resolution + load_shift, 10),
+            cost_from=float(cost_from + cost_shift),
+            marginal_price=None if marginal_power_plant is None else marginal_power_plant.cost_per_mwh(),
+            marginal_powerplant=None if marginal_power_plant is None else marginal_power_plant.name,
+            powerplants_on=powerplants_on)
+
+    def get_segment(self, load):
+        """
+        Segment of the curve containing the load, found by binary search. Loads between two segments, less than a
+        step of the grid apart, are rounded to the closest load of the grid. When the segments are shifted by fixed
+        output power plants off the grid, they may overlap, the cheapest one containing the load being kept, and the
+        loads between them are dispatched alone, in a segment of their own
+        """
+        segment_number = bisect.bisect_right(self.breakpoints, load) - 1
+        if self.max_shift:
+            return self.get_shifted_segment(load, segment_number)
+        if segment_number >= 0 and load <= self.segments[segment_number].load_to:
+            return self.segments[segment_number]
+        rounded_load = round(load / self.resolution) * self.resolution
+        segment_number = bisect.bisect_right(self.breakpoints, rounded_load + self.resolution / 2) - 1
+        if segment_number >= 0 and rounded_load <= self.segments[segment_number].load_to + self.resolution / 2:
+            return self.segments[segment_number]
+        logger.debug(f"Impossible to have a configuration with load {load}")
+        raise PowerPlantConfigurationError(f"Impossible to have a configuration with a load of {load}")
+
+    def get_shifted_segment(self, load, segment_number):
+        """
+        Cheapest segment containing the load among the ones starting before it. Their loads being shifted by at most
+        max_shift from a grid where they do not overlap, the ones before the first ending below load - 2 * max_shift
+        can not contain it
+        """
+        containing = []
+        while segment_number >= 0 and self.segments[segment_number].load_to >= load - 2 * self.max_shift:
+            if load <= self.segments[segment_number].load_to:
+                containing.append(self.segments[segment_number])
+            segment_number -= 1
+        if containing:
+            return min(containing, key=lambda segment: segment.cost_from + (segment.marginal_price or 0) *
+                       self.load_in_segment(segment, load))
+        distributed_load = self.core.get_optimal_power_plants_for_load(load, self.fleet)
+        on = {power_plant: power for power_plant, power in distributed_load.items() if power > 0}
+        marginal_power_plant = max((power_plant for power_plant, power in on.items()
+                                    if power < power_plant.max_power_when_on()),
+                                   key=lambda power_plant: power_plant.cost_per_mwh(), default=None)
+        return CurveSegment(
+            load_from=load, load_to=load,
+            cost_from=sum(power_plant.cost_euros_per_load(power) for power_plant, power in on.items()),
+            marginal_price=None if marginal_power_plant is None else marginal_power_plant.cost_per_mwh(),
+            marginal_powerplant=None if marginal_power_plant is None else marginal_power_plant.name,
+            powerplants_on={power_plant.name: round(power, 10) for power_plant, power in on.items()})
+
+    def cost(self, load):
+        """Cheapest cost in euros of the load"""
+        segment = self.get_segment(load)
+        return segment.cost_from + (segment.marginal_price or 0) * self.load_in_segment(segment, load)
+
+    def marginal_price(self, load):
+        """Cost in euros of the next MWh at that load, None if no power plant on can deliver more"""
+        return self.get_segment(load).marginal_price
+
+    def dispatch(self, load):
+        """dict of the load on each power plant that is on (key=name) for the cheapest configuration"""
+        segment = self.get_segment(load)
+        dispatch = dict(segment.powerplants_on)
+        if segment.marginal_powerplant is not None:
+            dispatch[segment.marginal_powerplant] = round(dispatch[segment.marginal_powerplant] +
+                                                          self.load_in_segment(segment, load), 10)
+        return dispatch
+
+    @staticmethod
+    def load_in_segment(segment, load):
+        """Load above the start of the segment, the load being kept within the segment"""
+        return min(max(load, segment.load_from), segment.load_to) - segment.load_from
+
+    def evaluate(self, load):
+        """Cost, marginal price and cost per MW of the load, as expected in the response"""
+        cost = self.cost(load)
+        return {"load": load,
+                "cost": cost,
+                "marginal_price": self.marginal_price(load),
+                "cost_per_mw": cost / load if load else None}
+
+    def convert_segments_as_response(self):
+        """Converts the segments to the response expected i.e list of dicts"""
+        return [dict(segment._asdict(), powerplants_on=[{"name": name, "p": load_on_power_plant}
+                                                        for name, load_on_power_plant in
+                                                        segment.powerplants_on.items()])
+                for segment in self.segments]
@@ -0,0 +1,444 @@
+import logging
+from collections import namedtuple
+import numpy as np
+from app.main.config import Config
+from app.main.model.fleet import Fleet
+from app.main.model.power_plant import PowerPlantConfigurationError
+from app.main.service.branch_and_bound import BranchAndBoundCore
+from app.main.service.metrics import count_solver_calls
+logger = logging.getLogger("service")
+
+# Choices of a power plant over the window of loads first..first+size-1 of the grid it was walked through, each a
+# mask of packed bits: reaching the load with it at pmin after the marginal one, as the marginal one, or at pmax
+PlantChoices = namedtuple("PlantChoices", ["first", "size", "pmin", "marginal", "pmax"])
+
+
+class GridTooLargeError(ValueError):
+    """Raised when the cost tables would exceed the cells budget of the DynamicProgrammingCore"""
+
+
+class DynamicProgrammingCore:
+    """
+    Exact load distribution by dynamic programming over the load, discretised in steps of `resolution` MW.
+    Has the same interface as the LoadCalculatorCore, so both can be selected by the LoadCalculationInterface
+    """
+    # Finest step in MW. Loads and power plant limits are rounded to this grid
+    base_resolution = 0.01
+    # Cost difference, relative to the most expensive possible dispatch, below which two configurations are
+    # considered equally expensive
+    tolerance = 1e-12
+
+    def __init__(self, resolution=None, max_cells=None, time_limit=None):
+        """
+        :param resolution: step in MW of the load grid. If None, the coarsest step representing exactly the load
+        and the limits of all power plants is used (the smaller the step, the larger the grid)
+        :param max_cells: largest number of power plants times loads of the grid, DP_MAX_CELLS of the config if None.
+        Past it, the loads are distributed by the BranchAndBoundCore instead
+        :param time_limit: time limit in seconds of the searches of the BranchAndBoundCore past the max_cells,
+        None for no limit
+        """
+        self.resolution = resolution
+        self.max_cells = Config.DP_MAX_CELLS if max_cells is None else max_cells
+        self.time_limit = time_limit
+
+    @count_solver_calls("dp")
+    def get_optimal_power_plants_for_load(self, load, sorted_power_plants):
+        """
+        NOTE: Unit conversion is not handled here
+        Obtains a dict (key=powerplant, value=load on it) which is going to cost the least in euros.
+        For a fixed set of power plants that are on, the cheapest dispatch is known: the plants cheaper than
+        one marginal power plant run at pmax, the ones more expensive than it run at pmin, and the marginal one
+        covers the rest. So walking through the plants in merit order, two cost tables are kept over the load grid:
+        a) cheapest cost of reaching the load with the plants seen so far at pmax (before the marginal plant)
+        b) cheapest cost of reaching the load once the marginal plant is chosen, plants after it being at pmin
+        Time is O(number of power plants * load / resolution), and so is the memory of the choices, in bits. Past
+        max_cells, the load is distributed by the BranchAndBoundCore
+        :param load: int, load required to be distributed among power plants available on the grid
+        :param sorted_power_plants: list of sorted power plant instances
+        :return: dict of powerplants which are the most optimal (least cost in euros)
+        """
+        power_plants_to_use = self.get_optimal_power_plants_for_loads([load], sorted_power_plants)[0]
+        if power_plants_to_use is None:
+            logger.debug(f"Impossible to have a configuration with load {load}")
+            raise PowerPlantConfigurationError(f"Impossible to have a configuration with a load of {load}")
+        return power_plants_to_use
+
+    def get_optimal_power_plants_for_loads(self, loads, sorted_power_plants):
+        """
+        Same as get_optimal_power_plants_for_load for several loads, sharing the cost tables between them
+        :param loads: list of int, loads required to be distributed among power plants available on the grid
+        :param sorted_power_plants: list of sorted power plant instances
+        :return: list of dict of powerplants which are the most optimal for each load,
+        None for the loads which can not be distributed
+        """
+        resolution = self.resolution or self.determine_resolution(loads, sorted_power_plants)
+        steps_per_load = [int(round(load / resolution)) for load in loads]
+        try:
+            cost_tables = self.build_cost_tables(sorted_power_plants, resolution, min(steps_per_load),
+                                                 max(steps_per_load))
+        except GridTooLargeError as err:
+            logger.info(f"{err}: distributing the loads by branch and bound")
+            return BranchAndBoundCore(time_limit=self.time_limit).get_optimal_power_plants_for_loads(
+                loads, sorted_power_plants)
+        dispatches, unsolved_loads = [], {}
+        for load_number, dispatch in enumerate(self.backtrack(cost_tables, steps_per_load)):
+            if dispatch is not None:
+                power_per_plant = cost_tables.convert_to_power(*dispatch)
+                if power_per_plant is None:
+                    unsolved_loads[load_number] = loads[load_number]
+                else:
+                    dispatch = {cost_tables.plants[plant_number]: power
+                                for plant_number, power in power_per_plant.items()}
+            dispatches.append(dispatch)
+        if unsolved_loads:
+            logger.info(f"No power plant on can take the actual output of the fixed output power plants snapped to the "
+                        f"grid: distributing {len(unsolved_loads)} loads by branch and bound")
+            for load_number, dispatch in zip(unsolved_loads, BranchAndBoundCore(
+                    time_limit=self.time_limit).get_optimal_power_plants_for_loads(list(unsolved_loads.values()),
+                                                                                   sorted_power_plants)):
+                dispatches[load_number] = dispatch
+        return dispatches
+
+    def build_cost_tables(self, sorted_power_plants, resolution, smallest_load_steps=0, largest_load_steps=None):
+        """
+        Walks through the power plants in merit order to fill the cost tables, for the loads of the grid up to
+        largest_load_steps (None for the capacity of the power plants). The entries that do not lead to a load between
+        smallest_load_steps and largest_load_steps are not kept up to date
+        :return: CostTables
+        :raises GridTooLargeError: the power plants times the loads of the grid exceed the max_cells
+        """
+        cost_tables = CostTables(*self.discretize_power_plants(sorted_power_plants, resolution), resolution,
+                                 self.tolerance)
+        # Loads above the capacity of the power plants can not be distributed, no need to grow the tables for them
+        if largest_load_steps is None:
+            largest_load_steps = cost_tables.capacity
+        smallest_load_steps = min(smallest_load_steps, cost_tables.capacity)
+        largest_load_steps = min(largest_load_steps, cost_tables.capacity)
+        cells = len(cost_tables.plants) * (largest_load_steps + 1)
+        if cells > self.max_cells:
+            raise GridTooLargeError(f"The grid of {len(cost_tables.plants)} power plants and {largest_load_steps + 1} "
+                                    f"loads in steps of {resolution} MW exceeds {self.max_cells} cells")
+        cost_tables.resize(largest_load_steps + 1)
+        cost_at_pmax, cost_after_marginal = cost_tables.cost_at_pmax, cost_tables.cost_after_marginal
+
+        capacity_so_far, capacity_left = 0, cost_tables.capacity
+        for index in range(len(cost_tables.plants)):
+            pmin, pmax = cost_tables.pmin_steps[index], cost_tables.pmax_steps[index]
+            cost = cost_tables.cost_per_step[index]
+            if index % cost_tables.checkpoint_interval == 0:
+                cost_tables.checkpoints[index] = cost_at_pmax.copy()
+            capacity_so_far += pmax
+            capacity_left -= pmax
+            # Loads the plants seen so far can not reach, or from which the loads can not be reached anymore
+            # are not worth updating
+            first, last = max(0, smallest_load_steps - capacity_left), min(largest_load_steps, capacity_so_far)
+            if first > last:
+                continue
+            window = slice(first, last + 1)
+
+            at_pmin = self.shift_costs(cost_after_marginal, pmin, cost, first, last)
+            took_pmin = cost_tables.improves(at_pmin, cost_after_marginal[window])
+            cost_after_marginal[window] = np.where(took_pmin, at_pmin, cost_after_marginal[window])
+
+            at_pmax = self.shift_costs(cost_at_pmax, pmax, cost, first, last)
+            if pmin == pmax:
+                as_marginal = at_pmax
+            else:
+                as_marginal = self.marginal_costs(cost_at_pmax, pmin, pmax, cost, first, last)
+            took_marginal = cost_tables.improves(as_marginal, cost_after_marginal[window])
+            cost_after_marginal[window] = np.where(took_marginal, as_marginal, cost_after_marginal[window])
+
+            took_pmax = cost_tables.improves(at_pmax, cost_at_pmax[window])
+            cost_at_pmax[window] = np.where(took_pmax, at_pmax, cost_at_pmax[window])
+            cost_tables.record_choices(index, first, took_pmin, took_marginal, took_pmax)
+        return cost_tables
+
+    def backtrack(self, cost_tables, steps_per_load):
+        """
+        Finds the cheapest dispatch of each load from the cost tables
+        :param cost_tables: CostTables filled up to the largest of the loads
+        :param steps_per_load: list of loads, in steps of the resolution of the cost tables
+        :return: list with for each load None if it can not be distributed, else a tuple of the dict of the steps
+        delivered by each power plant (key=position in cost_tables.plants) and the position of the marginal power
+        plant (None if all power plants on are at pmax)
+        """
+        plants = cost_tables.plants
+        # Walk back through the plants after the marginal one (at pmin) for every load
+        steps_per_plant, remaining_steps, marginal_index = [], [], []
+        for load_steps in steps_per_load:
+            steps_of_dispatch, index = {}, len(plants) - 1
+            optimal_cost = cost_tables.optimal_cost(load_steps)
+            if np.isinf(optimal_cost):
+                steps_of_dispatch = None
+            elif optimal_cost < cost_tables.cost_at_pmax[load_steps]:
+                while not cost_tables.took("marginal", index, load_steps):
+                    if cost_tables.took("pmin", index, load_steps):
+                        steps_of_dispatch[index] = cost_tables.pmin_steps[index]
+                        load_steps -= cost_tables.pmin_steps[index]
+                    index -= 1
+            else:
+                index = None
+            steps_per_plant.append(steps_of_dispatch)
+            remaining_steps.append(load_steps)
+            marginal_index.append(index)
+
+        self.backtrack_marginal_loads(cost_tables, steps_per_plant, remaining_steps, marginal_index)
+
+        # Walk back through the plants before the marginal one (at pmax)
+        dispatches = []
+        for load_number, steps_of_dispatch in enumerate(steps_per_plant):
+            if steps_of_dispatch is None:
+                dispatches.append(None)
+                continue
+            load_steps = remaining_steps[load_number]
+            index = len(plants) - 1 if marginal_index[load_number] is None else marginal_index[load_number] - 1
+            while index >= 0:
+                if cost_tables.took("pmax", index, load_steps):
+                    steps_of_dispatch[index] = cost_tables.pmax_steps[index]
+                    load_steps -= cost_tables.pmax_steps[index]
+                index -= 1
+            dispatches.append((steps_of_dispatch, marginal_index[load_number]))
+        return dispatches
+
+    def backtrack_with_fixed_outputs(self, cost_tables, fixed_steps, load_steps):
+        """
+        Finds the cheapest dispatch of the load by the power plants of the cost tables and fixed output power plants
+        left out of them (e.g. the wind turbines, whose output changes with the wind). They cost nothing, so it is the
+        cheapest over the sums some of them deliver of the cheapest cost of the cost tables for the rest of the load
+        :param cost_tables: CostTables filled up to the load
+        :param fixed_steps: array of the output of each fixed output power plant, in steps of the resolution
+        :param load_steps: load in steps of the resolution
+        :return: None if the load can not be distributed, else a tuple of the dispatch of the power plants of the
+        cost tables (same as backtrack) and the mask of the fixed output power plants on
+        """
+        # Sums reachable with the first fixed output power plants, one row per power plant added
+        reachable = np.zeros((fixed_steps.size + 1, load_steps + 1), dtype=bool)
+        reachable[0, 0] = True
+        for number, steps in enumerate(fixed_steps):
+            reachable[number + 1] = reachable[number]
+            if steps <= load_steps:
+                reachable[number + 1, steps:] |= reachable[number, :load_steps + 1 - steps]
+        # Cheapest cost of the cost tables for the load left by each reachable sum, the largest sum being kept among
+        # equal costs
+        costs = np.full(load_steps + 1, np.inf)
+        optimal_costs = cost_tables.optimal_costs()[:load_steps + 1]
+        costs[:optimal_costs.size] = optimal_costs
+        costs[~reachable[-1, ::-1]] = np.inf
+        table_steps = int(np.argmin(costs))
+        if np.isinf(costs[table_steps]):
+            return None
+        fixed_on = np.zeros(fixed_steps.size, dtype=bool)
+        fixed_sum = load_steps - table_steps
+        for number in range(fixed_steps.size, 0, -1):
+            if not reachable[number - 1, fixed_sum]:
+                fixed_sum -= fixed_steps[number - 1]
+                fixed_on[number - 1] = True
+        return self.backtrack(cost_tables, [table_steps])[0], fixed_on
+
+    def backtrack_marginal_loads(self, cost_tables, steps_per_plant, remaining_steps, marginal_index):
+        """
+        Finds the load on the marginal power plant of each dispatch by rebuilding the cost table of the cheaper plants
+        at pmax, once for all the loads, from the last checkpoint before the first marginal power plant.
+        The dispatches and their remaining steps are updated in place
+        """
+        loads_per_marginal_index = {}
+        for load_number, index in enumerate(marginal_index):
+            if steps_per_plant[load_number] is not None and index is not None:
+                loads_per_marginal_index.setdefault(index, []).append(load_number)
+        if not loads_per_marginal_index:
+            return
+        largest_load = max(remaining_steps[load_number] for load_numbers in loads_per_marginal_index.values()
+                           for load_number in load_numbers)
+        first_index = min(loads_per_marginal_index)
+        first_index -= first_index % cost_tables.checkpoint_interval
+        cost_at_pmax = cost_tables.checkpoints[first_index][:largest_load + 1].copy()
+        for index in range(first_index, max(loads_per_marginal_index) + 1):
+            pmin, pmax = cost_tables.pmin_steps[index], cost_tables.pmax_steps[index]
+            cost = cost_tables.cost_per_step[index]
+            for load_number in loads_per_marginal_index.get(index, []):
+                load_steps = remaining_steps[load_number]
+                candidate_steps = np.arange(pmin, min(pmax, load_steps) + 1)
+                candidate_costs = cost_at_pmax[load_steps - candidate_steps] + candidate_steps * cost
+                marginal_steps = int(candidate_steps[np.argmin(candidate_costs)])
+                steps_per_plant[load_number][index] = marginal_steps
+                remaining_steps[load_number] -= marginal_steps
+            at_pmax = self.shift_costs(cost_at_pmax, pmax, cost, 0, largest_load)
+            cost_at_pmax = np.where(cost_tables.improves(at_pmax, cost_at_pmax), at_pmax, cost_at_pmax)
+
+    def determine_resolution(self, loads, sorted_power_plants):
+        """Coarsest multiple of the base_resolution on which the loads and all power plant limits lie"""
+        pmin, pmax, _ = self.get_limits_and_costs(sorted_power_plants)
+        values = np.concatenate((np.asarray(loads, dtype=np.float64), pmin, pmax))
+        steps = np.round(values / self.base_resolution).astype(np.int64)
+        return max(int(np.gcd.reduce(steps)), 1) * self.base_resolution
+
+    @classmethod
+    def discretize_power_plants(cls, sorted_power_plants, resolution):
+        """
+        Converts the limits of the power plants to steps of the resolution. pmin is rounded up and pmax down,
+        so that the power plants are never operated out of their limits. The fixed output power plants (pmin equal
+        to pmax, e.g. the wind turbines) are snapped to the nearest step instead, as they would be left out otherwise,
+        their actual output being kept. Power plants that can not deliver any load are left out
+        :return: tuple of the power plants used, pmin in steps, pmax in steps, cost in euros per step and dict of the
+        actual output of the fixed output power plants off the grid (key=position in the power plants used)
+        """
+        pmin, pmax, cost_per_mwh = cls.get_limits_and_costs(sorted_power_plants)
+        fixed_output = pmin == pmax
+        snapped_steps = np.round(pmax / resolution).astype(np.int64)
+        pmin_steps = np.where(fixed_output, snapped_steps, np.ceil(pmin / resolution - 1e-6).astype(np.int64))
+        pmax_steps = np.where(fixed_output, snapped_steps, np.floor(pmax / resolution + 1e-6).astype(np.int64))
+        usable = np.flatnonzero((pmax_steps > 0) & (pmin_steps <= pmax_steps))
+        plants = [sorted_power_plants[int(index)] for index in usable]
+        fixed_power = {plant_number: round(float(pmax[index]), 10) for plant_number, index in enumerate(usable)
+                       if fixed_output[index] and abs(pmax[index] - snapped_steps[index] * resolution) > 1e-9}
+        return (plants, pmin_steps[usable].tolist(), pmax_steps[usable].tolist(),
+                (cost_per_mwh[usable] * resolution).tolist(), fixed_power)
+
+    @staticmethod
+    def get_limits_and_costs(sorted_power_plants):
+        """Arrays of the min power, max power and cost per MWh of the power plants when on"""
+        if isinstance(sorted_power_plants, Fleet):
+            return sorted_power_plants.effective_pmin, sorted_power_plants.effective_pmax, \
+                   sorted_power_plants.cost_per_mwh
+        pmin = np.array([power_plant.min_power_when_on() for power_plant in sorted_power_plants], dtype=np.float64)
+        pmax = np.array([power_plant.max_power_when_on() for power_plant in sorted_power_plants], dtype=np.float64)
+        cost_per_mwh = np.array([power_plant.cost_euros_per_load(1) for power_plant in sorted_power_plants],
+                                dtype=np.float64)
+        return pmin, pmax, cost_per_mwh
+
+    @staticmethod
+    def shift_costs(costs, steps, cost_per_step, first, last):
+        """
+        Costs of the loads first..last after adding a power plant delivering exactly `steps` to the entries of `costs`
+        """
+        shifted = np.full(last - first + 1, np.inf)
+        source_first = max(first - steps, 0)
+        if source_first <= last - steps:
+            shifted[source_first + steps - first:] = costs[source_first:last - steps + 1] + steps * cost_per_step
+        return shifted
+
+    @classmethod
+    def marginal_costs(cls, costs, pmin_steps, pmax_steps, cost_per_step, first, last):
+        """
+        Costs of the loads first..last after adding a power plant delivering anything between pmin and pmax to the
+        entries of `costs`. As the cost is linear:
+        min over q of costs[x-q] + c*q = c*x + min over y in [x-pmax, x-pmin] of costs[y] - c*y
+        which is a sliding window minimum
+        """
+        source_first, source_last = first - pmax_steps, last - pmin_steps
+        reduced_costs = np.full(source_last - source_first + 1, np.inf)
+        if source_last >= 0:
+            valid_first = max(source_first, 0)
+            source_steps = np.arange(valid_first, source_last + 1)
+            reduced_costs[valid_first - source_first:] = costs[valid_first:source_last + 1] - cost_per_step * source_steps
+        window_minimum = cls.sliding_minimum(reduced_costs, pmax_steps - pmin_steps + 1)
+        return window_minimum + cost_per_step * np.arange(first, last + 1)
+
+    @staticmethod
+    def sliding_minimum(values, width):
+        """
+        Minimum of every window of `width` consecutive values (van Herk/Gil-Werman), in O(len(values))
+        :return: array where element j is min(values[j:j+width])
+        """
+        number_of_blocks = -(-values.size // width)
+        blocks = np.full(number_of_blocks * width, np.inf)
+        blocks[:values.size] = values
+        blocks = blocks.reshape(number_of_blocks, width)
+        prefix_minimum = np.minimum.accumulate(blocks, axis=1).ravel()
+        suffix_minimum = np.minimum.accumulate(blocks[:, ::-1], axis=1)[:, ::-1].ravel()
+        number_of_windows = values.size - width + 1
+        return np.minimum(suffix_minimum[:number_of_windows], prefix_minimum[width - 1:width - 1 + number_of_windows])
+
+
+class CostTables:
+    """
+    Cost tables of the DynamicProgrammingCore over the load grid, for a list of power plants in merit order.
+    Besides the cheapest costs, they keep which choice was taken for every power plant and load of its window, as
+    packed bits, and a copy of the cost table at pmax every checkpoint_interval power plants, to backtrack the
+    dispatches
+    """
+    def __init__(self, plants, pmin_steps, pmax_steps, cost_per_step, fixed_power, resolution, tolerance,
+                 table_size=1):
+        self.plants = plants
+        self.pmin_steps = pmin_steps
+        self.pmax_steps = pmax_steps
+        self.cost_per_step = cost_per_step
+        self.fixed_power = fixed_power
+        self.resolution = resolution
+        self.capacity = sum(pmax_steps)
+        self.checkpoint_interval = int(np.sqrt(len(plants))) + 1
+        self.checkpoints = {}
+        self.tolerance = tolerance
+        self.resize(table_size)
+
+    def resize(self, table_size):
+        """Empties the tables, giving them the size of the grid"""
+        self.absolute_tolerance = self.tolerance * (1 + table_size * max(self.cost_per_step, default=0))
+        self.cost_at_pmax = np.full(table_size, np.inf)
+        self.cost_at_pmax[0] = 0
+        self.cost_after_marginal = np.full(table_size, np.inf)
+        self.choices = [None] * len(self.plants)
+        self.checkpoints = {}
+
+    def record_choices(self, index, first, took_pmin, took_marginal, took_pmax):
+        """Keeps the masks of the choices of the power plant over the loads of its window, from first"""
+        self.choices[index] = PlantChoices(first=first, size=took_pmin.size, pmin=np.packbits(took_pmin),
+                                           marginal=np.packbits(took_marginal), pmax=np.packbits(took_pmax))
+
+    def took(self, choice, index, load_steps):
+        """
+        Whether the cheapest cost of the load was reached by that choice of the power plant
+        :param choice: "pmin", "marginal" or "pmax"
+        """
+        choices = self.choices[index]
+        if choices is None or not 0 <= load_steps - choices.first < choices.size:
+            return False
+        offset = load_steps - choices.first
+        return bool(getattr(choices, choice)[offset >> 3] >> (7 - (offset & 7)) & 1)
+
+    def convert_to_power(self, steps_per_plant, marginal_index, difference=0.0):
+        """
+        Loads in MW of a dispatch backtracked from the tables. The fixed output power plants snapped to the grid
+        deliver their actual output, and the difference is taken by the marginal power plant, else by the cheapest
+        power plant on with room for it when it is short of load, or the most expensive one when it is over
+        :param steps_per_plant: dict of the steps delivered by each power plant (key=position in plants)
+        :param marginal_index: position of the marginal power plant, None if there is none
+        :param difference: load in MW to take besides, e.g. that of fixed output power plants out of the tables
+        :return: dict of the load in MW on each power plant (key=position in plants), None if no power plant on has
+        room for the difference
+        """
+        power_per_plant = {plant_number: round(steps * self.resolution, 10)
+                           for plant_number, steps in steps_per_plant.items()}
+        for plant_number in power_per_plant.keys() & self.fixed_power.keys():
+            difference += power_per_plant[plant_number] - self.fixed_power[plant_number]
+            power_per_plant[plant_number] = self.fixed_power[plant_number]
+        if abs(difference) <= 1e-9:
+            return power_per_plant
+        candidates = sorted(power_per_plant.keys() - self.fixed_power.keys(), reverse=difference < 0)
+        if marginal_index in candidates:
+            candidates.remove(marginal_index)
+            candidates.insert(0, marginal_index)
+        for plant_number in candidates:
+            power = power_per_plant[plant_number] + difference
+            plant = self.plants[plant_number]
+            if plant.min_power_when_on() - 1e-9 <= power <= plant.max_power_when_on() + 1e-9:
+                power_per_plant[plant_number] = round(power, 10)
+                return power_per_plant
+        return None
+
+    def optimal_cost(self, load_steps):
+        """Cheapest cost in euros of the load, inf if it can not be distributed"""
+        if not 0 <= load_steps < self.cost_at_pmax.size:
+            return np.inf
+        if self.improves(self.cost_after_marginal[load_steps], self.cost_at_pmax[load_steps]):
+            return self.cost_after_marginal[load_steps]
+        return self.cost_at_pmax[load_steps]
+
+    def optimal_costs(self):
+        """Cheapest cost in euros of every load of the grid, inf for the ones that can not be distributed"""
+        return np.where(self.improves(self.cost_after_marginal, self.cost_at_pmax), self.cost_after_marginal,
+                        self.cost_at_pmax)
+
+    def improves(self, candidate_costs, current_costs):
+        """Mask of the entries where the candidate is cheaper than the current cost by more than the tolerance"""
+        return candidate_costs < current_costs - self.absolute_tolerance
@@ -0,0 +1,271 @@
+import uuid
+import pickle
+import logging
+import threading
+import multiprocessing
+import numpy as np
+from app.main.model.fleet import Fleet
+from app.main.model.power_plant import PowerPlantConfigurationError
+from app.main.service import load_calculations
+from app.main.service.metrics import stage
+from app.main.service.solver_pool import SolverTimeoutError
+from app.main.service.unit_commitment import DynamicProgrammingCore, GridTooLargeError
+logger = logging.getLogger("service")
+
+# Percentiles of the costs, reserves and loads on each power plant kept in the response
+PERCENTILES = (5, 50, 95)
+# Chunks of scenarios sent to each worker process, more than one to balance the slow scenarios between them
+CHUNKS_PER_PROCESS = 4
+
+
+def wind_scenario_evaluator(raw_input_data, processes=None, engine="dp"):
+    """
+    Dispatches the load for sampled wind scenarios, in a pool of processes, and aggregates the dispatches
+    :param raw_input_data: dictionary of load, fuels, powerplants and scenarios, a dict of count, seed and either
+    wind_std (with optionally wind_mean and correlation) or wind_factors, a list of dicts of the wind (%) per wind turbine
+    :param processes: number of worker processes, None for one per CPU, 0 to dispatch in this process
+    :param engine: name of the solver engine in SOLVER_ENGINES. The dp one builds the cost tables of the thermal power
+    plants once per process, and dispatches each scenario on them with the wind rounded to their grid
+    :return: dict of the number of scenarios, the probability that the load can not be distributed, the number of
+    scenarios left unsolved by the time limit of the search, and the mean and percentiles of the cost, of the reserve
+    of the thermal power plants that are on and of the load on each power plant
+    """
+    load_calculations_interface = load_calculations.LoadCalculationInterface.get_load_calculator_from_raw_data(
+        raw_input_data, engine)
+    sorted_fleet = load_calculations_interface.get_sorted_power_plants()
+    wind_indices = np.flatnonzero(sorted_fleet.type_codes == Fleet.WINDTURBINE)
+    wind_percentages = sample_wind_percentages(raw_input_data.get("scenarios", {}),
+                                               [sorted_fleet.names[index] for index in wind_indices],
+                                               raw_input_data.get("fuels", {}).get("wind(%)", 0))
+    # Scenarios dispatched by each process, which share the time limit of its solver
+    searches = len(wind_percentages) if processes == 0 else -(-len(wind_percentages) //
+                                                            (processes or multiprocessing.cpu_count()))
+    scenario_dispatcher = ScenarioDispatcher(sorted_fleet, load_calculations_interface.load_to_distrib, engine,
+                                             searches)
+    with stage("dispatch"):
+        loads, costs = dispatch_scenarios(scenario_dispatcher, wind_percentages, processes)
+    with stage("response"):
+        return aggregate_scenarios(sorted_fleet, loads, costs)
+
+
+def sample_wind_percentages(scenarios, wind_turbine_names, wind_percentage):
+    """
+    Wind (%) of each wind turbine in each scenario. The samples only depend on the seed, so that an evaluation can be
+    reproduced whatever the number of processes
+    :param scenarios: dict of count, seed and either wind_factors or wind_std, wind_mean and correlation
+    :param wind_turbine_names: names of the wind turbines, in the order of the columns
+    :param wind_percentage: wind (%) of the fuels, used for the wind turbines missing from the scenarios
+    :return: array of the wind (%) per scenario (rows) and wind turbine (columns)
+    """
+    rng = np.random.default_rng(scenarios.get("seed", 0))
+    wind_factors = scenarios.get("wind_factors")
+    if wind_factors:
+        wind_percentages = np.array([[factors.get(name, wind_percentage) for name in wind_turbine_names]
+                                     for factors in wind_factors], dtype=np.float64).reshape(-1, len(wind_turbine_names))
+        if "count" in scenarios:
+            wind_percentages = wind_percentages[rng.integers(0, len(wind_percentages), scenarios["count"])]
+        return wind_percentages
+    count = scenarios.get("count", 1000)
+    # Each wind turbine sees a share of the forecast error common to all of them and a share of its own
+    correlation = scenarios.get("correlation", 1.0)
+    common_error = rng.standard_normal((count, 1))
+    own_error = rng.standard_normal((count, len(wind_turbine_names)))
+    forecast_error = np.sqrt(correlation) * common_error + np.sqrt(1 - correlation) * own_error
+    return np.clip(scenarios.get("wind_mean", wind_percentage) + scenarios.get("wind_std", 0) * forecast_error, 0, 100)
+
+
+def dispatch_scenarios(scenario_dispatcher, wind_percentages, processes=None):
+    """
+    Dispatches the scenarios in chunks, in the pool of processes kept by this process. The ScenarioDispatcher is
+    pickled once and sent with each chunk, a worker process unpickling it and building its cost tables only for the
+    first chunk of the request it dispatches
+    :return: tuple of the array of the load on each power plant per scenario and the array of the cost per scenario,
+    NaN for the scenarios whose load can not be distributed and inf for the ones left unsolved
+    """
+    if processes == 0 or len(wind_percentages) == 0:
+        return scenario_dispatcher.dispatch(wind_percentages)
+    processes = processes or multiprocessing.cpu_count()
+    chunks = np.array_split(wind_percentages, min(len(wind_percentages), processes * CHUNKS_PER_PROCESS))
+    key, pickled_dispatcher = uuid.uuid4().hex, pickle.dumps(scenario_dispatcher)
+    results = get_scenario_pool(processes).map(dispatch_in_worker, [(key, pickled_dispatcher, chunk)
+                                                                     for chunk in chunks], chunksize=1)
+    return np.concatenate([loads for loads, _ in results]), np.concatenate([costs for _, costs in results])
+
+
+# Pools of processes dispatching the scenarios by number of processes, started by the first request that needs one in
+# this process (e.g. a worker of the solver pool) and kept for the next ones
+scenario_pools = {}
+scenario_pools_lock = threading.Lock()
+
+
+def get_scenario_pool(processes):
+    with scenario_pools_lock:
+        if processes not in scenario_pools:
+            logger.info(f"Starting scenario pool of {processes} processes")
+            scenario_pools[processes] = multiprocessing.Pool(processes)
+        return scenario_pools[processes]
+
+
+# Key and ScenarioDispatcher of the request whose scenarios the worker process dispatched last
+worker_dispatcher = (None, None)
+
+
+def dispatch_in_worker(task):
+    """:param task: tuple of the key of the request, its pickled ScenarioDispatcher and the chunk of scenarios"""
+    global worker_dispatcher
+    key, pickled_dispatcher, wind_percentages = task
+    if worker_dispatcher[0] != key:
+        worker_dispatcher = (key, pickle.loads(pickled_dispatcher))
+    return worker_dispatcher[1].dispatch(wind_percentages)
+
+
+class ScenarioDispatcher:
+    """
+    Dispatches a load on a sorted fleet for several wind scenarios. The wind turbines cost nothing whatever the wind,
+    so the merit order is the same in all of them: only the limits of the wind turbines change.
+    With the dp engine, a wind turbine is either off or at its pmax, so the cheapest dispatch of a scenario is the
+    cheapest over the sums of wind that some of the wind turbines deliver of the cheapest cost of the thermal power
+    plants for the rest of the load. Those costs come from cost tables of the thermal power plants, built once up to
+    the load, so a scenario costs a subset sum of the wind over the grid and a backtrack. Past the cells budget of the
+    DynamicProgrammingCore, each scenario is searched by the bnb engine with the time limit of the solves
+    """
+    # Grids of the wind of the dp engine, finest first. The finest one on which the load is at most max_scenario_steps
+    # is used, which bounds the cost of a scenario
+    wind_resolutions = (0.01, 0.1, 1)
+    max_scenario_steps = 100000
+
+    def __init__(self, sorted_fleet, load, engine="dp", searches=1):
+        """:param searches: number of scenarios dispatched in each process, sharing the time limit of the solver"""
+        self.fleet = sorted_fleet
+        self.load = load
+        self.engine = engine
+        self.searches = searches
+        self.wind_indices = np.flatnonzero(sorted_fleet.type_codes == Fleet.WINDTURBINE)
+        self.core = DynamicProgrammingCore()
+        # Built in the process dispatching the scenarios, rather than sent to it
+        self.cost_tables = None
+
+    def __getstate__(self):
+        return dict(self.__dict__, cost_tables=None)
+
+    def dispatch(self, wind_percentages):
+        """
+        :param wind_percentages: array of the wind (%) per scenario (rows) and wind turbine (columns)
+        :return: tuple of the array of the load on each power plant per scenario and the array of the cost per
+        scenario, NaN for the scenarios whose load can not be distributed and inf for the ones left unsolved
+        """
+        loads = np.full((len(wind_percentages), len(self.fleet)), np.nan)
+        costs = np.full(len(wind_percentages), np.nan)
+        wind_pmax = self.fleet.pmax[self.wind_indices] * wind_percentages / 100
+        if self.engine == "dp" and self.build_cost_tables():
+            # Rounded to the grid of the cost tables, of 10 kW unless the load is large
+            wind_steps = np.round(wind_pmax / self.cost_tables.resolution).astype(np.int64)
+            scenarios, dispatch_scenario = wind_steps, self.dispatch_on_cost_tables
+        else:
+            load_calculator = load_calculations.get_solver("bnb" if self.engine == "dp" else self.engine,
+                                                           self.searches)
+            # Rounded to 10 kW, the finest grid of the dp engine
+            scenarios = np.round(wind_pmax, 2)
+            dispatch_scenario = lambda scenario_wind_pmax: self.dispatch_scenario(load_calculator, scenario_wind_pmax)
+        # Scenarios with the same wind, e.g. clipped at 0 or 100 %, are dispatched once
+        dispatched = {}
+        for number, scenario in enumerate(scenarios):
+            key = tuple(scenario)
+            if key not in dispatched:
+                dispatched[key] = dispatch_scenario(scenario)
+            if dispatched[key] is None:
+                continue
+            if np.isinf(dispatched[key]).any():
+                costs[number] = np.inf
+                continue
+            loads[number] = dispatched[key]
+            costs[number] = dispatched[key] @ self.fleet.cost_per_mwh
+        return loads, costs
+
+    def build_cost_tables(self):
+        """
+        Builds the cost tables of the thermal power plants up to the load, on the grid of the wind, unless they are
+        already built
+        :return: False when they exceed the cells budget of the core
+        """
+        if self.cost_tables is None:
+            thermal_power_plants = [self.fleet[index] for index in range(len(self.fleet))
+                                    if self.fleet.type_codes[index] != Fleet.WINDTURBINE]
+            wind_resolution = next((resolution for resolution in self.wind_resolutions
+                                    if self.load / resolution <= self.max_scenario_steps), self.wind_resolutions[-1])
+            resolution = self.core.determine_resolution([self.load, wind_resolution], thermal_power_plants)
+            if self.load / resolution > max(self.max_scenario_steps, self.load / wind_resolution):
+                # Limits of the thermal power plants off the grid of the wind, e.g. in hundredths of MW: they are
+                # rounded onto it (pmin up and pmax down) rather than refining the grid past the bound
+                logger.info(f"Thermal limits rounded onto the grid of {wind_resolution} MW of the wind")
+                resolution = wind_resolution
+            load_steps = int(round(self.load / resolution))
+            try:
+                self.cost_tables = self.core.build_cost_tables(thermal_power_plants, resolution, 0, load_steps)
+            except GridTooLargeError as err:
+                logger.info(f"{err}: the scenarios are dispatched by branch and bound")
+                return False
+        return True
+
+    def dispatch_on_cost_tables(self, wind_steps):
+        """
+        Load on each power plant for the pmax of each wind turbine in steps of the grid of the cost tables, None if the
+        load can not be distributed
+        """
+        load_steps = int(round(self.load / self.cost_tables.resolution))
+        dispatch = self.core.backtrack_with_fixed_outputs(self.cost_tables, wind_steps, load_steps)
+        if dispatch is None:
+            return None
+        thermal_dispatch, wind_on = dispatch
+        power_per_plant = self.cost_tables.convert_to_power(*thermal_dispatch)
+        if power_per_plant is None:
+            return self.dispatch_scenario(load_calculations.get_solver("bnb", self.searches),
+                                          wind_steps * self.cost_tables.resolution)
+        loads = np.zeros(len(self.fleet))
+        for plant_number, power in power_per_plant.items():
+            loads[self.cost_tables.plants[plant_number].index] = power
+        loads[self.wind_indices[wind_on]] = np.round(wind_steps[wind_on] * self.cost_tables.resolution, 10)
+        return loads
+
+    def dispatch_scenario(self, load_calculator, wind_pmax):
+        """
+        Load on each power plant for the pmax of each wind turbine, None if the load can not be distributed and inf
+        if the search found no dispatch within its time limit
+        """
+        self.fleet.effective_pmax[self.wind_indices] = wind_pmax
+        self.fleet.effective_pmin[self.wind_indices] = wind_pmax
+        try:
+            distributed_load = load_calculator.get_optimal_power_plants_for_load(self.load, self.fleet)
+        except PowerPlantConfigurationError:
+            return None
+        except SolverTimeoutError:
+            return np.full(len(self.fleet), np.inf)
+        loads = np.zeros(len(self.fleet))
+        for power_plant, load_on_power_plant in distributed_load.items():
+            loads[power_plant.index] = load_on_power_plant
+        return loads
+
+
+def aggregate_scenarios(sorted_fleet, loads, costs):
+    """Statistics of the dispatches of the scenarios, as expected in the response"""
+    feasible = np.isfinite(costs)
+    feasible_loads = loads[feasible]
+    thermal_on = (feasible_loads > 0) & (sorted_fleet.type_codes != Fleet.WINDTURBINE)
+    reserves = ((sorted_fleet.pmax - feasible_loads) * thermal_on).sum(axis=1)
+    power_plants = [dict(summarize(feasible_loads[:, index]), name=name,
+                         probability_on=float((feasible_loads[:, index] > 0).mean()) if feasible.any() else None)
+                    for index, name in enumerate(sorted_fleet.names)]
+    return {"scenarios": int(costs.size),
+            "infeasibility_probability": float(np.isnan(costs).mean()) if costs.size else None,
+            "unsolved_scenarios": int(np.isinf(costs).sum()),
+            "cost": summarize(costs[feasible]),
+            "reserve": summarize(reserves),
+            "powerplants": power_plants}
+
+
+def summarize(values):
+    """Mean and PERCENTILES of the values, None when there are none"""
+    if not values.size:
+        return dict({"mean": None}, **{f"p{percentile}": None for percentile in PERCENTILES})
+    return dict({"mean": float(values.mean())},
+                **{f"p{percentile}": float(np.percentile(values, percentile)) for percentile in PERCENTILES})
@@ -1,9 +1,30 @@
+import os
+import sys
 import json
+import time
+import tempfile
+import itertools
+import threading
+import multiprocessing
 import pathlib
 import unittest
+from unittest import mock
 from parameterized import parameterized
-from app.main.service import load_calculations
-from app.main.model.power_plant import PowerPlantConfigurationError
+from werkzeug.serving import make_server
+from app.main import create_app
+from app.benchmarks import fleet_generator, load_test, oracle, run as benchmarks
+from app.main.service import load_calculations, supply_curve, wind_scenarios, scheduling, \
+    replay, metrics, branch_and_bound
+from app.main.service.dispatch_cache import DispatchCache, LRUCache, dispatch_cache
+from app.main.service.branch_and_bound import BranchAndBoundCore
+from app.main.service.unit_commitment import DynamicProgrammingCore, GridTooLargeError
+from app.main.service.fleet_registry import FleetRegistry, FleetNotInWorkerError, dispatch_in_worker
+from app.main.service.solver_pool import SolverPool, SolverPoolBusyError, SolverTimeoutError
+from app.main.config import Config, TestingConfig
+from app.main.model.fleet import Fleet
+from app.main.controller import fast_validation
+from app.main.controller.input_validation import PowerPlantLoadSchema
+from app.main.model.power_plant import PowerPlantConfigurationError, PowerPlantFactory, PowerPlant
 
 
 class Testing(unittest.TestCase):
@@ -33,5 +54,675 @@ class Testing(unittest.TestCase):
             with self.assertRaises(raised_error):
                 load_calculations.load_distributor(example_content)
 
+    @parameterized.expand([
+        ("payload1.json",),
+        ("payload2.json",),
+        ("payload3.json",),
+    ])
+    def test_engines_agree_on_example(self, file_name):
+        path_to_example_dir = pathlib.Path.cwd().parent / "example_payloads"
+        with open(path_to_example_dir / file_name, "r") as fp:
+            example_content = json.load(fp)
+            self.assertEqual(load_calculations.load_distributor(example_content, engine="legacy"),
+                             load_calculations.load_distributor(example_content, engine="dp"))
+
+    def test_dp_engine_finds_cheaper_transition(self):
+        # The legacy engine keeps gasfiredcheap below pmax to turn on gasfiredrigid at its pmin
+        raw_input_data = {"load": 149,
+                          "fuels": {"gas(euro/MWh)": 13.4, "kerosine(euro/MWh)": 50.8, "co2(euro/ton)": 20,
+                                    "wind(%)": 60},
+                          "powerplants": [
+                              {"name": "gasfiredcheap", "type": "gasfired", "efficiency": 0.58, "pmin": 52,
+                               "pmax": 96},
+                              {"name": "gasfiredold", "type": "gasfired", "efficiency": 0.27, "pmin": 26, "pmax": 82},
+                              {"name": "gasfiredrigid", "type": "gasfired", "efficiency": 0.28, "pmin": 86,
+                               "pmax": 89}]}
+        self.assertEqual([{'name': 'gasfiredcheap', 'p': 63}, {'name': 'gasfiredrigid', 'p': 86},
+                          {'name': 'gasfiredold', 'p': 0}],
+                         load_calculations.load_distributor(raw_input_data, engine="legacy"))
+        self.assertEqual([{'name': 'gasfiredcheap', 'p': 96}, {'name': 'gasfiredrigid', 'p': 0},
+                          {'name': 'gasfiredold', 'p': 53}],
+                         load_calculations.load_distributor(raw_input_data, engine="dp"))
+
+    def test_batch_matches_single_loads(self):
+        path_to_example_dir = pathlib.Path.cwd().parent / "example_payloads"
+        with open(path_to_example_dir / "payload1.json", "r") as fp:
+            example_content = json.load(fp)
+        batch_content = dict(example_content, loads=[480, 910, 10000, 0],
+                             fuels_per_slot=[{}, {"wind(%)": 0}, {}, {"gas(euro/MWh)": 20}])
+        output_received = load_calculations.load_distributor_batch(batch_content)
+        for slot, load in enumerate(batch_content["loads"]):
+            single_content = dict(example_content, load=load,
+                                  fuels=dict(example_content["fuels"], **batch_content["fuels_per_slot"][slot]))
+            if load == 10000:
+                self.assertIn("error", output_received[slot])
+                continue
+            self.assertEqual(load_calculations.load_distributor(single_content), output_received[slot]["powerplants"])
+        self.assertAlmostEqual(368.4 * (13.4 / 0.53 + 0.3 * 20), output_received[0]["cost"])
+
+    def test_cache_hits_skip_power_plant_instantiation(self):
+        path_to_example_dir = pathlib.Path.cwd().parent / "example_payloads"
+        with open(path_to_example_dir / "payload3.json", "r") as fp:
+            example_content = json.load(fp)
+        cache = DispatchCache()
+        expected_output = load_calculations.load_distributor(example_content, cache=cache)
+        expected_output_other_load = load_calculations.load_distributor(dict(example_content, load=480), cache=None)
+        with mock.patch.object(Fleet, "from_raw_data") as from_raw_data:
+            self.assertEqual(expected_output, load_calculations.load_distributor(example_content, cache=cache))
+            self.assertEqual(expected_output_other_load,
+                             load_calculations.load_distributor(dict(example_content, load=480), cache=cache))
+            from_raw_data.assert_not_called()
+        self.assertEqual({"size": 2, "hits": 1, "misses": 2, "evictions": 0, "expirations": 0},
+                         cache.responses.stats())
+        self.assertEqual(1, cache.merit_orders.stats()["hits"])
+
+    @parameterized.expand([
+        ("payload1.json",),
+        ("payload2.json",),
+    ])
+    def test_fleet_matches_power_plant_instances(self, file_name):
+        path_to_example_dir = pathlib.Path.cwd().parent / "example_payloads"
+        with open(path_to_example_dir / file_name, "r") as fp:
+            example_content = json.load(fp)
+        power_plant_instances = [PowerPlantFactory.get_power_plant_instance(powerplant)
+                                 for powerplant in example_content["powerplants"]]
+        [PowerPlantFactory.set_fuel_on_power_plant(powerplant_instance, example_content["fuels"])
+         for powerplant_instance in power_plant_instances]
+        fleet = Fleet.from_raw_data(example_content["powerplants"])
+        fleet.set_fuels(example_content["fuels"])
+        fleet.sort()
+        for power_plant, fleet_power_plant in zip(PowerPlant.get_sorted_power_plants(power_plant_instances), fleet):
+            self.assertEqual(power_plant.name, fleet_power_plant.name)
+            self.assertEqual(power_plant.min_power_when_on(), fleet_power_plant.min_power_when_on())
+            self.assertEqual(power_plant.max_power_when_on(), fleet_power_plant.max_power_when_on())
+            self.assertAlmostEqual(power_plant.cost_euros_per_load(100), fleet_power_plant.cost_euros_per_load(100))
+        self.assertEqual(len(power_plant_instances), len(fleet))
+
+    def test_lru_cache_eviction(self):
+        now = [0]
+        cache = LRUCache(max_size=2, ttl=10, clock=lambda: now[0])
+        cache.put("a", 1)
+        cache.put("b", 2)
+        self.assertEqual(1, cache.get("a"))
+        cache.put("c", 3)
+        self.assertIsNone(cache.get("b"))
+        now[0] = 11
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual({"size": 1, "hits": 1, "misses": 2, "evictions": 1, "expirations": 1}, cache.stats())
+
+    def test_supply_curve_matches_single_loads(self):
+        path_to_example_dir = pathlib.Path.cwd().parent / "example_payloads"
+        with open(path_to_example_dir / "payload1.json", "r") as fp:
+            example_content = json.load(fp)
+        curve = supply_curve.SupplyCurve.get_supply_curve_from_raw_data(example_content)
+        for load in [0, 22, 50, 150, 480, 910, 1257]:
+            dispatch = {power_plant["name"]: power_plant["p"] for power_plant in
+                        load_calculations.load_distributor(dict(example_content, load=load), cache=None)}
+            self.assertEqual({name: p for name, p in dispatch.items() if p}, curve.dispatch(load))
+        self.assertAlmostEqual(368.4 * (13.4 / 0.53 + 0.3 * 20), curve.cost(480))
+        self.assertAlmostEqual(13.4 / 0.53 + 0.3 * 20, curve.marginal_price(480))
+        with self.assertRaises(PowerPlantConfigurationError):
+            curve.cost(10000)
+        self.assertIn("error", supply_curve.supply_curve_calculator(dict(example_content, loads=[10000]))["loads"][0])
+
+    def test_app_factory_serves_the_api(self):
+        path_to_example_dir = pathlib.Path.cwd().parent / "example_payloads"
+        with open(path_to_example_dir / "payload2.json", "r") as fp:
+            example_content = json.load(fp)
+        app = create_app("test")
+        self.assertFalse(app.debug)
+        response = app.test_client().post("/powerplant/", json=example_content)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(load_calculations.load_distributor(example_content), response.get_json())
+
+    def test_metrics_and_profile_of_requests(self):
+        path_to_example_dir = pathlib.Path.cwd().parent / "example_payloads"
+        with open(path_to_example_dir / "payload1.json", "r") as fp:
+            example_content = json.load(fp)
+        client = create_app("test").test_client()
+        # A cached response would skip the stages of the solve
+        dispatch_cache.clear()
+        response = client.post("/powerplant/", json=example_content, headers={"X-Profile": "stages"})
+        self.assertEqual(200, response.status_code)
+        stages = [timing.split(";")[0] for timing in response.headers["Server-Timing"].split(", ")]
+        self.assertEqual(["validation", "fleet", "sort", "dispatch", "response", "total"], stages)
+        self.assertEqual("dp=1", response.headers["X-Solver-Calls"])
+        self.assertNotIn("Server-Timing", client.post("/powerplant/", json=example_content).headers)
+
+        response = client.get("/metrics")
+        self.assertEqual(200, response.status_code)
+        self.assertIn('powerplant_stage_duration_seconds_count{stage="dispatch"}', response.data.decode())
+        self.assertIn('powerplant_http_request_duration_seconds_bucket{route="/powerplant/",method="POST",'
+                      'status="200",le="+Inf"}', response.data.decode())
+
+    def test_metrics_are_summed_over_the_worker_processes(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with mock.patch.object(TestingConfig, "METRICS_DIR", directory):
+                client = create_app("test").test_client()
+            try:
+                client.get("/powerplant/unknown")
+                sample = 'powerplant_http_request_duration_seconds_count{route="unmatched",method="GET",status="404"}'
+                count = float(self.metric_value(client.get("/metrics").data.decode(), sample))
+                # Another worker process having served the same requests
+                with open(os.path.join(directory, f"metrics_{os.getpid()}.json"), "r") as fp:
+                    snapshot = fp.read()
+                with open(os.path.join(directory, "metrics_1.json"), "w") as fp:
+                    fp.write(snapshot)
+                self.assertEqual(2 * count, float(self.metric_value(client.get("/metrics").data.decode(), sample)))
+                # The file of the process is written at most once per interval after the requests, and at each scrape
+                with mock.patch.object(metrics.registry, "write_interval", 60):
+                    client.get("/powerplant/unknown")
+                    client.get("/powerplant/unknown")
+                    with open(os.path.join(directory, f"metrics_{os.getpid()}.json"), "r") as fp:
+                        self.assertEqual(count, self.snapshot_count(json.load(fp)))
+                    self.assertIsNotNone(metrics.registry._deferred_write)
+                    self.assertEqual(2 * count + 2,
+                                     float(self.metric_value(client.get("/metrics").data.decode(), sample)))
+                    metrics.registry.write(force=True)
+                    self.assertIsNone(metrics.registry._deferred_write)
+            finally:
+                metrics.registry.directory = None
+
+    @staticmethod
+    def snapshot_count(snapshot):
+        """Count of the HTTP requests of the unmatched route in a metrics file"""
+        return next(sum(bucket_counts) for key, (bucket_counts, _) in
+                    snapshot["powerplant_http_request_duration_seconds"] if key == ["unmatched", "GET", "404"])
+
+    @staticmethod
+    def metric_value(metrics_text, sample):
+        return next(line.split(" ")[-1] for line in metrics_text.splitlines() if line.startswith(sample + " "))
+
+    def test_registered_fleet_is_dispatched_by_id(self):
+        path_to_example_dir = pathlib.Path.cwd().parent / "example_payloads"
+        with open(path_to_example_dir / "payload3.json", "r") as fp:
+            example_content = json.load(fp)
+        client = create_app("test").test_client()
+        self.assertEqual(404, client.post("/fleets/north/dispatch", json={"load": 100, "fuels": {"wind(%)": 50}})
+                         .status_code)
+        response = client.put("/fleets/north", json={"powerplants": example_content["powerplants"]})
+        self.assertEqual({"id": "north", "powerplants": 6}, response.get_json())
+        response = client.post("/fleets/north/dispatch",
+                               json={"load": example_content["load"], "fuels": example_content["fuels"]})
+        self.assertEqual(load_calculations.load_distributor(example_content, cache=None), response.get_json())
+
+        with tempfile.TemporaryDirectory() as directory:
+            snapshot_path = os.path.join(directory, "fleets.json")
+            registry = FleetRegistry(snapshot_path)
+            other_process_registry = FleetRegistry(snapshot_path)
+            registry.register("north", example_content["powerplants"])
+            registered_fleet = FleetRegistry(snapshot_path).get("north")
+            self.assertEqual(example_content["powerplants"], registered_fleet.power_plants)
+            self.assertEqual(example_content["powerplants"], other_process_registry.get("north").power_plants)
+            self.assertEqual(load_calculations.load_distributor(example_content, cache=None),
+                             load_calculations.registered_fleet_load_distributor(registered_fleet, example_content,
+                                                                                 cache=DispatchCache()))
+            # Registrations of concurrent worker processes are all kept
+            processes = [multiprocessing.get_context("fork").Process(target=lambda number: [
+                FleetRegistry(snapshot_path).register(f"fleet{number}-{index}", example_content["powerplants"])
+                for index in range(10)], args=(number,)) for number in range(4)]
+            for process in processes:
+                process.start()
+            for process in processes:
+                process.join()
+            self.assertEqual(41, len(FleetRegistry(snapshot_path)))
+
+    def test_redispatch_matches_full_solves(self):
+        path_to_example_dir = pathlib.Path.cwd().parent / "example_payloads"
+        with open(path_to_example_dir / "payload3.json", "r") as fp:
+            example_content = json.load(fp)
+        client = create_app("test").test_client()
+        client.put("/fleets/north", json={"powerplants": example_content["powerplants"]})
+        dispatch_cache.clear()
+        redispatched = []
+        for load, wind in [(480, 60), (1100, 60), (1105, 60), (1090, 62), (1150, 62), (300, 62.345), (40, 10)]:
+            fuels = dict(example_content["fuels"], **{"wind(%)": wind})
+            response = client.post("/fleets/north/redispatch", json={"load": load, "fuels": fuels}).get_json()
+            self.assertEqual(load_calculations.load_distributor(dict(example_content, load=load, fuels=fuels),
+                                                                cache=None), response["powerplants"])
+            redispatched.append(response["redispatched"])
+        # The cost tables of the thermal power plants are kept when the wind changes, and built again when the load
+        # exceeds twice the one they were built for, unless they reach the capacity of the thermal power plants
+        self.assertEqual([False, False, True, True, True, True, True], redispatched)
+        self.assertEqual(1, dispatch_cache.cost_tables.stats()["size"])
+
+    def test_wind_scenarios_are_reproducible(self):
+        path_to_example_dir = pathlib.Path.cwd().parent / "example_payloads"
+        with open(path_to_example_dir / "payload3.json", "r") as fp:
+            example_content = json.load(fp)
+        forecast = {"wind_factors": [dict.fromkeys(["windpark1", "windpark2"], example_content["fuels"]["wind(%)"])]}
+        evaluation = wind_scenarios.wind_scenario_evaluator(dict(example_content, scenarios=forecast), processes=0)
+        self.assertEqual({power_plant["name"]: power_plant["p"]
+                          for power_plant in load_calculations.load_distributor(example_content, cache=None)},
+                         {power_plant["name"]: power_plant["p50"] for power_plant in evaluation["powerplants"]})
+
+        scenarios = {"count": 40, "seed": 3, "wind_std": 20, "correlation": 0.5}
+        evaluation = wind_scenarios.wind_scenario_evaluator(dict(example_content, scenarios=scenarios), processes=0)
+        self.assertEqual(40, evaluation["scenarios"])
+        self.assertEqual(0.0, evaluation["infeasibility_probability"])
+        self.assertLessEqual(evaluation["cost"]["p5"], evaluation["cost"]["p95"])
+        self.assertEqual(evaluation, wind_scenarios.wind_scenario_evaluator(
+            dict(example_content, scenarios=scenarios), processes=2))
+        response = create_app("test").test_client().post("/powerplant/scenarios",
+                                                         json=dict(example_content, scenarios=scenarios))
+        self.assertEqual(evaluation, response.get_json())
+        self.assertEqual(0, evaluation["unsolved_scenarios"])
+        self.assertEqual(evaluation, wind_scenarios.wind_scenario_evaluator(
+            dict(example_content, scenarios=scenarios), processes=0, engine="bnb"))
+        response = create_app("test").test_client().post(
+            "/powerplant/scenarios", json=dict(example_content, scenarios={"wind_factors": [{"windpark3": 50}]}))
+        self.assertEqual(422, response.status_code)
+
+    def test_wind_scenarios_cost_a_bounded_time_on_large_fleets(self):
+        payload = fleet_generator.generate_payload(200, seed=0)
+        payload["load"] = 586
+        scenarios = {"count": 20, "seed": 0, "wind_std": 20, "wind_mean": 50, "correlation": 0.5}
+        previous = metrics.RequestProfile.start()
+        try:
+            evaluation = wind_scenarios.wind_scenario_evaluator(dict(payload, scenarios=scenarios), processes=0)
+        finally:
+            profile = metrics.RequestProfile.stop(previous)
+        self.assertEqual(0.0, evaluation["infeasibility_probability"])
+        # Every scenario dispatched on the cost tables, of at most max_scenario_steps loads, none searched by bnb
+        self.assertNotIn("bnb", profile.solver_calls)
+        sorted_fleet = load_calculations.LoadCalculationInterface.get_load_calculator_from_raw_data(
+            payload, "dp").get_sorted_power_plants()
+        scenario_dispatcher = wind_scenarios.ScenarioDispatcher(sorted_fleet, payload["load"])
+        self.assertTrue(scenario_dispatcher.build_cost_tables())
+        self.assertLessEqual(scenario_dispatcher.cost_tables.cost_at_pmax.size,
+                             wind_scenarios.ScenarioDispatcher.max_scenario_steps + 1)
+
+    def test_wind_scenarios_keep_the_grid_of_the_wind_with_fractional_limits(self):
+        payload = fleet_generator.generate_payload(200, seed=0, decimals=2)
+        payload["load"] = 5000
+        sorted_fleet = load_calculations.LoadCalculationInterface.get_load_calculator_from_raw_data(
+            payload, "dp").get_sorted_power_plants()
+        scenario_dispatcher = wind_scenarios.ScenarioDispatcher(sorted_fleet, payload["load"])
+        self.assertTrue(scenario_dispatcher.build_cost_tables())
+        self.assertEqual(0.1, scenario_dispatcher.cost_tables.resolution)
+        scenarios = {"count": 20, "seed": 0, "wind_std": 20, "wind_mean": 50, "correlation": 0.5}
+        evaluation = wind_scenarios.wind_scenario_evaluator(dict(payload, scenarios=scenarios), processes=0)
+        self.assertEqual(0, evaluation["unsolved_scenarios"])
+
+    def test_schedule_keeps_units_on_through_short_dips(self):
+        path_to_example_dir = pathlib.Path.cwd().parent / "example_payloads"
+        with open(path_to_example_dir / "payload3.json", "r") as fp:
+            example_content = json.load(fp)
+        # Without start-up costs, minimum times or ramps, each slot is dispatched as if alone
+        schedule_content = dict(example_content, loads=[150, 480, 300, 910, 700, 200])
+        schedule = scheduling.schedule_calculator(schedule_content)
+        for scheduled_slot, slot in zip(schedule["slots"], load_calculations.load_distributor_batch(schedule_content)):
+            self.assertAlmostEqual(slot["cost"], scheduled_slot["cost"])
+
+        fuels = {"gas(euro/MWh)": 10, "co2(euro/ton)": 0}
+        power_plants = [{"name": "base", "type": "gasfired", "efficiency": 0.5, "pmin": 0, "pmax": 150,
+                         "ramp_rate": 60},
+                        {"name": "peaker", "type": "gasfired", "efficiency": 0.25, "pmin": 20, "pmax": 100,
+                         "startup_cost": 1000}]
+        schedule_content = {"loads": [50, 150, 80, 150], "fuels": fuels, "powerplants": power_plants}
+        schedule = scheduling.schedule_calculator(schedule_content)
+        # The base ramps from 50 to 110 only, and the peaker stays on at pmin through the dip rather than restarting
+        self.assertEqual([[50, 0], [110, 40], [60, 20], [120, 30]],
+                         [[power_plant["p"] for power_plant in slot["powerplants"]] for slot in schedule["slots"]])
+        self.assertEqual(2, schedule["starts"])
+        self.assertAlmostEqual(1000, schedule["startup_cost"])
+        self.assertAlmostEqual(sum(slot["cost"] for slot in schedule["slots"]), schedule["cost"])
+
+        client = create_app("test").test_client()
+        self.assertEqual(schedule, client.post("/powerplant/schedule", json=schedule_content).get_json())
+        power_plants[1]["min_up_time"] = 3
+        response = client.post("/powerplant/schedule", json=dict(schedule_content, loads=[150, 10, 10]))
+        self.assertEqual(400, response.status_code)
+
+    def test_schedule_holds_ramp_limited_units_low_ahead_of_a_drop(self):
+        fuels = {"gas(euro/MWh)": 13.4, "kerosine(euro/MWh)": 50.8, "co2(euro/ton)": 20, "wind(%)": 60}
+        power_plants = [{"name": f"gasfired{number}", "type": "gasfired", "efficiency": 0.5, "pmin": 0, "pmax": 100,
+                         "ramp_rate": 10, "min_up_time": 8} for number in range(10)]
+        power_plants += [{"name": f"turbojet{number}", "type": "turbojet", "efficiency": 0.3, "pmin": 0, "pmax": 200}
+                         for number in range(10)]
+        schedule_content = {"loads": [100, 200, 300, 400, 500, 20, 20, 20], "fuels": fuels,
+                            "powerplants": power_plants}
+        # Raised to their ramp limit, the gas-fired units held on by their minimum up time could not go down to 20 MW
+        schedule = scheduling.schedule_calculator(schedule_content)
+        turbojets_only = scheduling.schedule_calculator(dict(schedule_content, powerplants=power_plants[10:]))
+        self.assertAlmostEqual(264160, turbojets_only["cost"])
+        self.assertLessEqual(schedule["cost"], turbojets_only["cost"])
+        for slot, load in zip(schedule["slots"], schedule_content["loads"]):
+            self.assertAlmostEqual(load, sum(power_plant["p"] for power_plant in slot["powerplants"]))
+        for previous_slot, slot in zip(schedule["slots"], schedule["slots"][1:]):
+            for previous_power_plant, power_plant in zip(previous_slot["powerplants"][:10], slot["powerplants"][:10]):
+                self.assertLessEqual(abs(power_plant["p"] - previous_power_plant["p"]), 10 + 1e-9)
+
+    def test_replay_streams_a_result_per_record(self):
+        path_to_example_dir = pathlib.Path.cwd().parent / "example_payloads"
+        with open(path_to_example_dir / "payload3.json", "r") as fp:
+            example_content = json.load(fp)
+        records = [json.dumps({"load": 100, "fuels": example_content["fuels"]}),
+                   json.dumps(dict(example_content, id="first")),
+                   "",
+                   json.dumps({"load": 480, "fuels": dict(example_content["fuels"], **{"wind(%)": 0})}),
+                   "{not json",
+                   json.dumps({"load": 100000, "fuels": example_content["fuels"]}),
+                   json.dumps({"load": 480, "fuels": dict(example_content["fuels"], **{"wind(%)": -5})}),
+                   json.dumps({"load": 480, "fuels": example_content["fuels"], "id": "last"})]
+        response = create_app("test").test_client().post("/powerplant/replay", data="\n".join(records) + "\n",
+                                                          content_type="application/x-ndjson")
+        self.assertEqual("application/x-ndjson", response.mimetype)
+        results = [json.loads(line) for line in response.data.decode().splitlines()]
+        self.assertEqual([1, 2, 4, 5, 6, 7, 8], [result["line"] for result in results])
+        self.assertIn("error", results[0])
+        self.assertEqual("first", results[1]["id"])
+        self.assertEqual(load_calculations.load_distributor(example_content, cache=None), results[1]["powerplants"])
+        self.assertEqual(load_calculations.load_distributor(
+            dict(example_content, load=480, fuels=dict(example_content["fuels"], **{"wind(%)": 0})), cache=None),
+            results[2]["powerplants"])
+        self.assertIn("error", results[3])
+        self.assertIn("error", results[4])
+        self.assertEqual("Wind percentage cannot be less than 0", results[5]["error"])
+        self.assertEqual(load_calculations.load_distributor(dict(example_content, load=480), cache=None),
+                         results[6]["powerplants"])
+
+        with tempfile.TemporaryDirectory() as directory:
+            input_path, output_path = os.path.join(directory, "in.ndjson"), os.path.join(directory, "out.ndjson")
+            with open(input_path, "w") as fp:
+                fp.write("\n".join(records) + "\n")
+            self.assertEqual(0, replay.main([input_path, output_path]))
+            with open(output_path, "r") as fp:
+                self.assertEqual(response.data.decode(), fp.read())
+
+    def test_fast_validation_matches_schema(self):
+        path_to_example_dir = pathlib.Path.cwd().parent / "example_payloads"
+        with open(path_to_example_dir / "payload3.json", "r") as fp:
+            example_content = json.load(fp)
+        power_plants = example_content["powerplants"]
+        payloads = [example_content,
+                    dict(example_content, load="480"),
+                    dict(example_content, load=-1),
+                    dict(example_content, fuels={"wind(%)": True}),
+                    dict(example_content, extra=1),
+                    dict(example_content, powerplants=[]),
+                    dict(example_content, powerplants=power_plants[:-1] + [dict(power_plants[-1], pmin=-1)]),
+                    dict(example_content, powerplants=power_plants[:-1] + [dict(power_plants[-1], type="nuclear")]),
+                    dict(example_content, powerplants=power_plants[:-1] + [dict(power_plants[-1], min_up_time=1.5)]),
+                    dict(example_content, powerplants=power_plants[:-1] + [{"name": "tj2"}, 3])]
+        schema_client = create_app("test").test_client()
+        fast_app = create_app("test")
+        fast_app.config["VALIDATION_MODE"] = "fast"
+        fast_client = fast_app.test_client()
+        for payload in payloads:
+            schema_response = schema_client.post("/powerplant/", json=payload)
+            fast_response = fast_client.post("/powerplant/", json=payload)
+            self.assertEqual((schema_response.status_code, schema_response.get_json()),
+                             (fast_response.status_code, fast_response.get_json()))
+
+        # Only the first payload is proven valid, the string load being left to the schema
+        self.assertEqual([True] + [False] * (len(payloads) - 1),
+                         [fast_validation.parse_load_body(json.dumps(payload)) is not None for payload in payloads])
+        scheduled_power_plants = [dict(power_plant, startup_cost=10, min_up_time=2) for power_plant in power_plants[:2]]
+        input_args, registered_fleet = fast_validation.fast_load_validator.validate(
+            dict(example_content, powerplants=scheduled_power_plants + power_plants[2:]))
+        self.assertEqual({"load": 910.0, "fuels": example_content["fuels"]},
+                         {key: input_args[key] for key in ("load", "fuels")})
+        self.assertEqual(DispatchCache.canonicalize_power_plants(power_plants), registered_fleet.canonical_power_plants)
+        self.assertEqual([10, 10, 0, 0, 0, 0], registered_fleet.fleet.startup_cost.tolist())
+        self.assertEqual([2, 2, 0, 0, 0, 0], registered_fleet.fleet.min_up_time.tolist())
+
+    def test_solver_pool_rejects_work_beyond_its_budget(self):
+        solver_pool = SolverPool(max_workers=1, max_pending=1, timeout=0.1)
+        try:
+            self.assertEqual([{'name': 'gasfiredcheap', 'p': 10}], solver_pool.run(
+                load_calculations.load_distributor,
+                {"load": 10, "fuels": {"gas(euro/MWh)": 13.4},
+                 "powerplants": [{"name": "gasfiredcheap", "type": "gasfired", "efficiency": 0.5, "pmin": 0,
+                                  "pmax": 100}]}, timeout=10))
+            # A solve gives its place back before returning, so the next one of the same thread is accepted
+            for _ in range(50):
+                solver_pool.run(time.sleep, 0, timeout=10)
+            with self.assertRaises(SolverTimeoutError):
+                solver_pool.run(time.sleep, 1)
+            # The sleep still runs in the worker and holds the only place of the pool
+            with self.assertRaises(SolverPoolBusyError):
+                solver_pool.run(time.sleep, 0)
+        finally:
+            solver_pool.shutdown()
+
+    def test_registered_fleet_is_sent_once_to_a_worker(self):
+        path_to_example_dir = pathlib.Path.cwd().parent / "example_payloads"
+        with open(path_to_example_dir / "payload3.json", "r") as fp:
+            example_content = json.load(fp)
+        registered_fleet = FleetRegistry().register("north", example_content["powerplants"])
+        load_args = {"load": example_content["load"], "fuels": example_content["fuels"]}
+        solver_pool = SolverPool(max_workers=1, max_pending=1, timeout=10)
+        try:
+            with self.assertRaises(FleetNotInWorkerError):
+                solver_pool.run(dispatch_in_worker, load_calculations.registered_fleet_load_distributor, "north",
+                                registered_fleet.version, load_args)
+            expected = load_calculations.load_distributor(example_content, cache=None)
+            self.assertEqual(expected, solver_pool.run(
+                dispatch_in_worker, load_calculations.registered_fleet_load_distributor, "north",
+                registered_fleet.version, load_args, registered_fleet.power_plants))
+            # The worker holds the fleet now, the ID and version are enough
+            self.assertEqual(expected, solver_pool.run(
+                dispatch_in_worker, load_calculations.registered_fleet_load_distributor, "north",
+                registered_fleet.version, load_args))
+            # Registering the fleet again with other power plants changes its version
+            other_fleet = FleetRegistry().register("north", example_content["powerplants"][:-1])
+            self.assertNotEqual(registered_fleet.version, other_fleet.version)
+            with self.assertRaises(FleetNotInWorkerError):
+                solver_pool.run(dispatch_in_worker, load_calculations.registered_fleet_load_distributor, "north",
+                                other_fleet.version, load_args)
+        finally:
+            solver_pool.shutdown()
+
+    @parameterized.expand([
+        ("payload1.json",),
+        ("payload2.json",),
+        ("payload3.json",),
+    ])
+    def test_bnb_engine_matches_dp_engine(self, file_name):
+        path_to_example_dir = pathlib.Path.cwd().parent / "example_payloads"
+        with open(path_to_example_dir / file_name, "r") as fp:
+            example_content = json.load(fp)
+        self.assertEqual(load_calculations.load_distributor(example_content, engine="dp", cache=None),
+                         load_calculations.load_distributor(example_content, engine="bnb", cache=None))
+
+    @parameterized.expand([
+        (33.33,),
+        (27.3,),
+    ])
+    def test_dp_engine_keeps_wind_turbines_off_its_grid(self, wind_percentage):
+        path_to_example_dir = pathlib.Path.cwd().parent / "example_payloads"
+        with open(path_to_example_dir / "payload1.json", "r") as fp:
+            example_content = json.load(fp)
+        example_content["fuels"]["wind(%)"] = wind_percentage
+        fleet_content = {"fuels": example_content["fuels"], "powerplants": example_content["powerplants"],
+                         "loads": [example_content["load"]]}
+        client = create_app("test").test_client()
+        expected = load_calculations.load_distributor(example_content, engine="legacy", cache=None)
+        batch = client.post("/powerplant/batch", json=fleet_content).get_json()[0]
+        for response in (client.post("/powerplant/", json=example_content).get_json(), batch["powerplants"]):
+            self.assertEqual([power_plant["name"] for power_plant in expected],
+                             [power_plant["name"] for power_plant in response])
+            for expected_power_plant, power_plant in zip(expected, response):
+                self.assertAlmostEqual(expected_power_plant["p"], power_plant["p"])
+        curve = client.post("/powerplant/curve", json=fleet_content).get_json()
+        self.assertAlmostEqual(batch["cost"], curve["loads"][0]["cost"])
+
+    def test_bnb_anytime_returns_incumbent_with_gap(self):
+        raw_input_data = {"load": 1395, "fuels": {"gas(euro/MWh)": 13.4, "co2(euro/ton)": 20},
+                          "powerplants": [{"name": f"gasfired{number}", "type": "gasfired",
+                                           "efficiency": 0.6 - number / 100, "pmin": 100 + 37 * (number % 4),
+                                           "pmax": 150 + 41 * (number % 5)} for number in range(20)]}
+        sorted_power_plants = load_calculations.LoadCalculationInterface.get_load_calculator_from_raw_data(
+            raw_input_data).get_sorted_power_plants()
+        optimal = BranchAndBoundCore().search(1395, sorted_power_plants)
+        self.assertTrue(optimal.complete)
+        self.assertEqual(0, optimal.optimality_gap)
+        self.assertAlmostEqual(load_calculations.LoadCalculatorCore.calculate_cost_of_powerplant_dict(
+            DynamicProgrammingCore().get_optimal_power_plants_for_load(1395, sorted_power_plants)), optimal.cost)
+        incumbent = BranchAndBoundCore(node_limit=50).search(1395, sorted_power_plants)
+        self.assertFalse(incumbent.complete)
+        self.assertGreater(incumbent.optimality_gap, 0)
+        self.assertGreaterEqual(incumbent.cost, optimal.cost)
+        self.assertAlmostEqual(1395, sum(incumbent.dispatch.values()))
+        self.assertEqual(50, incumbent.nodes_explored)
+
+    def test_bnb_time_limit_reaches_requests_without_recursion(self):
+        power_plants = fleet_generator.generate_power_plants(200, seed=0)
+        sorted_power_plants = load_calculations.LoadCalculationInterface.get_load_calculator_from_raw_data(
+            {"load": 586, "fuels": fleet_generator.generate_fuels(0), "powerplants": power_plants}
+        ).get_sorted_power_plants()
+        recursion_limit = sys.getrecursionlimit()
+        with mock.patch.object(Config, "SEARCH_TIME_LIMIT", 0.4):
+            solver = load_calculations.get_solver("bnb", searches=2)
+        self.assertEqual(0.2, solver.time_limit)
+        # A clock advancing 1/16 s at each reading, the first one setting the deadline
+        clock = mock.Mock(monotonic=mock.Mock(side_effect=itertools.count(0, 0.0625)))
+        with mock.patch.object(branch_and_bound, "time", clock):
+            incumbent = solver.search(586, sorted_power_plants)
+        # Stopped at the fourth reading, the clock being read every 64 nodes
+        self.assertEqual(256, incumbent.nodes_explored)
+        self.assertFalse(incumbent.complete)
+        self.assertAlmostEqual(586, sum(incumbent.dispatch.values()))
+        # Deeper than the recursion limit: one level per power plant
+        deep_power_plants = fleet_generator.generate_power_plants(1200, seed=0)
+        sorted_power_plants = load_calculations.LoadCalculationInterface.get_load_calculator_from_raw_data(
+            {"load": 0, "fuels": fleet_generator.generate_fuels(0), "powerplants": deep_power_plants}
+        ).get_sorted_power_plants()
+        load = int(sorted_power_plants.effective_pmax.sum()) - 1
+        self.assertAlmostEqual(load, sum(BranchAndBoundCore(time_limit=5).search(load, sorted_power_plants)
+                                         .dispatch.values()))
+        self.assertEqual(recursion_limit, sys.getrecursionlimit())
+
+    def test_dp_engine_falls_back_to_bnb_past_its_cells_budget(self):
+        power_plants = fleet_generator.generate_power_plants(200, seed=0, decimals=2)
+        fuels = fleet_generator.generate_fuels(0)
+        load = fleet_generator.capacity_loads(power_plants, fuels, 1, 0.5, 0.5)[0]
+        sorted_power_plants = load_calculations.LoadCalculationInterface.get_load_calculator_from_raw_data(
+            {"load": load, "fuels": fuels, "powerplants": power_plants}).get_sorted_power_plants()
+        previous = metrics.RequestProfile.start()
+        try:
+            dispatch = load_calculations.get_solver("dp").get_optimal_power_plants_for_load(load, sorted_power_plants)
+        finally:
+            profile = metrics.RequestProfile.stop(previous)
+        # Past the cells budget, searched once by the bnb engine, to the end
+        self.assertEqual({"dp": 1, "bnb": 1}, profile.solver_calls)
+        self.assertEqual(0, profile.incomplete_searches)
+        self.assertAlmostEqual(BranchAndBoundCore().search(load, sorted_power_plants).cost,
+                               load_calculations.LoadCalculatorCore.calculate_cost_of_powerplant_dict(dispatch))
+        # Within the budget, the choices of the cost tables are packed over the window of each power plant
+        small_payload = {"fuels": dict(fuels, **{"wind(%)": 100}), "powerplants": power_plants[:20]}
+        small_load = fleet_generator.capacity_loads(small_payload["powerplants"], small_payload["fuels"], 1,
+                                                    0.5, 0.5)[0]
+        small_power_plants = load_calculations.LoadCalculationInterface.get_load_calculator_from_raw_data(
+            dict(small_payload, load=small_load)).get_sorted_power_plants()
+        core = DynamicProgrammingCore()
+        cost_tables = core.build_cost_tables(small_power_plants, 0.01, small_load, small_load)
+        self.assertLess(sum(choices.pmin.nbytes + choices.marginal.nbytes + choices.pmax.nbytes
+                            for choices in cost_tables.choices if choices is not None),
+                        len(cost_tables.plants) * (small_load * 100 + 1) / 2)
+        with self.assertRaises(GridTooLargeError):
+            DynamicProgrammingCore(max_cells=1000).build_cost_tables(small_power_plants, 0.01, small_load, small_load)
+        cost = load_calculations.LoadCalculatorCore.calculate_cost_of_powerplant_dict
+        self.assertAlmostEqual(cost(core.get_optimal_power_plants_for_load(small_load, small_power_plants)), cost(
+            DynamicProgrammingCore(max_cells=1000).get_optimal_power_plants_for_load(small_load, small_power_plants)))
+        with mock.patch.object(Config, "DP_MAX_CELLS", 1000):
+            response = create_app("test").test_client().post(
+                "/powerplant/curve", json=small_payload)
+        self.assertEqual(400, response.status_code)
+        self.assertIn("exceeds 1000 cells", response.get_json()["custom"])
+
+    def test_incomplete_searches_are_surfaced_in_the_response_and_metrics(self):
+        raw_input_data = {"load": 1395, "fuels": {"gas(euro/MWh)": 13.4, "co2(euro/ton)": 20},
+                          "powerplants": [{"name": f"gasfired{number}", "type": "gasfired",
+                                           "efficiency": 0.6 - number / 100, "pmin": 100 + 37 * (number % 4),
+                                           "pmax": 150 + 41 * (number % 5)} for number in range(20)]}
+        client = create_app("test").test_client()
+        dispatch_cache.clear()
+        self.assertNotIn("X-Optimality-Gap", client.post("/powerplant/", json=raw_input_data).headers)
+        dispatch_cache.clear()
+        # Past the cells budget, the dp engine falls back to a search stopped at its node limit
+        with mock.patch.object(Config, "DP_MAX_CELLS", 1000), \
+                mock.patch("app.main.service.unit_commitment.BranchAndBoundCore",
+                           lambda time_limit: BranchAndBoundCore(node_limit=50, time_limit=time_limit)):
+            response = client.post("/powerplant/", json=raw_input_data, headers={"X-Profile": "stages"})
+        self.assertEqual(200, response.status_code)
+        self.assertGreater(float(response.headers["X-Optimality-Gap"]), 0)
+        self.assertEqual("bnb=1, dp=1", response.headers["X-Solver-Calls"])
+        self.assertIn("powerplant_incomplete_searches_total ", client.get("/metrics").data.decode())
+
+    def test_fleet_generator_is_seeded(self):
+        payload = fleet_generator.generate_payload(30, seed=3)
+        self.assertEqual(payload, fleet_generator.generate_payload(30, seed=3))
+        self.assertNotEqual(payload, fleet_generator.generate_payload(30, seed=4))
+        self.assertEqual({}, PowerPlantLoadSchema().validate(payload))
+        loads = fleet_generator.transition_loads(payload["powerplants"], payload["fuels"], 10, seed=3)
+        self.assertEqual(10, len(loads))
+        self.assertEqual(sorted(loads), loads)
+        capacity = sum(power_plant["pmax"] for power_plant in payload["powerplants"])
+        self.assertGreater(loads[-1], capacity / 2)
+        fractional_payload = fleet_generator.generate_payload(30, seed=3, decimals=2)
+        self.assertEqual({}, PowerPlantLoadSchema().validate(fractional_payload))
+        self.assertTrue(any(power_plant["pmax"] != int(power_plant["pmax"])
+                            for power_plant in fractional_payload["powerplants"]))
+
+    def test_benchmark_records_the_failed_calls(self):
+        payload = fleet_generator.generate_payload(10, seed=0)
+        summary = benchmarks.benchmark(benchmarks.distribute, [payload, dict(payload, load=100000)])
+        self.assertEqual(2, summary["calls"])
+        self.assertEqual(1, summary["failures"])
+        self.assertEqual(["PowerPlantConfigurationError"], [error.split(":")[0] for error in summary["errors"]])
+        # A search that found no dispatch within its limits
+        with mock.patch.object(benchmarks, "distribute", side_effect=SolverTimeoutError("No configuration found")):
+            summary = benchmarks.benchmark(benchmarks.distribute, [payload])
+        self.assertEqual(1, summary["failures"])
+        self.assertEqual(["SolverTimeoutError: No configuration found"], list(summary["errors"]))
+
+    def test_benchmark_comparison_flags_regressions(self):
+        baseline = {"benchmarks": {"http/powerplant/10": {"p50_ms": 10.0}, "validation/10": {"p50_ms": 1.0}}}
+        report = {"benchmarks": {"http/powerplant/10": {"p50_ms": 11.0}, "validation/10": {"p50_ms": 1.5},
+                                 "load_distributor/dp/10": {"p50_ms": 2.0}}}
+        self.assertEqual([("validation/10", 1.0, 1.5)], benchmarks.compare(report, baseline, threshold=0.2))
+
+    def test_load_test_counts_statuses_of_replayed_requests(self):
+        server = make_server("127.0.0.1", 0, create_app("test"), threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            requests = load_test.read_requests()
+            requests += [("POST", "/powerplant/", dict(requests[0][2], load=100000)),
+                         ("POST", "/powerplant/", dict(requests[0][2], load=-1))]
+            summary = load_test.run_load_test("127.0.0.1", server.server_port, requests, concurrency=2, duration=0.5)
+        finally:
+            server.shutdown()
+        self.assertEqual(summary["requests"], sum(summary["statuses"].values()))
+        self.assertEqual({"200", "400", "422"}, set(summary["statuses"]))
+        self.assertAlmostEqual(summary["statuses"]["400"] / summary["requests"], summary["error_rates"]["infeasible"])
+        self.assertGreater(summary["statuses"]["200"], summary["statuses"]["422"])
+        self.assertLessEqual(summary["latency"]["p50_ms"], summary["latency"]["p99_ms"])
+        self.assertIsNone(summary["server"])
+
+    def test_exact_modes_match_exhaustive_oracle(self):
+        # The exact modes, and the schedule with ramps whose feasible profiles must be scheduled
+        modes = [mode for mode in oracle.DISPATCH_MODES if mode != "legacy"]
+        for seed in range(25):
+            with self.subTest(seed=seed):
+                discrepancies, durations = oracle.check_case(oracle.generate_case(seed), modes)
+                self.assertEqual([], discrepancies)
+                self.assertEqual(set(modes), set(durations))
+        fleet = Fleet.from_raw_data([{"name": "a", "type": "gasfired", "efficiency": 0.5, "pmin": 50, "pmax": 100},
+                                     {"name": "b", "type": "turbojet", "efficiency": 0.3, "pmin": 0, "pmax": 40}])
+        fleet.set_fuels({"gas(euro/MWh)": 10, "kerosine(euro/MWh)": 30, "co2(euro/ton)": 0})
+        cost, loads = oracle.exhaustive_dispatch(fleet, 35)
+        self.assertEqual([0, 35], loads.tolist())
+        self.assertEqual([70, 0], oracle.exhaustive_dispatch(fleet, 70)[1].tolist())
+        self.assertIsNone(oracle.exhaustive_dispatch(fleet, 45))
+        self.assertIsNone(oracle.exhaustive_dispatch(fleet, 141))
+        self.assertEqual({"expected_cost": cost, "cost": cost - 1},
+                         oracle.compare_with_oracle(fleet, 35, (cost, loads), cost - 1))
+
+    def test_unknown_engine(self):
+        with self.assertRaises(ValueError):
+            load_calculations.load_distributor({"load": 0, "fuels": {}, "powerplants": []}, engine="simplex")
+
 if __name__=="__main__":
     unittest.main()
\ No newline at end of file
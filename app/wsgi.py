@@ -0,0 +1,6 @@
+import os
+from app.main import create_app
+
+# Entry point of the WSGI server. Preloading this module builds the app and imports the solvers once, before the
+# workers are forked
+app = create_app(os.getenv('FLASK_ENV') or 'production')